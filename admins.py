@@ -0,0 +1,62 @@
+"""Список админов в памяти.
+
+Таблица admins читается один раз при старте в неизменяемый frozenset,
+проверка на горячем пути - просто `chat_id in admin_set`. Изменения
+через add/remove пишутся в БД и сразу подменяют множество целиком,
+внешние правки admins.db подхватываются через watchdog.
+"""
+import os
+
+from watch import FileWatcher
+
+
+def insert_admin(conn, chat_id):
+    conn.execute("INSERT OR IGNORE INTO admins (chat_id) VALUES (?)", (chat_id,))
+
+
+def _delete_admin(conn, chat_id):
+    return conn.execute("DELETE FROM admins WHERE chat_id = ?", (chat_id,)).rowcount
+
+
+def _select_admins(conn):
+    return frozenset(row[0] for row in conn.execute("SELECT chat_id FROM admins"))
+
+
+class AdminSet:
+    def __init__(self, db):
+        self.db = db
+        self._ids = frozenset()
+        self._watcher = None
+
+    def __contains__(self, chat_id):
+        return chat_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def load(self):
+        """Синхронная загрузка при старте (до запуска event loop)."""
+        self._ids = self.db.submit_read(_select_admins).result()
+
+    async def reload(self):
+        self._ids = await self.db.read(_select_admins)
+
+    async def add(self, chat_id):
+        await self.db.write(insert_admin, chat_id)
+        self._ids = self._ids | {chat_id}
+
+    async def remove(self, chat_id):
+        removed = await self.db.write(_delete_admin, chat_id)
+        self._ids = self._ids - {chat_id}
+        return bool(removed)
+
+    # ---------- отслеживание файла ----------
+    def watch(self):
+        path = os.path.abspath(self.db.path)
+        self._watcher = FileWatcher([path, path + "-wal"], self.reload)
+        self._watcher.start()
+
+    def stop_watching(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
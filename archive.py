@@ -0,0 +1,268 @@
+"""Архив закрытых заявок: переписка уходит из accounts.db в сжатые файлы.
+
+Заявка, закрытая дольше archive_after_days дней, переносится целиком -
+строка accounts, её messages и attachments - одной JSON-строкой в
+архив месяца закрытия: <dir>/YYYY-MM.jsonl.gz. Каждый проход дописывает
+в файл новый gzip-член, так что старые части не перепаковываются, а
+gzip читает их подряд как один поток.
+
+Порядок прохода: сначала файл дописывается и сбрасывается на диск,
+потом одной транзакцией в archive_manifest пишется, где лежит заявка,
+и строки удаляются из горячих таблиц (поисковый индекс чистят триггеры
+schema v6). Падение между шагами оставит в архиве копию заявки, которая
+ещё есть в БД; следующий проход допишет её снова, а fetch() берёт
+последнюю запись.
+
+Освободившиеся страницы возвращаются порциями через incremental_vacuum,
+чтобы не занимать поток-писатель надолго. Для этого файлу нужен
+auto_vacuum=INCREMENTAL, а он включается только полным VACUUM, который
+переписывает весь файл и на это время останавливает запись. Поэтому
+это отдельный шаг обслуживания (`python bot.py --vacuum` при
+остановленном боте), а не часть старта; без него страницы просто
+переиспользуются SQLite. Так горячая база держит только открытые и
+недавно закрытые заявки.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+
+from lifecycle import CLOSED
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = "archive"
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_INTERVAL = 3600  # секунд между проходами
+ARCHIVE_BATCH = 200      # заявок за проход
+VACUUM_PAGES = 500       # страниц за один incremental_vacuum
+AUTO_VACUUM_INCREMENTAL = 2
+
+# Дословно как в предикате idx_accounts_closed (schema v9)
+CLOSED_CONDITION = f"status = '{CLOSED}'"
+
+
+def _rows(cursor):
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+def _cold_accounts(conn, after_days, limit):
+    """-> [заявка со своими messages и attachments], самые давно закрытые первыми."""
+    accounts = _rows(conn.execute(
+        f"SELECT * FROM accounts INDEXED BY idx_accounts_closed "
+        f"WHERE {CLOSED_CONDITION} AND closed_at < datetime('now', ?) ORDER BY closed_at LIMIT ?",
+        (f"-{after_days} days", limit),
+    ))
+    for account in accounts:
+        account_id = account["id"]
+        messages = _rows(conn.execute(
+            "SELECT * FROM messages WHERE account_id = ? ORDER BY timestamp, id", (account_id,)))
+        attachments = _rows(conn.execute(
+            "SELECT * FROM attachments WHERE account_id = ? ORDER BY message_id, position",
+            (account_id,)))
+        account["messages"] = messages
+        account["attachments"] = attachments
+    return accounts
+
+
+def _partition(account):
+    # closed_at - 'YYYY-MM-DD HH:MM:SS' (CURRENT_TIMESTAMP)
+    return (account.get("closed_at") or account.get("created_at") or "unknown")[:7]
+
+
+def _append(directory, partition, accounts):
+    """Дописывает заявки новым gzip-членом и ждёт, пока данные лягут на диск."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{partition}.jsonl.gz")
+    with open(path, "ab") as f:
+        with gzip.GzipFile(fileobj=f, mode="wb") as archive:
+            for account in accounts:
+                archive.write(json.dumps(account, ensure_ascii=False).encode() + b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _forget(conn, accounts):
+    """Манифест + удаление из горячих таблиц; -> (перенесённые заявки, удалено сообщений).
+
+    Заявку, которую успели переоткрыть после чтения, не трогаем: её копия
+    в архиве без строки манифеста не видна.
+    """
+    moved, deleted = [], 0
+    for account in accounts:
+        account_id = account["id"]
+        if conn.execute(f"DELETE FROM accounts WHERE id = ? AND {CLOSED_CONDITION}",
+                        (account_id,)).rowcount == 0:
+            continue
+        conn.execute(
+            "INSERT OR REPLACE INTO archive_manifest (account_id, partition, user_id, username, closed_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (account_id, _partition(account), account["user_id"], account["username"], account["closed_at"]),
+        )
+        conn.execute("DELETE FROM attachments WHERE account_id = ?", (account_id,))
+        deleted += conn.execute("DELETE FROM messages WHERE account_id = ?", (account_id,)).rowcount
+        # Недоставленное (pending) не трогаем: оно ещё может уйти
+        conn.execute("DELETE FROM outbox WHERE account_id = ? AND status <> 'pending'", (account_id,))
+        moved.append(account)
+    return moved, deleted
+
+
+def _auto_vacuum(conn):
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+
+def _vacuum(conn):
+    """Полный VACUUM; заодно включает auto_vacuum=INCREMENTAL (иначе его не сменить)."""
+    conn.commit()  # VACUUM не работает внутри транзакции
+    conn.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}")
+    conn.execute("VACUUM")
+
+
+def _incremental_vacuum(conn, pages):
+    """-> сколько свободных страниц вернули файлу."""
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if before:
+        # execute() шагает прагму один раз - это одна страница; executescript
+        # доводит её до конца (транзакции здесь нет, коммитить ему нечего)
+        conn.executescript(f"PRAGMA incremental_vacuum({pages})")
+    return before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def _checkpoint(conn):
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+
+def _manifest_entry(conn, account_id):
+    return conn.execute("SELECT partition FROM archive_manifest WHERE account_id = ?",
+                        (account_id,)).fetchone()
+
+
+def _read_archived(directory, partition, account_id):
+    path = os.path.join(directory, f"{partition}.jsonl.gz")
+    found = None
+    with gzip.open(path, "rt", encoding="utf-8") as archive:
+        for line in archive:
+            # Быстрая проверка до разбора JSON: id всегда первым ключом
+            if line.startswith(f'{{"id": {account_id},'):
+                found = json.loads(line)
+    return found
+
+
+def format_transcript(account):
+    """Архивная заявка текстом - для отправки админу файлом."""
+    photos = {}
+    for attachment in account.get("attachments", ()):
+        photos[attachment["message_id"]] = photos.get(attachment["message_id"], 0) + 1
+    lines = [
+        f"#{account['id']} @{account.get('username') or '-'} ({account['user_id']}), "
+        f"создана {account.get('created_at')}, закрыта {account.get('closed_at')}",
+        "",
+        account.get("account_info") or "",
+    ]
+    if photos.get(None):
+        lines.append(f"[вложений: {photos[None]}]")
+    lines.append("")
+    for message in account.get("messages", ()):
+        author = "Админ" if message["from_admin"] else "Пользователь"
+        extra = f" [вложений: {photos[message['id']]}]" if message["id"] in photos else ""
+        lines.append(f"[{message['timestamp']}] {author}: {message['message_text'] or ''}{extra}")
+    return "\n".join(lines)
+
+
+class Retention:
+    def __init__(self, db, routes, directory=ARCHIVE_DIR, archive_after_days=ARCHIVE_AFTER_DAYS,
+                 interval=ARCHIVE_INTERVAL, batch=ARCHIVE_BATCH):
+        self.db = db
+        self.routes = routes
+        self.directory = directory
+        self.archive_after_days = archive_after_days
+        self.interval = interval
+        self.batch = batch
+        self._task = None
+        # Счётчики для наблюдения
+        self.archived = 0
+        self.messages_archived = 0
+        self.pages_freed = 0
+
+    async def start(self):
+        if self.archive_after_days <= 0:
+            return
+        if await self.db.read(_auto_vacuum) != AUTO_VACUUM_INCREMENTAL:
+            logger.warning(f"{self.db.path}: auto_vacuum не INCREMENTAL, место после архивации "
+                           f"не вернётся файлу - при остановленном боте запустите bot.py --vacuum")
+        self._task = asyncio.create_task(self._archive_loop(), name="retention")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def archive_batch(self):
+        """Переносит до batch заявок в архив; -> сколько перенесено."""
+        accounts = await self.db.read(_cold_accounts, self.archive_after_days, self.batch)
+        if not accounts:
+            return 0
+        partitions = {}
+        for account in accounts:
+            partitions.setdefault(_partition(account), []).append(account)
+        for partition, chunk in partitions.items():
+            await asyncio.to_thread(_append, self.directory, partition, chunk)
+        moved, deleted = await self.db.write(_forget, accounts)
+        for account in moved:
+            self.routes.invalidate_user(account["user_id"])
+            if account["topic_id"]:
+                self.routes.invalidate_topic(account["admin_chat_id"], account["topic_id"])
+        self.archived += len(moved)
+        self.messages_archived += deleted
+        logger.info(f"В архив: {len(moved)} заявок, {deleted} сообщений")
+        return len(accounts)
+
+    async def vacuum(self):
+        """Шаг обслуживания: полный VACUUM с включением auto_vacuum=INCREMENTAL.
+        Держит поток-писатель всё время работы; -> секунд."""
+        started = time.monotonic()
+        await self.db.write(_vacuum)
+        elapsed = time.monotonic() - started
+        logger.info(f"{self.db.path}: VACUUM за {elapsed:.1f} с, auto_vacuum=INCREMENTAL")
+        return elapsed
+
+    async def reclaim(self):
+        """Возвращает свободные страницы порциями, между ними пишут остальные."""
+        while True:
+            freed = await self.db.write(_incremental_vacuum, VACUUM_PAGES)
+            self.pages_freed += freed
+            if freed < VACUUM_PAGES:
+                break
+        await self.db.write(_checkpoint)
+
+    async def fetch(self, account_id):
+        """Заявка из архива со всей перепиской или None."""
+        entry = await self.db.read(_manifest_entry, account_id)
+        if entry is None:
+            return None
+        return await asyncio.to_thread(_read_archived, self.directory, entry[0], account_id)
+
+    async def _archive_loop(self):
+        while True:
+            try:
+                archived = 0
+                # Полная пачка - скорее всего, есть ещё: следующая сразу
+                while True:
+                    count = await self.archive_batch()
+                    archived += count
+                    if count < self.batch:
+                        break
+                if archived:
+                    await self.reclaim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка архивации заявок: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,114 @@
+"""Распределение новых заявок по нескольким группам админов.
+
+Одна супергруппа упирается в лимит Telegram на отправку в группу (20
+сообщений в минуту) и в то, что все админы разбирают один форум. С
+несколькими группами у каждой свой bucket в планировщике исходящих, так
+что пропускная способность пересылки растёт с числом групп.
+
+Группа выбирается один раз, при создании топика, и хранится в заявке
+(accounts.admin_chat_id); дальше маршрутизация идёт по паре
+(группа, топик). Балансировщик подключаемый - BALANCERS[name]:
+
+* least_open - группа с наименьшим числом открытых заявок;
+* round_robin - по кругу;
+* language - по language_code пользователя (LANGUAGE_GROUPS), для
+  остальных языков - least_open.
+"""
+import itertools
+import logging
+import time
+
+from lifecycle import OPEN_CONDITION
+
+logger = logging.getLogger(__name__)
+
+COUNTS_REFRESH = 30  # секунд, сколько least_open доверяет своим счётчикам
+
+
+def parse_groups(value):
+    """'-100a, -100b' -> [-100a, -100b] без повторов, в исходном порядке."""
+    groups = []
+    for part in (value or "").replace(";", ",").split(","):
+        part = part.strip()
+        if part and int(part) not in groups:
+            groups.append(int(part))
+    return groups
+
+
+def parse_languages(value):
+    """'de:-100a, en:-100b' -> {'de': -100a, 'en': -100b}."""
+    languages = {}
+    for part in (value or "").replace(";", ",").split(","):
+        if ":" not in part:
+            continue
+        language, _, group = part.partition(":")
+        languages[language.strip().lower()] = int(group)
+    return languages
+
+
+def _open_by_group(conn):
+    # Частичный индекс idx_accounts_open_by_group (schema v8)
+    return dict(conn.execute(
+        f"SELECT admin_chat_id, COUNT(*) FROM accounts INDEXED BY idx_accounts_open_by_group "
+        f"WHERE {OPEN_CONDITION} AND admin_chat_id IS NOT NULL GROUP BY admin_chat_id"
+    ).fetchall())
+
+
+class RoundRobinBalancer:
+    def __init__(self, db, groups, **kwargs):
+        self.groups = groups
+        self._cycle = itertools.cycle(groups)
+
+    async def choose(self, language=None):
+        return next(self._cycle)
+
+
+class LeastOpenBalancer:
+    """Счётчики открытых заявок берутся из БД не чаще раза в COUNTS_REFRESH
+    секунд, а между обновлениями выбранной группе прибавляется по одной -
+    иначе параллельные воркеры intake отправили бы всех в одну группу."""
+
+    def __init__(self, db, groups, **kwargs):
+        self.db = db
+        self.groups = groups
+        self._counts = {}
+        self._loaded_at = None
+
+    async def choose(self, language=None):
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at > COUNTS_REFRESH:
+            self._counts = await self.db.read(_open_by_group)
+            self._loaded_at = now
+        group = min(self.groups, key=lambda group: self._counts.get(group, 0))
+        self._counts[group] = self._counts.get(group, 0) + 1
+        return group
+
+
+class LanguageBalancer:
+    def __init__(self, db, groups, languages=None, **kwargs):
+        self.groups = groups
+        self.languages = {
+            language: group for language, group in (languages or {}).items() if group in groups
+        }
+        self.fallback = LeastOpenBalancer(db, groups)
+
+    async def choose(self, language=None):
+        group = self.languages.get((language or "").split("-")[0].lower())
+        if group is not None:
+            return group
+        return await self.fallback.choose(language)
+
+
+BALANCERS = {
+    "least_open": LeastOpenBalancer,
+    "round_robin": RoundRobinBalancer,
+    "language": LanguageBalancer,
+}
+
+
+def make_balancer(name, db, groups, languages=None):
+    cls = BALANCERS.get(name)
+    if cls is None:
+        logger.warning(f"Неизвестный балансировщик {name}, использую least_open")
+        cls = LeastOpenBalancer
+    return cls(db, groups, languages=languages)
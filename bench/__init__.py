@@ -0,0 +1 @@
+"""Нагрузочные прогоны бота против локальной подделки Bot API (python -m bench)."""
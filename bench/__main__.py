@@ -0,0 +1,126 @@
+"""Нагрузочный прогон бота без Telegram.
+
+Поднимает подделку Bot API, запускает настоящий bot.py (его main(),
+polling) во временном каталоге с чистыми базами и гонит через него
+синтетический или записанный трафик. В конце - p50/p95/p99 по
+обработчикам, потери, пропускная способность и вызовы API.
+
+    python -m bench --users 200 --messages 10 --latency 0.05 --rate-429 0.01
+    python -m bench --users 50 --record traffic.jsonl
+    python -m bench --replay traffic.jsonl --speed 4 --json result.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import tempfile
+
+from bench.fake_api import FakeBotAPI
+from bench.replay import load, replay
+from bench.report import Tracker, format_summary
+from bench.traffic import ADMIN_GROUP_ID, ADMIN_ID, Recorder, TrafficGenerator
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bot.py")
+TOKEN = "123456:BENCH"
+STARTUP_TIMEOUT = 30.0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__.split("\n\n")[0])
+    load_group = parser.add_argument_group("трафик")
+    load_group.add_argument("--users", type=int, default=20)
+    load_group.add_argument("--messages", type=int, default=5, help="сообщений от пользователя после заявки")
+    load_group.add_argument("--admin-replies", type=int, default=2)
+    load_group.add_argument("--photo-ratio", type=float, default=0.2)
+    load_group.add_argument("--album-ratio", type=float, default=0.1)
+    load_group.add_argument("--think-time", type=float, default=0.2, help="средняя пауза между действиями, с")
+    load_group.add_argument("--ramp-up", type=float, default=1.0, help="за сколько секунд приходят все пользователи")
+    load_group.add_argument("--seed", type=int, default=1)
+    load_group.add_argument("--replay", metavar="JSONL", help="воспроизвести записанный трафик вместо генерации")
+    load_group.add_argument("--speed", type=float, default=1.0, help="ускорение replay (0 - без пауз)")
+    load_group.add_argument("--record", metavar="JSONL", help="записать сгенерированный трафик")
+    api_group = parser.add_argument_group("подделка Bot API")
+    api_group.add_argument("--latency", type=float, default=0.0, help="задержка ответа API, с")
+    api_group.add_argument("--jitter", type=float, default=0.0)
+    api_group.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429")
+    api_group.add_argument("--retry-after", type=int, default=1)
+    run_group = parser.add_argument_group("прогон")
+    run_group.add_argument("--drain", type=float, default=30.0, help="сколько ждать хвост ответов, с")
+    run_group.add_argument("--workdir", help="каталог для баз и лога бота (по умолчанию временный)")
+    run_group.add_argument("--json", metavar="PATH", help="сохранить отчёт в JSON")
+    return parser.parse_args(argv)
+
+
+async def start_bot(api, workdir):
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN=TOKEN,
+        BOT_API_BASE_URL=api.base_url,
+        ADMIN_GROUP_ID=str(ADMIN_GROUP_ID),
+        FIRST_ADMIN_ID=str(ADMIN_ID),
+        UPDATE_MODE="polling",
+    )
+    log = open(os.path.join(workdir, "bot.log"), "ab")
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, BOT_PATH, cwd=workdir, env=env, stdout=log, stderr=log
+    )
+    log.close()
+    return process
+
+
+async def stop_bot(process):
+    if process.returncode is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(process.wait(), 30)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+
+async def run(args, workdir):
+    api = FakeBotAPI(TOKEN, latency=args.latency, jitter=args.jitter, rate_429=args.rate_429,
+                     retry_after=args.retry_after, seed=args.seed)
+    tracker = Tracker()
+    api.listeners.append(tracker.on_call)
+    api.delivery_listeners.append(tracker.on_delivered)
+    await api.start()
+    process = await start_bot(api, workdir)
+    recorder = Recorder(args.record) if args.record else None
+    try:
+        await asyncio.wait_for(api.ready.wait(), STARTUP_TIMEOUT)
+        if args.replay:
+            await replay(api, tracker, load(args.replay), speed=args.speed)
+        else:
+            generator = TrafficGenerator(
+                api, tracker, users=args.users, messages=args.messages,
+                photo_ratio=args.photo_ratio, album_ratio=args.album_ratio,
+                admin_replies=args.admin_replies, think_time=args.think_time,
+                recorder=recorder, seed=args.seed,
+            )
+            await generator.run(ramp_up=args.ramp_up)
+        await tracker.drain(args.drain)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        await stop_bot(process)
+        await api.stop()
+    return tracker.summary(api)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="bench-") as tmp:
+        workdir = args.workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+        summary = asyncio.run(run(args, workdir))
+    print(format_summary(summary))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
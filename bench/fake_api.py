@@ -0,0 +1,204 @@
+"""Локальная подделка Bot API для нагрузочных прогонов.
+
+Понимает getUpdates (long polling с offset/timeout), sendMessage,
+sendPhoto, sendMediaGroup, createForumTopic и всё, что бот вызывает по
+пути (getMe, deleteWebhook, editForumTopic, copyMessage...). На каждый
+вызов можно добавить задержку и с заданной вероятностью ответить 429
+с retry_after - так проверяется поведение под лимитами Telegram.
+
+Подключение бота: BOT_API_BASE_URL=<FakeBotAPI.base_url>.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter, deque
+from urllib.parse import parse_qsl, unquote
+
+from webhook import InvalidRequest, read_request, write_response
+
+BOT_ID = 777000111
+BOT_USERNAME = "bench_bot"
+
+
+class FakeBotAPI:
+    def __init__(self, token, host="127.0.0.1", port=0, latency=0.0, jitter=0.0,
+                 rate_429=0.0, retry_after=1, seed=None):
+        self.token = token
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.injected_429 = 0
+        self.ready = asyncio.Event()  # первый getUpdates: бот поднялся
+        self.listeners = []           # callback(method, params, now) на каждый исходящий вызов
+        self.delivery_listeners = []  # callback(update, now) при первой выдаче апдейта
+        self._updates = deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._thread_ids = itertools.count(1000)
+        self._delivered = set()
+        self._new_updates = asyncio.Event()
+        self._server = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def push_update(self, update):
+        """Кладёт апдейт (dict без update_id или с ним) в очередь getUpdates."""
+        update = dict(update)
+        update["update_id"] = next(self._update_ids)
+        self._updates.append(update)
+        self._new_updates.set()
+        return update
+
+    def pending_updates(self):
+        return len(self._updates)
+
+    # ---------- HTTP ----------
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                # Как Telegram: простаивающие keep-alive-соединения не рвём
+                request = await read_request(reader, keepalive_timeout=None)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload = await self._dispatch(path, headers, body)
+                write_response(writer, status, payload, keep_alive=True)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except InvalidRequest as e:
+            write_response(writer, e.status, {"ok": False}, keep_alive=False)
+        finally:
+            writer.close()
+
+    async def _dispatch(self, path, headers, body):
+        prefix = f"/bot{self.token}/"
+        if not path.startswith(prefix):
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        api_method = path[len(prefix):].split("?", 1)[0]
+        params = _parse_params(headers, body)
+        if api_method == "getUpdates":
+            self.ready.set()
+            return 200, {"ok": True, "result": await self._get_updates(params)}
+
+        self.calls[api_method] += 1
+        now = time.monotonic()
+        for listener in self.listeners:
+            listener(api_method, params, now)
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if self.rate_429 and self.random.random() < self.rate_429:
+            self.injected_429 += 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        return 200, {"ok": True, "result": self._result(api_method, params)}
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = list(itertools.islice(self._updates, limit))
+        now = time.monotonic()
+        for update in batch:
+            if update["update_id"] not in self._delivered:
+                self._delivered.add(update["update_id"])
+                for listener in self.delivery_listeners:
+                    listener(update, now)
+        return batch
+
+    # ---------- ответы ----------
+    def _message(self, params, **extra):
+        chat_id = int(params.get("chat_id", 0))
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME},
+        }
+        if params.get("message_thread_id"):
+            message["message_thread_id"] = int(params["message_thread_id"])
+            message["is_topic_message"] = True
+        message.update(extra)
+        return message
+
+    def _result(self, api_method, params):
+        if api_method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME,
+                    "can_join_groups": True, "can_read_all_group_messages": True,
+                    "supports_inline_queries": False}
+        if api_method == "sendMessage":
+            return self._message(params, text=params.get("text", ""))
+        if api_method == "sendPhoto":
+            return self._message(params, photo=[_photo_size(params.get("photo", ""))],
+                                 caption=params.get("caption"))
+        if api_method == "sendMediaGroup":
+            media = json.loads(params.get("media") or "[]")
+            return [self._message(params, photo=[_photo_size(item.get("media", ""))],
+                                  caption=item.get("caption")) for item in media]
+        if api_method == "createForumTopic":
+            return {"message_thread_id": next(self._thread_ids), "name": params.get("name", ""),
+                    "icon_color": 7322096}
+        if api_method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        if api_method == "copyMessages":
+            ids = json.loads(params.get("message_ids") or "[]")
+            return [{"message_id": next(self._message_ids)} for _ in ids]
+        return True
+
+
+def _photo_size(file_id):
+    return {"file_id": file_id, "file_unique_id": f"u{abs(hash(file_id))}", "width": 1280, "height": 720}
+
+
+def _parse_params(headers, body):
+    if not body:
+        return {}
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        return {k: v if isinstance(v, str) else json.dumps(v) for k, v in json.loads(body).items()}
+    if content_type.startswith("multipart/form-data"):
+        return _parse_multipart(content_type, body)
+    return dict(parse_qsl(body.decode(), keep_blank_values=True))
+
+
+def _parse_multipart(content_type, body):
+    boundary = content_type.split("boundary=", 1)[1].strip('"').encode()
+    params = {}
+    for part in body.split(b"--" + boundary):
+        head, _, value = part.partition(b"\r\n\r\n")
+        if b'name="' not in head:
+            continue
+        name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+        params[name] = unquote(value.rstrip(b"\r\n").decode(errors="replace"))
+    return params
@@ -0,0 +1,34 @@
+"""Воспроизведение записанного трафика через подделку Bot API.
+
+Формат - JSONL: либо голый апдейт на строку (выдаются подряд), либо
+{"t": секунды от начала, "update": {...}}, как пишет Recorder. update_id
+переназначаются, так что годятся и выгрузки настоящих апдейтов.
+
+Номера топиков в записи относятся к прогону, в котором она сделана: на
+новом прогоне ответы админов попадут в топики с теми же номерами, но
+не обязательно тех же пользователей. Для нагрузки это неважно.
+"""
+import asyncio
+import json
+import time
+
+
+def load(path):
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [
+        (record["t"], record["update"]) if "update" in record else (0.0, record)
+        for record in records
+    ]
+
+
+async def replay(api, tracker, records, speed=1.0):
+    """Кладёт апдейты в очередь getUpdates, сохраняя паузы (speed - ускорение)."""
+    started = time.monotonic()
+    for offset, update in records:
+        if speed > 0:
+            delay = offset / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = {key: value for key, value in update.items() if key != "update_id"}
+        tracker.classify(api.push_update(update))
@@ -0,0 +1,202 @@
+"""Замер задержек обработчиков по исходящим вызовам бота.
+
+Задержка апдейта - время от его выдачи в getUpdates до первого
+исходящего вызова Bot API, который этот апдейт породил. Связь ищется
+по содержимому: текст, подпись или file_id апдейта встречается в
+параметрах вызова (пересылка, карточка заявки), или вызов copyMessage(s)
+копирует именно это сообщение. Для команд и ответов
+самому пользователю (start, отзывы, подтверждение заявки) - по
+первому вызову в его чат.
+"""
+import json
+import time
+from collections import defaultdict
+
+MIN_NEEDLE = 4  # более короткий текст слишком легко совпасть случайно
+
+
+class Expectation:
+    __slots__ = ("kind", "update_id", "needles", "chat_id", "source", "delivered_at", "matched_at")
+
+    def __init__(self, kind, update_id, needles=(), chat_id=None, source=None):
+        self.kind = kind
+        self.update_id = update_id
+        self.needles = tuple(needles)
+        self.chat_id = chat_id
+        self.source = source  # (chat_id, message_id) исходного сообщения для copyMessage(s)
+        self.delivered_at = None
+        self.matched_at = None
+
+
+def _needles(message):
+    needles = []
+    for value in (message.get("text"), message.get("caption")):
+        if value and len(value) >= MIN_NEEDLE and not value.startswith("/"):
+            needles.append(value)
+    if message.get("photo"):
+        needles.append(message["photo"][-1]["file_id"])
+    return needles
+
+
+class Tracker:
+    def __init__(self):
+        self.expectations = []
+        self._pending = []
+        self._by_update = defaultdict(list)
+        self._awaiting_info = set()  # пользователи после /start, ещё не приславшие заявку
+        self.started_at = None
+        self.finished_at = None
+
+    # ---------- классификация ----------
+    def classify(self, update):
+        """По апдейту (dict) заводит ожидания ответа бота."""
+        message = update.get("message")
+        if not message:
+            return []
+        update_id = update["update_id"]
+        chat = message["chat"]
+        source = (chat["id"], message["message_id"])
+        text = message.get("text") or ""
+        if chat["type"] in ("group", "supergroup"):
+            if message.get("media_group_id"):
+                kind = "admin_album"
+            elif message.get("photo"):
+                kind = "admin_photo"
+            else:
+                kind = "admin_reply"
+            expectations = [Expectation(kind, update_id, _needles(message), source=source)]
+        elif text.startswith("/start"):
+            self._awaiting_info.add(chat["id"])
+            expectations = [Expectation("start", update_id, chat_id=chat["id"])]
+        elif text == "📊 Bewertungen":
+            expectations = [Expectation("reviews", update_id, chat_id=chat["id"])]
+        elif chat["id"] in self._awaiting_info:
+            self._awaiting_info.discard(chat["id"])
+            expectations = [
+                Expectation("account_info", update_id, chat_id=chat["id"]),
+                Expectation("topic_card", update_id, _needles(message)),
+            ]
+        elif message.get("media_group_id"):
+            expectations = [Expectation("user_album", update_id, _needles(message), source=source)]
+        elif message.get("photo"):
+            expectations = [Expectation("user_photo", update_id, _needles(message), source=source)]
+        else:
+            expectations = [Expectation("user_message", update_id, _needles(message), source=source)]
+        expectations = [e for e in expectations
+                        if e.needles or e.source or e.chat_id is not None]
+        self.expectations.extend(expectations)
+        self._pending.extend(expectations)
+        self._by_update[update_id].extend(expectations)
+        return expectations
+
+    # ---------- события подделки API ----------
+    def on_delivered(self, update, now):
+        if self.started_at is None:
+            self.started_at = now
+        for expectation in self._by_update.get(update["update_id"], ()):
+            expectation.delivered_at = now
+
+    def on_call(self, method, params, now):
+        if not self._pending:
+            return
+        chat_id = params.get("chat_id")
+        chat_id = int(chat_id) if chat_id and chat_id.lstrip("-").isdigit() else chat_id
+        haystack = " ".join(str(v) for v in params.values())
+        copied = _copied(method, params)
+        still_pending = []
+        for expectation in self._pending:
+            if expectation.delivered_at is None:
+                still_pending.append(expectation)
+                continue
+            if expectation.chat_id is not None:
+                hit = expectation.chat_id == chat_id
+            elif expectation.source in copied:
+                hit = True
+            else:
+                hit = any(needle in haystack for needle in expectation.needles)
+            if hit:
+                expectation.matched_at = now
+                self.finished_at = now
+            else:
+                still_pending.append(expectation)
+        self._pending = still_pending
+
+    def pending(self):
+        return len(self._pending)
+
+    async def drain(self, timeout):
+        import asyncio
+
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    # ---------- отчёт ----------
+    def summary(self, api=None):
+        by_kind = defaultdict(list)
+        lost = defaultdict(int)
+        for expectation in self.expectations:
+            if expectation.matched_at is not None and expectation.delivered_at is not None:
+                by_kind[expectation.kind].append(expectation.matched_at - expectation.delivered_at)
+            else:
+                lost[expectation.kind] += 1
+        elapsed = ((self.finished_at or 0) - (self.started_at or 0)) or None
+        matched = sum(len(v) for v in by_kind.values())
+        result = {
+            "elapsed_s": round(elapsed, 3) if elapsed else None,
+            "throughput_per_s": round(matched / elapsed, 2) if elapsed else None,
+            "handlers": {},
+        }
+        for kind in sorted(set(by_kind) | set(lost)):
+            latencies = sorted(by_kind.get(kind, ()))
+            result["handlers"][kind] = {
+                "n": len(latencies),
+                "lost": lost.get(kind, 0),
+                "p50_ms": _ms(_percentile(latencies, 50)),
+                "p95_ms": _ms(_percentile(latencies, 95)),
+                "p99_ms": _ms(_percentile(latencies, 99)),
+                "max_ms": _ms(latencies[-1] if latencies else None),
+            }
+        if api is not None:
+            result["api_calls"] = dict(sorted(api.calls.items()))
+            result["injected_429"] = api.injected_429
+        return result
+
+
+def _copied(method, params):
+    """{(from_chat_id, message_id)} исходных сообщений copyMessage/copyMessages."""
+    if method == "copyMessage":
+        ids = [params.get("message_id")]
+    elif method == "copyMessages":
+        ids = json.loads(params.get("message_ids") or "[]")
+    else:
+        return set()
+    from_chat = int(params.get("from_chat_id", 0))
+    return {(from_chat, int(message_id)) for message_id in ids if message_id is not None}
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def format_summary(summary):
+    lines = [
+        f"{'handler':<14} {'n':>6} {'lost':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    ]
+    for kind, row in summary["handlers"].items():
+        cells = [row[key] if row[key] is not None else "-" for key in
+                 ("p50_ms", "p95_ms", "p99_ms", "max_ms")]
+        lines.append(f"{kind:<14} {row['n']:>6} {row['lost']:>5} "
+                     + " ".join(f"{cell:>9}" for cell in cells))
+    lines.append(f"elapsed: {summary['elapsed_s']} s, throughput: {summary['throughput_per_s']} responses/s")
+    if "api_calls" in summary:
+        lines.append("api calls: " + json.dumps(summary["api_calls"]))
+        lines.append(f"injected 429: {summary['injected_429']}")
+    return "\n".join(lines)
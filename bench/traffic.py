@@ -0,0 +1,172 @@
+"""Генератор синтетического трафика: пользователи и админы.
+
+Каждый пользователь проходит сценарий бота: /start, заявка (текст или
+фото), затем переписка - тексты, фото и альбомы. Админ отвечает в топик
+заявки, как только в группе появилась её карточка ("User: @benchN").
+"""
+import asyncio
+import itertools
+import random
+import time
+
+ADMIN_GROUP_ID = -100999
+ADMIN_ID = 424242
+CARD_TIMEOUT = 30.0  # секунд ждём карточку заявки, потом пользователь уходит
+
+
+class Recorder:
+    """Пишет выданные апдейты в JSONL ({"t": ..., "update": ...}) для replay."""
+
+    def __init__(self, path):
+        self._file = open(path, "w", encoding="utf-8")
+        self._started = time.monotonic()
+
+    def write(self, update):
+        import json
+
+        record = {"t": round(time.monotonic() - self._started, 4), "update": update}
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class TrafficGenerator:
+    def __init__(self, api, tracker, users=10, messages=5, photo_ratio=0.2, album_ratio=0.1,
+                 album_size=3, admin_replies=2, think_time=0.2, user_id_base=5_000_000,
+                 admin_id=ADMIN_ID, admin_group_id=ADMIN_GROUP_ID, recorder=None, seed=None):
+        self.api = api
+        self.tracker = tracker
+        self.users = users
+        self.messages = messages
+        self.photo_ratio = photo_ratio
+        self.album_ratio = album_ratio
+        self.album_size = album_size
+        self.admin_replies = admin_replies
+        self.think_time = think_time
+        self.user_id_base = user_id_base
+        self.admin_id = admin_id
+        self.admin_group_id = admin_group_id
+        self.recorder = recorder
+        self.random = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self._media_groups = itertools.count(1)
+        self._threads = {}  # username -> message_thread_id карточки
+        self._cards = {}    # username -> asyncio.Event
+        api.listeners.append(self._on_call)
+
+    # ---------- карточки заявок в группе админов ----------
+    def _on_call(self, method, params, now):
+        if method not in ("sendMessage", "sendPhoto", "sendMediaGroup"):
+            return
+        if str(params.get("chat_id")) != str(self.admin_group_id):
+            return
+        thread_id = params.get("message_thread_id")
+        blob = " ".join(params.values())
+        if "New info" not in blob or not thread_id:
+            return
+        for username, event in self._cards.items():
+            # В sendMediaGroup подпись лежит внутри JSON, перевод строки экранирован
+            marks = (f"User: @{username}\n", f"User: @{username}\\n")
+            if not event.is_set() and any(mark in blob for mark in marks):
+                self._threads[username] = int(thread_id)
+                event.set()
+
+    # ---------- апдейты ----------
+    def push(self, message):
+        update = self.api.push_update({"message": message})
+        self.tracker.classify(update)
+        if self.recorder is not None:
+            self.recorder.write(update)
+        return update
+
+    def _user(self, n):
+        user_id = self.user_id_base + n
+        return {"id": user_id, "is_bot": False, "first_name": f"Bench{n}", "username": f"bench{n}"}
+
+    def _private(self, user, **content):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user["id"], "type": "private", "first_name": user["first_name"],
+                     "username": user["username"]},
+            "from": user,
+        }
+        message.update(content)
+        return message
+
+    def _admin(self, thread_id, **content):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.admin_group_id, "type": "supergroup", "title": "Bench admins",
+                     "is_forum": True},
+            "from": {"id": self.admin_id, "is_bot": False, "first_name": "Admin"},
+            "message_thread_id": thread_id,
+            "is_topic_message": True,
+        }
+        message.update(content)
+        return message
+
+    def _photo(self, tag):
+        return [
+            {"file_id": f"{tag}-s", "file_unique_id": f"{tag}-us", "width": 90, "height": 90},
+            {"file_id": f"{tag}-l", "file_unique_id": f"{tag}-ul", "width": 1280, "height": 720},
+        ]
+
+    def _content(self, tag, text):
+        """Текст, фото или альбом (список сообщений) - по заданным долям."""
+        roll = self.random.random()
+        if roll < self.album_ratio:
+            media_group_id = f"mg{next(self._media_groups)}"
+            return [
+                {"photo": self._photo(f"{tag}-a{i}"), "media_group_id": media_group_id,
+                 **({"caption": text} if i == 0 else {})}
+                for i in range(self.album_size)
+            ]
+        if roll < self.album_ratio + self.photo_ratio:
+            return [{"photo": self._photo(tag), "caption": text}]
+        return [{"text": text}]
+
+    async def _think(self):
+        if self.think_time:
+            await asyncio.sleep(self.random.expovariate(1 / self.think_time))
+
+    # ---------- сценарии ----------
+    async def _session(self, n):
+        user = self._user(n)
+        username = user["username"]
+        self._cards[username] = asyncio.Event()
+        self.push(self._private(user, text="/start",
+                                entities=[{"type": "bot_command", "offset": 0, "length": 6}]))
+        await self._think()
+        info = f"Skins: {self.random.randint(1, 400)}, OG: nein [{username}]"
+        if self.random.random() < self.photo_ratio:
+            self.push(self._private(user, photo=self._photo(f"{username}-info"), caption=info))
+        else:
+            self.push(self._private(user, text=info))
+        try:
+            await asyncio.wait_for(self._cards[username].wait(), CARD_TIMEOUT)
+        except asyncio.TimeoutError:
+            return
+        thread_id = self._threads[username]
+        admin = asyncio.create_task(self._admin_session(username, thread_id))
+        for i in range(self.messages):
+            await self._think()
+            for content in self._content(f"{username}-m{i}", f"Nachricht {i} von {username}"):
+                self.push(self._private(user, **content))
+        await admin
+
+    async def _admin_session(self, username, thread_id):
+        for i in range(self.admin_replies):
+            await self._think()
+            for content in self._content(f"{username}-r{i}", f"Antwort {i} an {username}"):
+                self.push(self._admin(thread_id, **content))
+
+    async def run(self, ramp_up=1.0):
+        """Запускает сессии всех пользователей, равномерно за ramp_up секунд."""
+        async def delayed(n):
+            await asyncio.sleep(ramp_up * n / max(1, self.users))
+            await self._session(n)
+
+        await asyncio.gather(*(delayed(n) for n in range(self.users)))
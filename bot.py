@@ -1,302 +1,411 @@
-from telegram import Update, InputMediaPhoto, ReplyKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, ReplyKeyboardMarkup
 from telegram.ext import (
     Application,
+    CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     filters,
-    ConversationHandler
+    ConversationHandler,
+    TypeHandler
 )
-import sqlite3
 import os
+import argparse
 import configparser
 import logging
 import asyncio
+import datetime
+import math
+
+from admins import AdminSet, insert_admin
+from archive import ARCHIVE_AFTER_DAYS, ARCHIVE_DIR, Retention, format_transcript
+from balancer import make_balancer, parse_groups, parse_languages
+from cluster import (INDEX_ENV, INGRESS_SOCKET, KEY_ENV, ROLE_ENV, RUN_DIR, RUN_DIR_ENV, WORKER, WRITER_SOCKET,
+                     Cluster, WorkerLink, poll_updates, run_ingress, set_webhook)
+from content import ContentStore
+from export import FORMATS, MAX_DOCUMENT_SIZE, Exporter, archived_rows
+from guard import (ACCEPTED, DUPLICATE, GLOBAL_LIMITED, GLOBAL_SUBMISSION_BURST, GLOBAL_SUBMISSION_RATE,
+                   REVIEW_BURST, REVIEW_RATE, IntakeGuard, submission_fingerprint)
+from logs import LOG_BACKUPS, LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_HOURS, setup_logging
+from lifecycle import CLOSED, IDLE_TIMEOUT_DAYS, IN_PROGRESS, STATUSES, Lifecycle, touch_accounts
+from media import Album, Attachment, MediaGroupAggregator, message_attachment, photo_attachment
+from metrics import Metrics, MetricsServer, instrument_handlers
+from outbound import GROUP_BURST, GROUP_RATE, LANE_ADMIN, LANE_ALBUM, LANE_REVIEWS, OVERALL_RATE, OutboundScheduler
+from outbox import Outbox, message_key, outbox_entry
+from persistence import SQLitePersistence
+from relay import KIND_ALBUM, KIND_COPY, KIND_TEXT, deliver
+from router import ADMIN, ALBUM, MEDIA, PRIVATE, TEXT, TOPIC, USER, UpdateRouter
+from routing import MISS, WORKER_ROUTE_TTL, Route, RoutingCache
+from schema import migrate_accounts, migrate_admins, migrate_state
+from search import PAGE_SIZE, SearchSessions, build_match, format_results, search_page
+from sequencer import MAX_IN_FLIGHT, SequencedApplication
+from storage import Database, RemoteDatabase, TranscriptWriter, insert_account
+from topics import TOPIC_POOL_SIZE, IntakeQueue, TopicPool, assign_topic, mark_card_sent
+from webhook import WEBHOOK_QUEUE_SIZE, WebhookServer, run_webhook
 
-# Настройка логирования
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", 
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 # Константы состояний
 ACCOUNT_INFO = 0
 ADMIN_DB_FILE = "admins.db"
-SQLITE_TIMEOUT = 10
-MEDIA_GROUP_DELAY = 1.0  # Задержка для сбора медиагруппы
+ACCOUNTS_DB_FILE = "accounts.db"
+STATE_DB_FILE = "state.db"
 
-# Константы состояний
-ACCOUNT_INFO = 0
-ADMIN_DB_FILE = "admins.db"
-SQLITE_TIMEOUT = 10  # секунд для ожидания разблокировки БД
+CONFIG_FILE = "config.ini"
 
-# Константы отзывов
-REVIEW_PHOTOS = [
-    "AgACAgIAAxkBAAICO2hs9wABZdRD-__U8VkQ4-sGQatUMQACKvcxG2gAAWlLHUTK0lkjfD0BAAMCAAN5AAM2BA",
-    "AgACAgIAAxkBAAICPWhs9wVRoEb4YYMCnB3WAUFnKjLPAAIs9zEbaAABaUvP67RaQkhiJgEAAwIAA3kAAzYE"
-]
+# Клавиатура отзывов; фото и тексты - в content (config.ini, перечитывается на ходу)
 REVIEW_KEYBOARD = [["📊 Bewertungen"]]
 REVIEW_MARKUP = ReplyKeyboardMarkup(REVIEW_KEYBOARD, resize_keyboard=True, one_time_keyboard=False)
 
 # Чтение конфигурации
 config = configparser.ConfigParser()
-config.read('config.ini')
+config.read(CONFIG_FILE)
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN") or config.get('BOT', 'TOKEN', fallback=None)
 FIRST_ADMIN_ID = os.getenv("FIRST_ADMIN_ID") or config.get('BOT', 'FIRST_ADMIN_ID', fallback=None)
 ADMIN_GROUP_ID = os.getenv("ADMIN_GROUP_ID") or config.get('BOT', 'ADMIN_GROUP_ID', fallback=None)
+# Несколько групп админов через запятую; без списка - одна ADMIN_GROUP_ID
+ADMIN_GROUP_IDS = parse_groups(os.getenv("ADMIN_GROUP_IDS") or config.get('BOT', 'ADMIN_GROUP_IDS', fallback=None) or ADMIN_GROUP_ID)
+# Как распределять новые заявки по группам: least_open, round_robin или language
+BALANCER = os.getenv("BALANCER") or config.get('BOT', 'BALANCER', fallback='least_open')
+# Для BALANCER=language: 'de:-100..., en:-100...'
+LANGUAGE_GROUPS = parse_languages(os.getenv("LANGUAGE_GROUPS") or config.get('BOT', 'LANGUAGE_GROUPS', fallback=None))
+# Сколько апдейтов разных диалогов обрабатывается одновременно
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES") or config.get('BOT', 'MAX_CONCURRENT_UPDATES', fallback=MAX_IN_FLIGHT))
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+UPDATE_MODE = (os.getenv("UPDATE_MODE") or config.get('BOT', 'MODE', fallback='polling')).lower()
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN") or config.get('WEBHOOK', 'LISTEN', fallback='127.0.0.1')
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or config.get('WEBHOOK', 'PORT', fallback=8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or config.get('WEBHOOK', 'PATH', fallback='/telegram')
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or config.get('WEBHOOK', 'URL', fallback=None)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or config.get('WEBHOOK', 'SECRET', fallback=None)
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE") or config.get('WEBHOOK', 'QUEUE_SIZE', fallback=WEBHOOK_QUEUE_SIZE))
+# Сколько свободных топиков держать наготове (0 - создавать по требованию)
+TOPIC_POOL_SIZE = int(os.getenv("TOPIC_POOL_SIZE") or config.get('BOT', 'TOPIC_POOL_SIZE', fallback=TOPIC_POOL_SIZE))
+# Другой адрес Bot API (локальный bot-api сервер или подделка из bench)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL") or config.get('BOT', 'API_BASE_URL', fallback=None)
+# Prometheus-метрики на отдельном порту (0 - не поднимать)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN") or config.get('METRICS', 'LISTEN', fallback='127.0.0.1')
+METRICS_PORT = int(os.getenv("METRICS_PORT") or config.get('METRICS', 'PORT', fallback=0))
+# Через сколько дней без сообщений диалог закрывается (0 - не закрывать)
+IDLE_DAYS = int(os.getenv("IDLE_DAYS") or config.get('LIFECYCLE', 'IDLE_DAYS', fallback=IDLE_TIMEOUT_DAYS))
+# Закрытые дольше стольких дней заявки уходят в сжатый архив (0 - не архивировать)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS") or config.get('RETENTION', 'ARCHIVE_AFTER_DAYS', fallback=ARCHIVE_AFTER_DAYS))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR") or config.get('RETENTION', 'DIR', fallback=ARCHIVE_DIR)
+# Логи: файл с ротацией (пустой LOG_FILE - только stderr), формат json или text
+LOG_LEVEL = (os.getenv("LOG_LEVEL") or config.get('LOGGING', 'LEVEL', fallback='INFO')).upper()
+LOG_FILE = os.getenv("LOG_FILE", config.get('LOGGING', 'FILE', fallback=LOG_FILE))
+LOG_FORMAT = (os.getenv("LOG_FORMAT") or config.get('LOGGING', 'FORMAT', fallback='json')).lower()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES") or config.get('LOGGING', 'MAX_BYTES', fallback=LOG_MAX_BYTES))
+LOG_ROTATE_HOURS = float(os.getenv("LOG_ROTATE_HOURS") or config.get('LOGGING', 'ROTATE_HOURS', fallback=LOG_ROTATE_HOURS))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS") or config.get('LOGGING', 'BACKUPS', fallback=LOG_BACKUPS))
+# Процессов-воркеров (cluster.py): ingress раздаёт им апдейты по топикам и пользователям; 1 - всё в одном процессе
+WORKER_PROCESSES = max(1, int(os.getenv("WORKER_PROCESSES") or config.get('BOT', 'PROCESSES', fallback=1)))
+# Каталог unix-сокетов кластера
+CLUSTER_RUN_DIR = os.getenv(RUN_DIR_ENV) or config.get('BOT', 'RUN_DIR', fallback=RUN_DIR)
+# Роль и номер задаёт ingress, запуская воркер
+IS_WORKER = os.getenv(ROLE_ENV) == WORKER
+IS_INGRESS = WORKER_PROCESSES > 1 and not IS_WORKER
+WORKER_INDEX = int(os.getenv(INDEX_ENV) or 0)
+# Одиночные фоновые задачи (простой, архив) - в воркере 0
+PRIMARY = WORKER_INDEX == 0
+if IS_WORKER and METRICS_PORT:
+    METRICS_PORT += WORKER_INDEX
+
+# Настройка логирования: запись в файл и stderr - в отдельном потоке
+setup_logging(
+    level=LOG_LEVEL,
+    log_file=LOG_FILE,
+    fmt=LOG_FORMAT,
+    max_bytes=LOG_MAX_BYTES,
+    rotate_hours=LOG_ROTATE_HOURS,
+    backups=LOG_BACKUPS,
+)
+
+# Задержки обработчиков, SQLite и Bot API; /metrics и /stats
+metrics = Metrics()
+metrics_server = MetricsServer(metrics, METRICS_LISTEN, METRICS_PORT) if METRICS_PORT and not IS_INGRESS else None
+
+def open_database(path):
+    # В воркере кластера записи выполняет общий сервис записи, читает воркер сам
+    if IS_WORKER:
+        return RemoteDatabase(path, os.path.join(CLUSTER_RUN_DIR, WRITER_SOCKET),
+                              bytes.fromhex(os.environ[KEY_ENV]), metrics=metrics)
+    return Database(path, metrics=metrics)
+
+# Долгоживущие соединения: запись в отдельном потоке, чтение из пула
+accounts_db = open_database(ACCOUNTS_DB_FILE)
+admins_db = open_database(ADMIN_DB_FILE)
+state_db = open_database(STATE_DB_FILE)
+# Разговоры, user_data/chat_data и недособранные альбомы переживают рестарт
+persistence = SQLitePersistence(state_db, shard=WORKER_INDEX, shards=WORKER_PROCESSES)
+# Пересылки доставляются в фоне из таблицы outbox, с повторами и после рестарта
+outbox = Outbox(accounts_db, deliver, shard=WORKER_INDEX, shards=WORKER_PROCESSES)
+# Переписка пишется пачками в фоне, обработчики не ждут commit;
+# в той же транзакции отмечается активность диалога и ставятся пересылки
+transcript = TranscriptWriter(accounts_db, on_batch=touch_accounts, on_commit=outbox.wake, shard=WORKER_INDEX)
+# Админы держатся в памяти, is_admin не ходит в БД
+admin_set = AdminSet(admins_db)
+# topic -> запрос и user -> открытый диалог без похода в БД; в кластере
+# привязку меняют и другие воркеры - записи живут несколько секунд
+routes = RoutingCache(ttl=WORKER_ROUTE_TTL if IS_WORKER else None)
+# Статусы заявок, закрытие топиков и диалогов по простою
+lifecycle = Lifecycle(accounts_db, routes, idle_days=IDLE_DAYS)
+# Давно закрытые заявки - в архив по месяцам, горячая база не растёт
+retention = Retention(accounts_db, routes, directory=ARCHIVE_DIR, archive_after_days=ARCHIVE_AFTER_DAYS)
+# /export: выгрузка страницами во временный файл
+exporter = Exporter(accounts_db)
+# Запросы /search для кнопки «дальше»
+search_sessions = SearchSessions()
 
-if not BOT_TOKEN:
-    logger.error("BOT_TOKEN не задан! Укажите TELEGRAM_BOT_TOKEN или в config.ini.")
-    exit(1)
+# Что из config.ini применяется на ходу; остальное - только после рестарта
+LIVE_SECTIONS = {"TEXTS", "REVIEWS"}
+LIVE_SETTINGS = {("LOGGING", "level"), ("BOT", "first_admin_id")}
 
-# Функция для подключения к БД с тайм-аутом
-def get_conn(db_file):
-    return sqlite3.connect(db_file, timeout=SQLITE_TIMEOUT)
+def _restart_settings(cfg):
+    return {
+        (section, key): value
+        for section in cfg.sections() if section not in LIVE_SECTIONS
+        for key, value in cfg.items(section, raw=True) if (section, key) not in LIVE_SETTINGS
+    }
+
+started_settings = _restart_settings(config)
+
+async def apply_config(new_config):
+    """Вызывается после каждого перечитывания config.ini."""
+    level = os.getenv("LOG_LEVEL") or new_config.get('LOGGING', 'LEVEL', fallback='INFO')
+    logging.getLogger().setLevel(level.upper())
+    first_admin = os.getenv("FIRST_ADMIN_ID") or new_config.get('BOT', 'FIRST_ADMIN_ID', fallback=None)
+    if first_admin and int(first_admin) not in admin_set:
+        await admin_set.add(int(first_admin))
+    settings = _restart_settings(new_config)
+    changed = sorted(f"{section}.{key}" for section, key in started_settings.keys() | settings.keys()
+                     if started_settings.get((section, key)) != settings.get((section, key)))
+    if changed:
+        logger.warning(f"Изменения {', '.join(changed)} вступят в силу после рестарта")
+
+# Тексты и фото отзывов; правки config.ini подхватываются без рестарта
+content = ContentStore(CONFIG_FILE, on_config=apply_config)
+content.load()
 
 # Инициализация БД
 def init_accounts_db():
-    conn = get_conn('accounts.db')
-    conn.execute('PRAGMA journal_mode=WAL;')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS accounts (
-                 id INTEGER PRIMARY KEY, 
-                 user_id INTEGER, 
-                 username TEXT,
-                 account_info TEXT, 
-                 status TEXT DEFAULT 'new',
-                 admin_chat_id INTEGER,
-                 topic_id INTEGER,
-                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS messages (
-                 id INTEGER PRIMARY KEY, 
-                 account_id INTEGER,
-                 from_admin BOOLEAN, 
-                 message_text TEXT,
-                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
+    accounts_db.start()
+    accounts_db.submit_write(migrate_accounts).result()
+
+def init_state_db():
+    state_db.start()
+    state_db.submit_write(migrate_state).result()
 
 def init_admins_db():
-    conn = get_conn(ADMIN_DB_FILE)
-    conn.execute('PRAGMA journal_mode=WAL;')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS admins (
-                 id INTEGER PRIMARY KEY, 
-                 chat_id INTEGER UNIQUE)''')
-    conn.commit()
-    conn.close()
+    admins_db.start()
+    admins_db.submit_write(migrate_admins).result()
     if FIRST_ADMIN_ID:
         try:
-            add_admin(int(FIRST_ADMIN_ID))
+            admins_db.submit_write(insert_admin, int(FIRST_ADMIN_ID)).result()
         except Exception as e:
             logger.error(f"Не удалось добавить FIRST_ADMIN_ID: {e}")
+    admin_set.load()
+
+async def add_admin(chat_id):
+    await admin_set.add(chat_id)
 
-def add_admin(chat_id):
-    conn = get_conn(ADMIN_DB_FILE)
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO admins (chat_id) VALUES (?)", (chat_id,))
-    conn.commit()
-    conn.close()
+async def remove_admin(chat_id):
+    return await admin_set.remove(chat_id)
 
 def is_admin(chat_id):
-    try:
-        conn = get_conn(ADMIN_DB_FILE)
-        c = conn.cursor()
-        c.execute("SELECT 1 FROM admins WHERE chat_id = ?", (chat_id,))
-        exists = c.fetchone() is not None
-        return exists
-    except Exception as e:
-        logger.error(f"Ошибка проверки админа: {e}")
-        return False
-    finally:
-        if conn:
-            conn.close()
+    return chat_id in admin_set
 
-def save_account(user_id, username, info):
+async def save_account(user_id, username, info, attachments=(), language=None):
     try:
-        conn = get_conn('accounts.db')
-        c = conn.cursor()
-        c.execute("INSERT INTO accounts (user_id, username, account_info) VALUES (?, ?, ?)",
-                (user_id, username, info))
-        conn.commit()
-        account_id = c.lastrowid
-        return account_id
+        return await accounts_db.write(insert_account, user_id, username, info, attachments, language,
+                                       WORKER_INDEX)
     except Exception as e:
         logger.error(f"Ошибка сохранения аккаунта: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
-def save_message(account_id, from_admin, text):
-    try:
-        conn = get_conn('accounts.db')
-        c = conn.cursor()
-        c.execute("INSERT INTO messages (account_id, from_admin, message_text) VALUES (?, ?, ?)",
-                (account_id, int(from_admin), text))
-        conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка сохранения сообщения: {e}")
-    finally:
-        if conn:
-            conn.close()
+def save_message(account_id, from_admin, text, attachments=(), delivery=None):
+    """delivery - запись outbox_entry(...): пересылка уйдёт после commit строки"""
+    transcript.enqueue(account_id, from_admin, text, attachments, delivery)
+
+def save_messages(rows):
+    """rows: (account_id, from_admin, text[, attachments[, delivery]]) - попадут в одну транзакцию"""
+    transcript.enqueue_many(rows)
 
-def get_account_by_topic(topic_id):
+def _select_attachments(conn, account_id, message_id):
+    return [Attachment(*row) for row in conn.execute(
+        "SELECT media_type, file_id, file_unique_id, position, caption FROM attachments "
+        "WHERE account_id = ? AND message_id IS ? ORDER BY position",
+        (account_id, message_id))]
+
+async def get_attachments(account_id, message_id=None):
+    """Вложения заявки (message_id=None) или сообщения переписки"""
+    return await accounts_db.read(_select_attachments, account_id, message_id)
+
+async def find_attachments(file_unique_id):
+    """(account_id, message_id) всех вложений с этим файлом"""
+    return await accounts_db.fetchall(
+        "SELECT account_id, message_id FROM attachments WHERE file_unique_id = ?",
+        (file_unique_id,))
+
+async def get_account_by_topic(chat_id, topic_id):
+    route = routes.by_topic(chat_id, topic_id)
+    if route is not MISS:
+        return route
     try:
-        conn = get_conn('accounts.db')
-        c = conn.cursor()
-        c.execute("SELECT * FROM accounts WHERE topic_id = ?", (topic_id,))
-        return c.fetchone()
+        generation = routes.generation
+        # Номер топика уникален только внутри группы (idx_accounts_topic)
+        row = await accounts_db.fetchone(
+            "SELECT id, user_id, admin_chat_id, topic_id FROM accounts "
+            "WHERE admin_chat_id = ? AND topic_id = ?",
+            (chat_id, topic_id))
+        route = Route(*row) if row else None
+        routes.store_topic(chat_id, topic_id, route, generation)
+        return route
     except Exception as e:
         logger.error(f"Ошибка поиска аккаунта по топику: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
-def get_active_account(user_id):
+async def get_active_account(user_id):
+    route = routes.by_user(user_id)
+    if route is not MISS:
+        return route
     try:
-        conn = get_conn('accounts.db')
-        c = conn.cursor()
-        c.execute("SELECT id, admin_chat_id, topic_id FROM accounts WHERE user_id = ? AND admin_chat_id IS NOT NULL", (user_id,))
-        return c.fetchone()
+        generation = routes.generation
+        # Последний по времени открытый диалог пользователя (idx_accounts_open_by_user)
+        row = await accounts_db.fetchone(
+            "SELECT id, user_id, admin_chat_id, topic_id FROM accounts "
+            "WHERE user_id = ? AND admin_chat_id IS NOT NULL AND status <> 'closed' "
+            "ORDER BY id DESC LIMIT 1",
+            (user_id,))
+        route = Route(*row) if row else None
+        routes.store_user(user_id, route, generation)
+        return route
     except Exception as e:
         logger.error(f"Ошибка получения активного аккаунта: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
-# Добавим новую функцию для обработки альбомов
-async def account_album(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        u = update.message.from_user
-        user_info = f"@{u.username}" if u.username else f"{u.first_name} {u.last_name or ''}"
-        
-        # Получаем все фото из альбома
-        photos = [photo.file_id for photo in update.message.photo]
-        caption = update.message.caption or ""
-        
-        # Сохраняем в формате ALBUM:[file_id1,file_id2,...]:caption
-        album_data = f"ALBUM:{','.join(photos)}:{caption}"
-        account_id = save_account(u.id, user_info, album_data)
-        
-        if not account_id:
-            await update.message.reply_text("❌ Fehler bei der Bearbeitung der Anfrage. Versuchen Sie es später noch einmal.")
-            return ConversationHandler.END
-        
-        await update.message.reply_text("✅ Ich danke Dir! Bitte warte auf die Antwort des Administrators.")
-        
-        # Создаем топик
-        topic_id = await create_support_topic(
-            context,
-            account_id,
-            user_info,
-            album_data
-        )
-        
-        if not topic_id:
-            logger.error(f"Не удалось создать топик для запроса #{account_id}")
-        
-        return ConversationHandler.END
-    except Exception as e:
-        logger.error(f"Ошибка в account_album: {e}")
-        await update.message.reply_text("❌ Произошла ошибка при обработке вашего альбома")
-        return ConversationHandler.END
+def _account_topic(conn, account_id):
+    return conn.execute("SELECT admin_chat_id, topic_id, card_sent FROM accounts WHERE id = ?",
+                        (account_id,)).fetchone()
 
-# Функция для создания топика
-async def create_support_topic(context, account_id, user_info, account_info):
-    if not ADMIN_GROUP_ID:
+# Функция для создания топика (выполняется в фоне через intake, исключения - повтор)
+async def create_support_topic(bot, account_id, user_info, account_info, language=None):
+    if not ADMIN_GROUP_IDS:
         logger.error("ADMIN_GROUP_ID не задан! Не могу создать топик.")
         return None
     
-    try:
-        # Создаем новый топик в группе
+    # Повторная попытка: топик мог быть уже назначен, не плодим новый
+    row = await accounts_db.read(_account_topic, account_id)
+    if row and row[2]:
+        return row[1]  # и карточка уже отправлена
+    admin_chat, topic_id = row[:2] if row and row[1] else (None, None)
+    if not topic_id:
+        # Группу выбирает балансировщик; топик - из её запаса или новый
+        admin_chat = await balancer.choose(language)
         topic_name = f"Request #{account_id}: {user_info[:20]}"
-        topic = await context.bot.create_forum_topic(
-            chat_id=ADMIN_GROUP_ID,
-            name=topic_name
+        topic_id = await topic_pools[admin_chat].acquire(topic_name)
+        
+        # Сохраняем группу и ID топика в базу
+        row = await accounts_db.write(assign_topic, account_id, admin_chat, topic_id)
+        if row:
+            routes.assign(Route(*row))
+    
+    # Формируем сообщение в зависимости от типа контента
+    attachments = await get_attachments(account_id)
+    if attachments:
+        photo_caption = (
+            f"⚠️ New info #{account_id}\n"
+            f"👤 User: {user_info}\n"
         )
         
-        # Сохраняем ID топика в базу
-        conn = get_conn('accounts.db')
-        c = conn.cursor()
-        c.execute("UPDATE accounts SET admin_chat_id = ?, topic_id = ? WHERE id = ?", 
-                (ADMIN_GROUP_ID, topic.message_thread_id, account_id))
-        conn.commit()
-        conn.close()
+        if account_info:
+            photo_caption += f"📝 Info: {account_info}"
         
-        # Формируем сообщение в зависимости от типа контента
-        if account_info.startswith("PHOTO:"):
-            parts = account_info.split(':', 2)
-            file_id = parts[1]
-            caption = parts[2] if len(parts) > 2 else ""
-            
-            photo_caption = (
-                f"⚠️ New info #{account_id}\n"
-                f"👤 User: {user_info}\n"
-            )
-            
-            if caption:
-                photo_caption += f"📝 Info: {caption}"
-            
-            await context.bot.send_photo(
-                chat_id=ADMIN_GROUP_ID,
-                photo=file_id,
+        if len(attachments) == 1:
+            await bot.send_photo(
+                chat_id=admin_chat,
+                photo=attachments[0].file_id,
                 caption=photo_caption,
-                message_thread_id=topic.message_thread_id
+                message_thread_id=topic_id
             )
         else:
-            # Текстовое сообщение
-            message_text = (
-                f"⚠️ New info #{account_id}\n"
-                f"👤 User: {user_info}\n"
-                f"📝 Info:\n{account_info}"
-            )
-            await context.bot.send_message(
-                chat_id=ADMIN_GROUP_ID,
-                text=message_text,
-                message_thread_id=topic.message_thread_id
+            await bot.send_media_group(
+                chat_id=admin_chat,
+                media=[
+                    InputMediaPhoto(media=a.file_id, caption=photo_caption if i == 0 else None)
+                    for i, a in enumerate(attachments)
+                ],
+                message_thread_id=topic_id
             )
-        
-        return topic.message_thread_id
-        
-    except Exception as e:
-        logger.error(f"Ошибка при создании топика: {e}")
-        return None
+    else:
+        # Текстовое сообщение
+        message_text = (
+            f"⚠️ New info #{account_id}\n"
+            f"👤 User: {user_info}\n"
+            f"📝 Info:\n{account_info}"
+        )
+        await bot.send_message(
+            chat_id=admin_chat,
+            text=message_text,
+            message_thread_id=topic_id
+        )
+    
+    # Без отметки заявка поднимется при следующем старте
+    await accounts_db.write(mark_card_sent, account_id)
+    return topic_id
+
+async def process_intake(bot, job):
+    await create_support_topic(bot, job.account_id, job.user_info, job.account_info, job.language)
+
+# Топики и карточки заявок создаются в фоне, пользователь не ждёт Bot API;
+# в кластере запас делится между воркерами, у каждого свои строки topic_pool
+topic_pools = {
+    admin_chat: TopicPool(accounts_db, admin_chat, size=math.ceil(TOPIC_POOL_SIZE / WORKER_PROCESSES),
+                          shard=WORKER_INDEX, shards=WORKER_PROCESSES)
+    for admin_chat in ADMIN_GROUP_IDS
+}
+# Группа для новой заявки; дальше заявка живёт в ней (accounts.admin_chat_id)
+balancer = make_balancer(BALANCER, accounts_db, ADMIN_GROUP_IDS, LANGUAGE_GROUPS)
+# Заявки без карточки после рестарта поднимает воркер, который их принял
+intake = IntakeQueue(accounts_db, process_intake, shard=WORKER_INDEX, shards=WORKER_PROCESSES)
+# Лимиты на флуд, новые заявки и галерею отзывов; повторы заявок отсеиваются.
+# Пользователь всегда в одном воркере, общие на всех лимиты делятся на воркеры
+guard = IntakeGuard(
+    is_admin,
+    global_submission_rate=GLOBAL_SUBMISSION_RATE / WORKER_PROCESSES,
+    global_submission_burst=max(1, GLOBAL_SUBMISSION_BURST // WORKER_PROCESSES),
+    review_rate=REVIEW_RATE / WORKER_PROCESSES,
+    review_burst=max(1, REVIEW_BURST // WORKER_PROCESSES),
+)
 
 # ================== ОБРАБОТЧИКИ ==================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        await update.message.reply_text(
-            "Grind-Games ist die führende deutsche Seite für den An- und Verkauf von Fortnite Accounts. "
-            "Unser Ziel ist es, jedem User ein faires Angebot für seinen Fortnite Account zukommen zu lassen "
-            "und damit die Möglichkeit zu geben, aus einem alten Fortnite Account noch Geld machen zu können - "
-            "während man gleichzeitig einem künftigen Käufer eine Freude bereiten kann!\n\n"
-            "Wir antworten auf alle Account Anfragen in der Regel innerhalb von wenigen Stunden.\n\n"
-            "Sobald wir uns auf einen Preis geeinigt haben, bereiten wir die Überweisung auf dein Bankkonto direkt vor. "
-            "Es ist durchaus möglich, dass das Geld bereits nach wenigen Stunden bei dir ist und wir geben unser Bestes, "
-            "um dafür zu sorgen, dass alle Auszahlungen an unsere Verkäufer schnellstmöglich ausgeführt werden."
-        )
+        texts = content.current.texts
+        await update.message.reply_text(texts["start_intro"])
 
         await asyncio.sleep(1.5)
 
-        await update.message.reply_text(
-            "👋 Hallo. Schick uns bitte Deine Angaben in diesem Format:\n"
-            "📜 Anzahl der Skins:\n"
-            "💎 OG oder seltene Skins:\n"
-            "📸 Fotos von Deinem Konto\n\n"
-            "Du kannst auch die automatische Verifizierungsmethode verwenden und dein Konto " \
-            "durch den Skin Checker überprüfen lassen und uns die Fotos zukommen lassen, " \
-            "die du vom Bot in Telegram in nur wenigen Sekunden erhältst.\n@BombSkinCheckerBot",
-            reply_markup=REVIEW_MARKUP
-        )
+        await update.message.reply_text(texts["start_format"], reply_markup=REVIEW_MARKUP)
         return ACCOUNT_INFO
     except Exception as e:
         logger.error(f"Ошибка в start: {e}")
         return ConversationHandler.END
 
+async def _refuse_submission(update: Update, user_id, fingerprint):
+    """Отвечает пользователю и возвращает True, если заявку создавать не нужно."""
+    verdict, account_id = guard.admit_submission(user_id, fingerprint)
+    if verdict == ACCEPTED:
+        return False
+    if verdict == DUPLICATE:
+        text = f"✅ Ihre Anfrage #{account_id} ist bereits eingegangen. Bitte warten Sie auf die Antwort des Administrators."
+    elif verdict == GLOBAL_LIMITED:
+        text = "⏳ Gerade gehen sehr viele Anfragen ein. Bitte versuchen Sie es in ein paar Minuten noch einmal."
+    else:
+        text = "⏳ Sie haben bereits mehrere Anfragen gesendet. Bitte warten Sie auf die Antwort des Administrators."
+    await update.message.reply_text(text, reply_markup=REVIEW_MARKUP)
+    return True
+
 async def account_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         if update.message.text == "📊 Bewertungen":
@@ -307,31 +416,28 @@ async def account_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Обрабатываем текст или фото
         if update.message.photo:
-            # Для фото всегда сохраняем в формате "PHOTO:file_id:caption"
-            file_id = update.message.photo[-1].file_id
-            caption = update.message.caption or ""
-            text = f"PHOTO:{file_id}:{caption}"
+            # Фото - отдельной строкой в attachments, в account_info только подпись
+            attachments = [photo_attachment(update.message)]
+            text = update.message.caption or ""
         else:
+            attachments = []
             text = update.message.text
 
-        account_id = save_account(u.id, user_info, text)
+        # Повтор той же заявки или превышение лимита - без новой строки и топика
+        fingerprint = submission_fingerprint(text, attachments)
+        if await _refuse_submission(update, u.id, fingerprint):
+            return ConversationHandler.END
+        account_id = await save_account(u.id, user_info, text, attachments, u.language_code)
         
         if not account_id:
             await update.message.reply_text("❌ Fehler bei der Bearbeitung der Anfrage. Versuchen Sie es später noch einmal.")
             return ConversationHandler.END
+        guard.remember_submission(u.id, fingerprint, account_id)
         
         await update.message.reply_text("✅ Ich danke Ihnen! Bitte warten Sie auf die Antwort des Administrators.", reply_markup=REVIEW_MARKUP)
         
-        # Создаем топик
-        topic_id = await create_support_topic(
-            context,
-            account_id,
-            user_info,
-            text
-        )
-        
-        if not topic_id:
-            logger.error(f"Не удалось создать топик для запроса #{account_id}")
+        # Топик и карточка - в фоне
+        intake.submit(account_id, user_info, text, u.language_code)
         
         return ConversationHandler.END
     except Exception as e:
@@ -353,7 +459,7 @@ async def add_admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         try:
             new_admin = int(context.args[0])
-            add_admin(new_admin)
+            await add_admin(new_admin)
             await update.message.reply_text(f"✅ {new_admin} добавлен админом")
             await context.bot.send_message(chat_id=new_admin, text="🎉 Вы админ бота.")
         except:
@@ -361,362 +467,412 @@ async def add_admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Ошибка в add_admin_cmd: {e}")
 
-async def admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def remove_admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        # Проверяем, что сообщение в топике группы админов
-        if not update.message.message_thread_id:
+        uid = update.message.from_user.id
+        if not is_admin(uid):
+            await update.message.reply_text("❌ Kein Zugang")
             return
         
-        # Ищем аккаунт по ID топика
-        acc = get_account_by_topic(update.message.message_thread_id)
-        if not acc:
+        if not context.args:
+            await update.message.reply_text("Использование: /deladmin <user_id>")
             return
         
-        # Проверяем права админа
-        if not is_admin(update.message.from_user.id):
-            await update.message.reply_text("❌ Kein Zugang")
+        try:
+            old_admin = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("❌ Неверный ID")
             return
         
-        # Пересылаем пользователю
-        text = update.message.text or ''
-        save_message(acc[0], True, text)
-        
-        await context.bot.send_message(
-            chat_id=acc[1],  # user_id
-            text=f"📨 Antwort des Administrators:\n{text}"
-        )
+        if old_admin == uid:
+            await update.message.reply_text("❌ Нельзя удалить самого себя")
+            return
         
+        if await remove_admin(old_admin):
+            await update.message.reply_text(f"✅ {old_admin} больше не админ")
+        else:
+            await update.message.reply_text(f"⚠️ {old_admin} не был админом")
     except Exception as e:
-        logger.error(f"Ошибка в admin_reply: {e}")
+        logger.error(f"Ошибка в remove_admin_cmd: {e}")
 
-async def admin_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        # Проверяем, что сообщение в топике группы админов
-        if not update.message.message_thread_id:
+        if not is_admin(update.message.from_user.id):
+            await update.message.reply_text("❌ Kein Zugang")
             return
-        
-        # Ищем аккаунт по ID топика
-        acc = get_account_by_topic(update.message.message_thread_id)
+        await update.message.reply_text(metrics.format_stats()[:4096])
+    except Exception as e:
+        logger.error(f"Ошибка в stats_cmd: {e}")
+
+STATUS_USAGE = "Использование в топике заявки: /status " + "|".join(STATUSES)
+
+async def _topic_account(update: Update):
+    """Заявка топика, в котором админ дал команду, или None с подсказкой."""
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ Kein Zugang")
+        return None
+    acc = None
+    if update.message.message_thread_id:
+        acc = await get_account_by_topic(update.message.chat_id, update.message.message_thread_id)
+    if not acc:
+        await update.message.reply_text(STATUS_USAGE)
+    return acc
+
+async def _set_status(update: Update, acc, status):
+    old = await lifecycle.transition(acc.account_id, status, rate_limit_args=LANE_ADMIN)
+    if old == status:
+        await update.message.reply_text(f"ℹ️ #{acc.account_id} уже {status}")
+    else:
+        await update.message.reply_text(f"✅ #{acc.account_id}: {old} → {status}")
+
+async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        acc = await _topic_account(update)
         if not acc:
             return
-        
-        # Проверяем права админа
+        status = context.args[0].lower() if context.args else ""
+        if status not in STATUSES:
+            await update.message.reply_text(STATUS_USAGE)
+            return
+        await _set_status(update, acc, status)
+    except Exception as e:
+        logger.error(f"Ошибка в status_cmd: {e}")
+
+async def close_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        acc = await _topic_account(update)
+        if acc:
+            await _set_status(update, acc, CLOSED)
+    except Exception as e:
+        logger.error(f"Ошибка в close_cmd: {e}")
+
+async def reopen_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        acc = await _topic_account(update)
+        if acc:
+            await _set_status(update, acc, IN_PROGRESS)
+    except Exception as e:
+        logger.error(f"Ошибка в reopen_cmd: {e}")
+
+async def queue_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
         if not is_admin(update.message.from_user.id):
-            await update.message.reply_text("❌ Нет доступа")
+            await update.message.reply_text("❌ Kein Zugang")
             return
-        
-        # Сохраняем сообщение админа
-        caption = update.message.caption or ""
-        file_id = update.message.photo[-1].file_id
-        save_message(acc[0], True, f"PHOTO:{file_id}:{caption}")
-        
-        # Пересылаем пользователю
-        if caption:
-            await context.bot.send_photo(
-                chat_id=acc[1],
-                photo=file_id,
-                caption=f"📨 Antwort des Administrators:\n{caption}"
-            )
-        else:
-            await context.bot.send_photo(
-                chat_id=acc[1],
-                photo=file_id,
-                caption="📨 Antwort des Administrators"
-            )
-            
+        counts = await lifecycle.counts()
+        lines = [f"{status}: {counts.get(status, 0)}" for status in STATUSES if status != CLOSED]
+        await update.message.reply_text("📋 Открытые заявки\n" + "\n".join(lines))
     except Exception as e:
-        logger.error(f"Ошибка в admin_photo: {e}")
+        logger.error(f"Ошибка в queue_cmd: {e}")
 
-async def user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def archived_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        uid = update.message.from_user.id
-        if is_admin(uid): 
+        if not is_admin(update.message.from_user.id):
+            await update.message.reply_text("❌ Kein Zugang")
             return
-        
-        # Получаем активный диалог пользователя
-        acc = get_active_account(uid)
-        if not acc:
-            await update.message.reply_text("⏳ Warten Sie auf den Administrator.")
+        if not context.args or not context.args[0].lstrip("#").isdigit():
+            await update.message.reply_text("Использование: /archived <номер заявки>")
             return
-        
-        acc_id, admin_chat, topic_id = acc
-        save_message(acc_id, False, update.message.text)
-        
+        account_id = int(context.args[0].lstrip("#"))
+        account = await retention.fetch(account_id)
+        if account is None:
+            await update.message.reply_text(f"🔍 #{account_id} в архиве нет")
+            return
+        await update.message.reply_document(
+            document=format_transcript(account).encode(),
+            filename=f"account_{account_id}.txt",
+        )
+    except Exception as e:
+        logger.error(f"Ошибка в archived_cmd: {e}")
+
+EXPORT_USAGE = ("Использование: /export <номер заявки> [csv|jsonl] или "
+                "/export <ГГГГ-ММ-ДД> <ГГГГ-ММ-ДД> [csv|jsonl]; в топике заявки - без номера")
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if not is_admin(update.message.from_user.id):
+            await update.message.reply_text("❌ Kein Zugang")
+            return
+        args = list(context.args or ())
+        fmt = args.pop().lower() if args and args[-1].lower() in FORMATS else "csv"
+        account_id = None
+        if len(args) == 2:
+            try:
+                first, last = (datetime.date.fromisoformat(arg) for arg in args)
+            except ValueError:
+                await update.message.reply_text(EXPORT_USAGE)
+                return
+            # Последний день включительно
+            selection = {"date_from": first.isoformat(),
+                         "date_to": (last + datetime.timedelta(days=1)).isoformat()}
+            name = f"export_{first}_{last}"
+        else:
+            if len(args) == 1 and args[0].lstrip("#").isdigit():
+                account_id = int(args[0].lstrip("#"))
+            elif not args and update.message.message_thread_id:
+                acc = await get_account_by_topic(update.message.chat_id, update.message.message_thread_id)
+                account_id = acc.account_id if acc else None
+            if account_id is None:
+                await update.message.reply_text(EXPORT_USAGE)
+                return
+            selection = {"account_id": account_id}
+            name = f"account_{account_id}"
+
+        path, count, size = await exporter.export(fmt, **selection)
+        if not count and account_id is not None:
+            os.remove(path)
+            archived = await retention.fetch(account_id)
+            if archived is None:
+                await update.message.reply_text(f"🔍 Заявки #{account_id} нет")
+                return
+            path, count, size = await exporter.export(fmt, rows=archived_rows(archived))
         try:
-            await context.bot.send_message(
-                chat_id=admin_chat,
-                text=f"👤 User:\n{update.message.text}",
-                message_thread_id=topic_id
+            if size > MAX_DOCUMENT_SIZE:
+                await update.message.reply_text(f"⚠️ Выгрузка {size // 1024 // 1024} МБ - больше лимита Telegram, сузьте диапазон")
+                return
+            # PTB всё равно читает файл целиком - пусть хотя бы не в event loop
+            with open(path, "rb") as f:
+                data = await asyncio.to_thread(f.read)
+            await update.message.reply_document(
+                document=data, filename=f"{name}.{fmt}", caption=f"📤 Строк: {count}"
             )
-        except Exception as e:
-            logger.error(f"Error sending message: {e}")
-            await update.message.reply_text("⚠️ Eine Nachricht an den Administrator konnte nicht gesendet werden")
+        finally:
+            os.remove(path)
     except Exception as e:
-        logger.error(f"Ошибка в user_message: {e}")
+        logger.error(f"Ошибка в export_cmd: {e}")
 
-async def user_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def _search_reply(session_id, rows, empty="🔍 Ничего не найдено"):
+    """Текст и клавиатура страницы результатов поиска."""
+    if not rows:
+        return empty, None
+    markup = None
+    if len(rows) == PAGE_SIZE:
+        markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("Weiter ▶", callback_data=f"search:{session_id}")]]
+        )
+    return format_results(rows)[:4096], markup
+
+async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         uid = update.message.from_user.id
-        if is_admin(uid): 
+        if not is_admin(uid):
+            await update.message.reply_text("❌ Kein Zugang")
             return
-        
-        # Получаем активный диалог пользователя
-        acc = get_active_account(uid)
-        if not acc:
-            await update.message.reply_text("⏳ Warten Sie auf den Administrator.")
+        match = build_match(" ".join(context.args or ()))
+        if not match:
+            await update.message.reply_text("Использование: /search <слова или @username>")
             return
-        
-        acc_id, admin_chat, topic_id = acc
-        caption = update.message.caption or ""
-        file_id = update.message.photo[-1].file_id
-        save_message(acc_id, False, f"PHOTO:{file_id}:{caption}")
-        
-        try:
-            if caption:
-                await context.bot.send_photo(
-                    chat_id=admin_chat,
-                    photo=file_id,
-                    caption=f"👤 User: {caption}",
-                    message_thread_id=topic_id
-                )
-            else:
-                await context.bot.send_photo(
-                    chat_id=admin_chat,
-                    photo=file_id,
-                    caption="👤 User sent photo",
-                    message_thread_id=topic_id
-                )
-        except Exception as e:
-            logger.error(f"Error sending photo: {e}")
-            await update.message.reply_text("⚠️ Foto konnte nicht an den Administrator gesendet werden")
+        floor, rows = await accounts_db.read(search_page, match)
+        after = (rows[-1][0], rows[-1][1]) if rows else None
+        session_id = search_sessions.open(uid, match, floor, after)
+        text, markup = _search_reply(session_id, rows)
+        await update.message.reply_text(text, reply_markup=markup, disable_web_page_preview=True)
+    except Exception as e:
+        logger.error(f"Ошибка в search_cmd: {e}")
+
+async def search_more(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    try:
+        session_id = int(query.data.split(":", 1)[1])
+        session = search_sessions.get(session_id, query.from_user.id) if is_admin(query.from_user.id) else None
+        if session is None:
+            await query.answer("Поиск устарел, повторите /search")
+            return
+        match, floor, after = session
+        _, rows = await accounts_db.read(search_page, match, floor, after)
+        if rows:
+            search_sessions.advance(session_id, (rows[-1][0], rows[-1][1]))
+        await query.answer()
+        text, markup = _search_reply(session_id, rows, empty="🔍 Больше результатов нет")
+        await query.edit_message_text(text, reply_markup=markup, disable_web_page_preview=True)
     except Exception as e:
-        logger.error(f"Ошибка в user_photo: {e}")
+        logger.error(f"Ошибка в search_more: {e}")
 
-# Новая система обработки медиагрупп
-media_groups = {}
+async def deny_topic(update: Update, context: ContextTypes.DEFAULT_TYPE, routed):
+    # В топик заявки пишет не админ
+    await update.message.reply_text("❌ Kein Zugang")
 
+async def wait_for_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # У пользователя ещё нет открытого диалога
+    await update.message.reply_text("⏳ Warten Sie auf den Administrator.")
 
-async def handle_media_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик для медиагрупп (альбомов)"""
+# Если пересылку так и не удалось доставить
+USER_UNREACHABLE = "⚠️ Nachricht konnte dem Benutzer nicht zugestellt werden"
+ADMIN_UNREACHABLE = "⚠️ Eine Nachricht an den Administrator konnte nicht gesendet werden"
+ADMIN_MEDIA_UNREACHABLE = "⚠️ Datei konnte nicht an den Administrator gesendet werden"
+
+def _admin_notice(acc, text=USER_UNREACHABLE):
+    return {"chat_id": acc.admin_chat_id, "message_thread_id": acc.topic_id, "text": text}
+
+def _user_notice(acc, text=ADMIN_UNREACHABLE):
+    return {"chat_id": acc.user_id, "text": text}
+
+async def admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, routed):
     try:
-        # Определяем тип отправителя
-        uid = update.message.from_user.id
-        if is_admin(uid):
-            sender_type = "admin"
-            # Для админов получаем информацию об аккаунте из топика
-            if not update.message.message_thread_id:
-                return
-            acc = get_account_by_topic(update.message.message_thread_id)
-            if not acc:
-                return
-            user_id = acc[1]  # user_id для отправки
-        else:
-            sender_type = "user"
-            # Для пользователей получаем активный диалог
-            acc = get_active_account(uid)
-            if not acc:
-                await update.message.reply_text("⏳ Warten Sie auf den Administrator.")
-                return
-            user_id = None
-            admin_chat = acc[1]
-            topic_id = acc[2]
+        acc = routed.route
         
-        # Получаем ID медиагруппы
-        media_group_id = update.message.media_group_id
-        
-        # Если это первое сообщение в группе
-        if media_group_id not in media_groups:
-            media_groups[media_group_id] = {
-                "media": [],
-                "caption": update.message.caption or "",
-                "sender_type": sender_type,
-                "user_id": user_id,
-                "admin_chat": admin_chat if sender_type == "user" else ADMIN_GROUP_ID,
-                "topic_id": topic_id if sender_type == "user" else update.message.message_thread_id,
-                "account_id": acc[0] if sender_type == "user" else acc[0],
-                "timestamp": update.message.date
-            }
-            
-            # Запланируем обработку группы через задержку
-            context.job_queue.run_once(
-                process_media_group, 
-                MEDIA_GROUP_DELAY, 
-                data=media_group_id,
-                name=f"media_group_{media_group_id}"
-            )
-        
-        # Добавляем медиа в группу
-        if update.message.photo:
-            file_id = update.message.photo[-1].file_id
-            media_groups[media_group_id]["media"].append(("photo", file_id))
-        # Можно добавить обработку других типов медиа здесь
+        # Пересылаем пользователю - в фоне, вместе с записью в переписку
+        text = update.message.text or ''
+        save_message(acc.account_id, True, text, delivery=outbox_entry(
+            message_key(update.message), acc.user_id, KIND_TEXT,
+            text=f"📨 Antwort des Administrators:\n{text}",
+            lane=LANE_ADMIN,
+            notice=_admin_notice(acc),
+        ))
         
-        # Сохраняем сообщение в БД
-        if sender_type == "user":
-            save_message(acc[0], False, f"PHOTO:{file_id}:{update.message.caption or ''}")
-        else:
-            save_message(acc[0], True, f"PHOTO:{file_id}:{update.message.caption or ''}")
-            
     except Exception as e:
-        logger.error(f"Ошибка в handle_media_group: {e}")
+        logger.error(f"Ошибка в admin_reply: {e}")
 
-async def process_media_group(context: ContextTypes.DEFAULT_TYPE):
-    """Обработка собранной медиагруппы"""
-    job = context.job
-    media_group_id = job.data
-    
-    if media_group_id not in media_groups:
-        return
-        
-    group_data = media_groups[media_group_id]
-    
+async def admin_media(update: Update, context: ContextTypes.DEFAULT_TYPE, routed):
     try:
-        # Создаем медиагруппу
-        media_group = []
-        base_caption = ""
+        acc = routed.route
+        attachment = message_attachment(update.message)
         
-        if group_data["sender_type"] == "user":
-            base_caption = "👤 User sent album"
-            if group_data["caption"]:
-                base_caption += f"\n{group_data['caption']}"
-        else:
-            base_caption = "📨 Antwort des Administrators"
-            if group_data["caption"]:
-                base_caption += f"\n{group_data['caption']}"
-        
-        for i, (media_type, file_id) in enumerate(group_data["media"]):
-            if i == 0:
-                media_item = InputMediaPhoto(media=file_id, caption=base_caption)
-            else:
-                media_item = InputMediaPhoto(media=file_id)
-            media_group.append(media_item)
-        
-        # Отправляем медиагруппу
-        if group_data["sender_type"] == "user":
-            await context.bot.send_media_group(
-                chat_id=group_data["admin_chat"],
-                media=media_group,
-                message_thread_id=group_data["topic_id"]
-            )
-        else:
-            await context.bot.send_media_group(
-                chat_id=group_data["user_id"],
-                media=media_group
-            )
+        # Сохраняем сообщение админа и копируем пользователю вложение любого типа
+        caption = update.message.caption or ""
+        save_message(acc.account_id, True, caption, [attachment], delivery=outbox_entry(
+            message_key(update.message), acc.user_id, KIND_COPY,
+            from_chat_id=update.message.chat_id,
+            message_id=update.message.message_id,
+            caption=f"📨 Antwort des Administrators:\n{caption}" if caption else "📨 Antwort des Administrators",
+            media_type=attachment.media_type,
+            lane=LANE_ADMIN,
+            notice=_admin_notice(acc),
+        ))
             
     except Exception as e:
-        logger.error(f"Ошибка отправки медиагруппы: {e}")
-    finally:
-        # Удаляем группу из кэша
-        if media_group_id in media_groups:
-            del media_groups[media_group_id]
+        logger.error(f"Ошибка в admin_media: {e}")
 
-async def admin_album(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def user_message(update: Update, context: ContextTypes.DEFAULT_TYPE, routed):
     try:
-        if not update.message.message_thread_id:
-            return
-            
-        acc = get_account_by_topic(update.message.message_thread_id)
-        if not acc:
-            return
-            
-        if not is_admin(update.message.from_user.id):
-            await update.message.reply_text("❌ Kein Zugang")
-            return
-        
-        # Получаем все фото из альбома
-        file_ids = [photo.file_id for photo in update.message.photo]
-        caption = update.message.caption or ""
-        
-        # Сохраняем сообщения
-        for i, file_id in enumerate(file_ids):
-            save_message(acc[0], True, f"PHOTO:{file_id}:{caption if i == 0 else ''}")
-        
-        # Создаем медиагруппу для пользователя
-        media_group = []
-        base_caption = "📨 Antwort des Administrators"
-        if caption:
-            base_caption += f"\n{caption}"
-        
-        for i, file_id in enumerate(file_ids):
-            if i == 0:
-                media_item = InputMediaPhoto(media=file_id, caption=base_caption)
-            else:
-                media_item = InputMediaPhoto(media=file_id)
-            media_group.append(media_item)
-        
-        await context.bot.send_media_group(
-            chat_id=acc[1],
-            media=media_group
-        )
-            
+        acc = routed.route
+        save_message(acc.account_id, False, update.message.text, delivery=outbox_entry(
+            message_key(update.message), acc.admin_chat_id, KIND_TEXT,
+            text=f"👤 User:\n{update.message.text}",
+            message_thread_id=acc.topic_id,
+            notice=_user_notice(acc),
+        ))
     except Exception as e:
-        logger.error(f"Error in admin_album: {e}")
+        logger.error(f"Ошибка в user_message: {e}")
 
-async def user_album(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def user_media(update: Update, context: ContextTypes.DEFAULT_TYPE, routed):
     try:
-        uid = update.message.from_user.id
-        if is_admin(uid):
-            return
-        
-        acc = get_active_account(uid)
-        if not acc:
-            await update.message.reply_text("⏳ Warten Sie auf den Administrator.")
-            return
-            
-        acc_id, admin_chat, topic_id = acc
+        acc = routed.route
+        attachment = message_attachment(update.message)
         caption = update.message.caption or ""
-        
-        # Получаем все фото из сообщения
-        file_ids = [photo.file_id for photo in update.message.photo]
-        
-        # Сохраняем каждое фото
-        for i, file_id in enumerate(file_ids):
-            save_message(acc_id, False, f"PHOTO:{file_id}:{caption if i == 0 else ''}")
-        
-        # Создаем медиагруппу с использованием InputMediaPhoto
-        media_group = []
-        base_caption = "👤 User sent Album"
-        if caption:
-            base_caption += f"\n{caption}"
-        
-        for i, file_id in enumerate(file_ids):
-            if i == 0:
-                media_item = InputMediaPhoto(media=file_id, caption=base_caption)
-            else:
-                media_item = InputMediaPhoto(media=file_id)
-            media_group.append(media_item)
-        
-        try:
-            await context.bot.send_media_group(
-                chat_id=admin_chat,
-                media=media_group,
-                message_thread_id=topic_id
-            )
-        except Exception as e:
-            logger.error(f"Error sending album: {e}")
-            await update.message.reply_text("⚠️ Не удалось отправить альбом администратору")
-            
+        save_message(acc.account_id, False, caption, [attachment], delivery=outbox_entry(
+            message_key(update.message), acc.admin_chat_id, KIND_COPY,
+            from_chat_id=update.message.chat_id,
+            message_id=update.message.message_id,
+            caption=f"👤 User: {caption}" if caption else f"👤 User sent {attachment.media_type}",
+            media_type=attachment.media_type,
+            message_thread_id=acc.topic_id,
+            notice=_user_notice(acc, ADMIN_MEDIA_UNREACHABLE),
+        ))
     except Exception as e:
-        logger.error(f"Error in user_album: {e}")
+        logger.error(f"Ошибка в user_media: {e}")
+
+# Части альбомов админа и пользователя
+async def handle_media_group(update: Update, context: ContextTypes.DEFAULT_TYPE, routed):
+    """Обработчик для медиагрупп (альбомов)"""
+    try:
+        # Добавляем медиа в группу; отправка и запись в БД - когда альбом соберётся
+        media_groups.add(
+            routed.album_id,
+            message_attachment(update.message),
+            (routed.role, routed.route, update.message.chat_id),
+            message_id=update.message.message_id,
+        )
+    except Exception as e:
+        logger.error(f"Ошибка в handle_media_group: {e}")
+
+async def process_media_group(album):
+    """Обработка собранной медиагруппы"""
+    sender_type, acc, from_chat_id = album.meta
+    from_admin = sender_type == ADMIN
+    
+    if sender_type == USER:
+        base_caption = "👤 User sent album"
+    else:
+        base_caption = "📨 Antwort des Administrators"
+    if album.items[0].caption:
+        base_caption += f"\n{album.items[0].caption}"
+    
+    # Копируем альбом целиком (при необходимости собираем заново) - в фоне
+    if sender_type == USER:
+        target = dict(chat_id=acc.admin_chat_id, message_thread_id=acc.topic_id,
+                      lane=LANE_ALBUM, notice=_user_notice(acc, ADMIN_MEDIA_UNREACHABLE))
+    else:
+        target = dict(chat_id=acc.user_id, lane=LANE_ADMIN, notice=_admin_notice(acc))
+    delivery = outbox_entry(
+        f"{from_chat_id}:album:{_album_key(album)}", kind=KIND_ALBUM,
+        from_chat_id=from_chat_id,
+        media_group_id=album.media_group_id,
+        message_ids=album.message_ids,
+        items=album.items,
+        caption=base_caption,
+        **target,
+    )
+    
+    # Альбом - одно сообщение со всеми вложениями, одной транзакцией с доставкой
+    save_message(acc.account_id, from_admin, album.caption, album.items, delivery)
+    # Сохранённый альбом можно забыть только после commit переписки: пока
+    # пачка не записана, flush() бросает и задание альбома остаётся в
+    # state.db; если упадём раньше, повторная обработка отсеется по ключу
+    # доставки
+    await transcript.flush()
+
+# Недособранный альбом в state.db: meta - (роль, маршрут, чат источника)
+ALBUM_JOB = "media_group"
+
+def _album_key(album):
+    """Ключ одной отправки альбома. Часть, опоздавшая к уже отданному
+    альбому, собирается в новый Album с тем же media_group_id - различаем
+    их по первому сообщению."""
+    if not album.message_ids:
+        return album.media_group_id
+    return f"{album.media_group_id}:{album.message_ids[0]}"
+
+def _save_album(album):
+    role, acc, from_chat_id = album.meta
+    persistence.save_job(ALBUM_JOB, _album_key(album), {
+        "media_group_id": album.media_group_id,
+        "role": role,
+        "route": [acc.account_id, acc.user_id, acc.admin_chat_id, acc.topic_id],
+        "from_chat_id": from_chat_id,
+        "items": album.items,
+        "message_ids": album.message_ids,
+        "caption": album.caption,
+    })
+
+def _drop_album(album):
+    persistence.drop_job(ALBUM_JOB, _album_key(album))
+
+async def restore_media_groups():
+    """Альбомы, части которых пришли до рестарта, отправляются как есть."""
+    for key, job in await persistence.load_jobs(ALBUM_JOB):
+        album = Album(job.get("media_group_id", key), (job["role"], Route(*job["route"]), job["from_chat_id"]), 0)
+        album.items = [Attachment(*item) for item in job["items"]]
+        album.message_ids = job["message_ids"]
+        album.caption = job["caption"]
+        if not album.items:
+            _drop_album(album)
+            continue
+        media_groups.restore(album)
+
+# Альбомы собираются по media_group_id с адаптивной паузой
+media_groups = MediaGroupAggregator(process_media_group, on_update=_save_album, on_done=_drop_album)
 
 # Обработчик для медиа без подписи в состоянии ACCOUNT_INFO
 async def invalid_account_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-            "👋 Hallo. Schicken Sie uns Ihre Angaben in diesem Format:\n"
-            "📝 Anzahl der Skins:\n"
-            "📝 Og oder seltene Skins:\n"
-            "🖼️ Fotos von Ihrem Konto\n\n"
-            "Oder Sie können die automatische Verifizierungsmethode verwenden, " \
-            "das Konto durch den Checker überprüfen und uns die Fotos schicken, " \
-            "die Sie vom Bot in Telegramm erhalten.\n@BombSkinCheckerBot"
-    )
+    await update.message.reply_text(content.current.texts["invalid_info"])
     return ACCOUNT_INFO
 
 
 async def show_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        if not REVIEW_PHOTOS:
+        review_media = content.current.review_media
+        if not review_media:
             await update.message.reply_text("⚠️ Keine Bewertungen verfügbar")
             return
         
@@ -725,40 +881,190 @@ async def show_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             logger.warning("Konnte die Nachricht nicht löschen")
 
-        # Отправляем все фото отзывов медиагруппой
-        media_group = []
-        for i, photo_id in enumerate(REVIEW_PHOTOS):
-            if i == 0:
-                # Для первого фото добавляем подпись
-                media_group.append(InputMediaPhoto(
-                    media=photo_id,
-                    caption="📊 Bewertungen unserer Kunden:"
-                ))
-            else:
-                media_group.append(InputMediaPhoto(media=photo_id))
-        
-        await context.bot.send_media_group(
-            chat_id=update.message.chat_id,
-            media=media_group
-        )
+        # Галерея только что была у этого пользователя или её просят все разом
+        if not guard.admit_reviews(update.message.from_user.id):
+            return
+
+        # Медиагруппа собрана заранее, в снимке content; одно фото медиагруппой не отправить
+        if len(review_media) == 1:
+            await context.bot.send_photo(
+                chat_id=update.message.chat_id,
+                photo=review_media[0].media,
+                caption=review_media[0].caption,
+                rate_limit_args=LANE_REVIEWS
+            )
+        else:
+            await context.bot.send_media_group(
+                chat_id=update.message.chat_id,
+                media=review_media,
+                rate_limit_args=LANE_REVIEWS
+            )
 
     except Exception as e:
         logger.error(f"Fehler in show_reviews: {e}")
         await update.message.reply_text("❌ Fehler beim Laden der Bewertungen")
 
 
+def register_metrics(application, scheduler, webhook_server=None):
+    """Глубины очередей и счётчики компонентов снимаются при каждой выдаче метрик."""
+    queues = {
+        "updates_in_flight": application.in_flight,
+        "outbound": scheduler.pending,
+        "intake": intake.__len__,
+        "media_groups": media_groups.__len__,
+        "transcript": transcript.__len__,
+        "outbox": outbox.__len__,
+        "topic_pool": lambda: sum(len(pool) for pool in topic_pools.values()),
+        "sqlite_accounts_writes": accounts_db.pending_writes,
+        "state": persistence.pending,
+    }
+    if webhook_server is not None:
+        queues["webhook"] = webhook_server.queue.qsize
+    metrics.collect("bot_queue_depth", "gauge", "Глубина внутренних очередей", ("queue",),
+                    lambda: [((name,), depth()) for name, depth in queues.items()])
+    metrics.collect("bot_events_total", "counter", "Счётчики компонентов", ("event",), lambda: [
+        (("outbound_sent",), scheduler.sent),
+        (("outbound_retried",), scheduler.retried),
+        (("outbound_coalesced",), scheduler.coalesced),
+        (("transcript_commits",), transcript.commits),
+        (("transcript_rows",), transcript.rows_written),
+        (("transcript_failures",), transcript.failures),
+        (("transcript_dead_letters",), transcript.dead_letters),
+        (("media_flushed_full",), media_groups.flushed_full),
+        (("media_flushed_timeout",), media_groups.flushed_timeout),
+        (("media_evicted",), media_groups.evicted),
+        (("topic_pool_hits",), sum(pool.hits for pool in topic_pools.values())),
+        (("topic_pool_misses",), sum(pool.misses for pool in topic_pools.values())),
+        (("lifecycle_expired",), lifecycle.expired),
+        (("archive_accounts",), retention.archived),
+        (("archive_messages",), retention.messages_archived),
+        (("archive_pages_freed",), retention.pages_freed),
+        (("exports",), exporter.exports),
+        (("export_rows",), exporter.rows_exported),
+        (("outbox_delivered",), outbox.delivered),
+        (("outbox_retried",), outbox.retried),
+        (("outbox_dead",), outbox.dead),
+        (("state_commits",), persistence.commits),
+        (("state_keys",), persistence.keys_written),
+        (("state_failures",), persistence.failures),
+        (("guard_dropped",), guard.dropped),
+        (("guard_duplicates",), guard.duplicates),
+        (("guard_limited",), guard.limited),
+        (("guard_reviews_throttled",), guard.reviews_throttled),
+        (("content_reloads",), content.reloads),
+        (("content_rejected",), content.rejected),
+    ])
+
+
+async def start_background(application: Application):
+    if metrics_server is not None:
+        await metrics_server.start()
+    transcript.start()
+    admin_set.watch()
+    content.watch()
+    for pool in topic_pools.values():
+        await pool.start(application.bot)
+    await intake.start(application.bot)
+    if PRIMARY:
+        await lifecycle.start(application.bot)
+        await retention.start()
+    # Недоставленное до рестарта уходит первым делом
+    await outbox.start(application.bot)
+    # Каждый воркер поднимает только свои альбомы (в т.ч. после перезапуска)
+    await restore_media_groups()
+
+
+async def close_databases(application: Application):
+    if metrics_server is not None:
+        await metrics_server.stop()
+    admin_set.stop_watching()
+    content.stop_watching()
+    await outbox.close()
+    await lifecycle.close()
+    await retention.close()
+    await intake.close()
+    for pool in topic_pools.values():
+        await pool.close()
+    await media_groups.close()
+    await transcript.close()
+    accounts_db.close()
+    admins_db.close()
+    await persistence.flush()
+    state_db.close()
+
+
+def run_cluster():
+    """Ingress: принимает апдейты и раздаёт их WORKER_PROCESSES воркерам (cluster.py)."""
+    cluster = Cluster(__file__, WORKER_PROCESSES, [ACCOUNTS_DB_FILE, ADMIN_DB_FILE, STATE_DB_FILE],
+                      run_dir=CLUSTER_RUN_DIR, log_file=LOG_FILE)
+    if UPDATE_MODE == "webhook":
+        # Апдейт не собирается в объекты PTB: воркеру нужен сырой JSON
+        server = WebhookServer(
+            cluster,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            queue_size=WEBHOOK_QUEUE_SIZE,
+            decode=lambda data: data,
+        )
+        source = set_webhook(BOT_TOKEN, WEBHOOK_URL, WEBHOOK_SECRET, BOT_API_BASE_URL) if WEBHOOK_URL else None
+        code = run_ingress(cluster, source, server)
+    else:
+        code = run_ingress(cluster, poll_updates(cluster, BOT_TOKEN, BOT_API_BASE_URL))
+    if code:
+        exit(code)
+
 def main():
+    # Токен нужен только боту: --vacuum и прочее обслуживание обходятся без него
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN не задан! Укажите TELEGRAM_BOT_TOKEN или в config.ini.")
+        exit(1)
+    
     # Проверка конфигурации группы
-    if not ADMIN_GROUP_ID:
+    if not ADMIN_GROUP_IDS:
         logger.warning("ADMIN_GROUP_ID не задан! Бот не сможет создавать топики.")
+    elif len(ADMIN_GROUP_IDS) > 1:
+        logger.info(f"Групп админов: {len(ADMIN_GROUP_IDS)}, балансировка {BALANCER}")
+    if UPDATE_MODE == "webhook" and not WEBHOOK_SECRET and not IS_WORKER:
+        logger.warning("WEBHOOK_SECRET не задан! Webhook примет запросы от кого угодно.")
+    
+    if IS_INGRESS:
+        run_cluster()
+        return
     
     # Инициализация БД
     init_accounts_db()
     init_admins_db()
+    init_state_db()
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    # В кластере у каждого воркера своя доля общих лимитов Telegram
+    scheduler = OutboundScheduler(
+        overall_rate=OVERALL_RATE / WORKER_PROCESSES,
+        group_rate=GROUP_RATE / WORKER_PROCESSES,
+        group_burst=max(1, GROUP_BURST // WORKER_PROCESSES),
+        metrics=metrics,
+    )
+    builder = Application.builder().token(BOT_TOKEN)
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    application = (
+        builder
+        # Апдейты одного пользователя/топика - по порядку, разных - параллельно
+        .application_class(SequencedApplication, kwargs={"max_in_flight": MAX_CONCURRENT_UPDATES})
+        # Все исходящие запросы идут через общий планировщик с лимитами Telegram
+        .rate_limiter(scheduler)
+        # Состояние разговоров - в state.db, пишется только изменившееся
+        .persistence(persistence)
+        .post_init(start_background)
+        .post_shutdown(close_databases)
+        .build()
+    )
     
-    review_handler = MessageHandler(filters.Regex(r'^📊 Bewertungen$'), show_reviews)
+    # Отзывы - только в личке; в топиках админов этот текст обычный ответ
+    review_handler = MessageHandler(
+        filters.Regex(r'^📊 Bewertungen$') & filters.ChatType.PRIVATE, show_reviews
+    )
 
     # Обработчики для пользователей
     user_conv = ConversationHandler(
@@ -772,33 +1078,91 @@ def main():
             ]
         },
         fallbacks=[],
-        per_user=True
+        per_user=True,
+        name="user_conv",
+        persistent=True
     )
     
-    # Обработчики для админов
-    admin_handlers = [
+    # Команды админов
+    admin_commands = [
         CommandHandler("addadmin", add_admin_cmd),
-        MessageHandler(filters.TEXT & filters.ChatType.SUPERGROUP, admin_reply),
-        MessageHandler(filters.PHOTO & filters.ChatType.SUPERGROUP, admin_photo),
-        MessageHandler(filters.PHOTO & filters.ChatType.SUPERGROUP, handle_media_group)
+        CommandHandler("deladmin", remove_admin_cmd),
+        CommandHandler("stats", stats_cmd),
+        CommandHandler("status", status_cmd),
+        CommandHandler("close", close_cmd),
+        CommandHandler("reopen", reopen_cmd),
+        CommandHandler("queue", queue_cmd),
+        CommandHandler("archived", archived_cmd),
+        CommandHandler("export", export_cmd),
+        CommandHandler("search", search_cmd),
+        CallbackQueryHandler(search_more, pattern=r"^search:\d+$"),
     ]
     
-    # Обработчики для пользовательских сообщений
-    user_message_handlers = [
-        MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(r'^📊 Bewertungen$'), user_message),
-        MessageHandler(filters.PHOTO, user_photo),
-        MessageHandler(filters.PHOTO, handle_media_group)
-    ]
+    # Переписка: роль, место и тип сообщения определяются один раз
+    router = UpdateRouter(
+        {
+            (ADMIN, TOPIC, TEXT): admin_reply,
+            (ADMIN, TOPIC, MEDIA): admin_media,
+            (ADMIN, TOPIC, ALBUM): handle_media_group,
+            (USER, TOPIC, TEXT): deny_topic,
+            (USER, TOPIC, MEDIA): deny_topic,
+            (USER, TOPIC, ALBUM): deny_topic,
+            (USER, PRIVATE, TEXT): user_message,
+            (USER, PRIVATE, MEDIA): user_media,
+            (USER, PRIVATE, ALBUM): handle_media_group,
+        },
+        is_admin=is_admin,
+        by_topic=get_account_by_topic,
+        by_user=get_active_account,
+        on_unrouted=wait_for_admin,
+    )
     
+    # Флуд из лички отсекается раньше всех обработчиков
+    application.add_handler(TypeHandler(Update, guard.check), group=-1)
+
     # Регистрация обработчиков
     application.add_handlers([
-        *admin_handlers,
+        *admin_commands,
         review_handler,
         user_conv,
-        *user_message_handlers
+        router
     ])
+    # Время каждого обработчика - в bot_handler_seconds
+    instrument_handlers(application, metrics)
     
-    application.run_polling()
+    if IS_WORKER:
+        # Апдейты своего шарда приходят от ingress; run_webhook нужен только start/stop
+        link = WorkerLink(application, os.path.join(CLUSTER_RUN_DIR, INGRESS_SOCKET), WORKER_INDEX)
+        register_metrics(application, scheduler)
+        run_webhook(application, link)
+    elif UPDATE_MODE == "webhook":
+        server = WebhookServer(
+            application,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            queue_size=WEBHOOK_QUEUE_SIZE,
+        )
+        register_metrics(application, scheduler, server)
+        run_webhook(application, server, webhook_url=WEBHOOK_URL)
+    else:
+        register_metrics(application, scheduler)
+        application.run_polling()
+
+def vacuum_accounts():
+    """Обслуживание при остановленном боте: полный VACUUM accounts.db."""
+    init_accounts_db()
+    try:
+        asyncio.run(retention.vacuum())
+    finally:
+        accounts_db.close()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Бот поддержки")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="полный VACUUM accounts.db (включает auto_vacuum=INCREMENTAL) и выход")
+    if parser.parse_args().vacuum:
+        vacuum_accounts()
+    else:
+        main()
@@ -0,0 +1,450 @@
+"""Многопроцессный режим: один процесс принимает апдейты, N воркеров их обрабатывают.
+
+В одном процессе разбор апдейтов в объекты PTB, фильтры, сборка текстов
+и sqlite делят одно ядро. С WORKER_PROCESSES > 1 `python bot.py`
+становится ingress:
+
+* поднимает сервис записи (storage.serve_writes) и N воркеров - тот же
+  bot.py с BOT_ROLE=worker и WORKER_INDEX; упавший воркер запускается
+  заново, без сервиса записи кластер останавливается;
+* получает апдейты (getUpdates или webhook) и, не собирая из них
+  объекты PTB, раздаёт сырым JSON по воркерам. shard_of() берёт ключ
+  так же, как sequencer.conversation_key: топик форума, иначе
+  пользователь, иначе чат. Поэтому у одного диалога два ключа: личка
+  пользователя шардируется по user_id, ответы админов в топике - по
+  topic_id, и два направления обычно обрабатывают разные воркеры. Каждое
+  направление целиком живёт в одном воркере и приходит по одному
+  соединению, так что его порядок сохраняется, а в воркере его дальше
+  держит SequencedApplication. Общего для обоих направлений состояния в
+  памяти воркера нет: маршруты кэшируются лишь на WORKER_ROUTE_TTL
+  секунд (routing.RoutingCache), простой и архив обслуживает воркер 0
+  по таблице accounts;
+* пока воркер перезапускается, его апдейты копятся в очереди шарда;
+  полная очередь останавливает приём (getUpdates не вызывается,
+  webhook отвечает 503).
+
+Связь - unix-сокеты в run_dir: кадры «длина + JSON» от ingress к
+воркерам, multiprocessing.connection - к сервису записи. Ключ
+аутентификации случайный на каждый запуск и передаётся в окружении.
+Апдейты, уже отданные упавшему воркеру, теряются - как и при падении
+одиночного процесса после подтверждения getUpdates.
+"""
+import asyncio
+import json
+import logging
+import os
+import secrets
+import signal
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import httpx
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Окружение дочерних процессов
+ROLE_ENV = "BOT_ROLE"
+INDEX_ENV = "WORKER_INDEX"
+KEY_ENV = "CLUSTER_KEY"
+RUN_DIR_ENV = "CLUSTER_RUN_DIR"
+WORKER = "worker"
+WRITER = "writer"
+
+RUN_DIR = "run"
+INGRESS_SOCKET = "ingress.sock"
+WRITER_SOCKET = "writer.sock"
+SHARD_QUEUE_SIZE = 1000
+POLL_TIMEOUT = 30         # секунд long polling getUpdates
+POLL_RETRY_DELAY = 5.0    # секунд после ошибки getUpdates
+RESTART_DELAY = 1.0       # секунд до перезапуска упавшего воркера
+STARTUP_TIMEOUT = 30.0    # секунд ждём сокет сервиса записи
+STOP_TIMEOUT = 30.0       # секунд на завершение дочернего процесса до kill
+
+_FRAME = struct.Struct("!I")
+
+# Поля апдейта, в которых лежит само сообщение (Update.effective_message)
+_MESSAGE_FIELDS = {"message", "edited_message", "channel_post", "edited_channel_post"}
+
+
+def conversation_key(update):
+    """sequencer.conversation_key для сырого апдейта (dict)."""
+    payload = field = None
+    for field, value in update.items():
+        if field != "update_id" and isinstance(value, dict):
+            payload = value
+            break
+    if payload is None:
+        return None
+    if field == "callback_query":
+        message = payload.get("message")
+    else:
+        message = payload if field in _MESSAGE_FIELDS else None
+    chat = message.get("chat") if message else payload.get("chat")
+    if message and chat and chat.get("type") == "supergroup" and message.get("message_thread_id"):
+        return ("topic", chat["id"], message["message_thread_id"])
+    # У poll_answer автор - в user, у остальных - в from
+    user = payload.get("from") or payload.get("user")
+    if user:
+        return ("user", user["id"])
+    if chat:
+        return ("chat", chat["id"])
+    return None
+
+
+def shard_of(update, shards):
+    key = conversation_key(update)
+    if key is None:
+        return update.get("update_id", 0) % shards
+    return zlib.crc32(repr(key).encode()) % shards
+
+
+def process_log_file(log_file, name):
+    """logs/bot.log -> logs/bot.<name>.log: у каждого процесса свой файл с ротацией."""
+    if not log_file:
+        return log_file
+    root, ext = os.path.splitext(log_file)
+    return f"{root}.{name}{ext}"
+
+
+async def read_frame(reader):
+    (size,) = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    return await reader.readexactly(size)
+
+
+def write_frame(writer, data):
+    writer.write(_FRAME.pack(len(data)) + data)
+
+
+class Cluster:
+    """Дочерние процессы и очереди шардов на стороне ingress.
+
+    process_update(update) - для WebhookServer(decode=...) и poll_updates:
+    апдейт (dict) уходит в очередь своего воркера.
+    """
+
+    def __init__(self, script, workers, databases, run_dir=RUN_DIR, log_file=None,
+                 queue_size=SHARD_QUEUE_SIZE):
+        self.script = os.path.abspath(script)
+        self.workers = workers
+        self.databases = databases
+        self.run_dir = os.path.abspath(run_dir)
+        self.log_file = log_file
+        self.authkey = secrets.token_bytes(32)
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.failed = asyncio.Event()  # сервис записи умер - дальше работать нельзя
+        self._unsent = [None] * workers  # кадр, который не успели отдать воркеру
+        self._links = {}
+        self._processes = {}
+        self._supervisors = []
+        self._server = None
+        self._stopping = False
+        # Счётчики для наблюдения
+        self.forwarded = 0
+        self.restarts = 0
+
+    @property
+    def ingress_address(self):
+        return os.path.join(self.run_dir, INGRESS_SOCKET)
+
+    @property
+    def writer_address(self):
+        return os.path.join(self.run_dir, WRITER_SOCKET)
+
+    async def process_update(self, update):
+        shard = shard_of(update, self.workers)
+        await self.queues[shard].put(json.dumps(update, ensure_ascii=False).encode())
+
+    # ---------- жизненный цикл ----------
+    async def start(self):
+        os.makedirs(self.run_dir, exist_ok=True)
+        for path in (self.ingress_address, self.writer_address):
+            if os.path.exists(path):
+                os.remove(path)  # остался от прошлого запуска
+        self._server = await asyncio.start_unix_server(self._handle_worker, self.ingress_address)
+        writer = await self._spawn(WRITER)
+        self._supervisors.append(asyncio.create_task(self._supervise(WRITER, writer)))
+        await self._wait_for_writer(writer)
+        for index in range(self.workers):
+            process = await self._spawn(WORKER, index)
+            self._supervisors.append(asyncio.create_task(self._supervise(WORKER, process, index)))
+        logger.info(f"Кластер: {self.workers} воркеров, сервис записи {self.writer_address}")
+
+    async def stop(self):
+        """Останавливает воркеры, потом сервис записи: воркеры дописывают своё при выходе."""
+        self._stopping = True
+        for task in self._supervisors:
+            task.cancel()
+        await asyncio.gather(*self._supervisors, return_exceptions=True)
+        workers = [process for (role, _), process in self._processes.items() if role == WORKER]
+        await asyncio.gather(*(self._terminate(process) for process in workers))
+        writer = self._processes.get((WRITER, None))
+        if writer is not None:
+            await self._terminate(writer)
+        for task in list(self._links.values()):
+            task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for path in (self.ingress_address, self.writer_address):
+            if os.path.exists(path):
+                os.remove(path)
+        lost = sum(queue.qsize() for queue in self.queues)
+        if lost:
+            logger.warning(f"Кластер остановлен, не переданы воркерам {lost} апдейтов")
+
+    async def drain(self, timeout=STOP_TIMEOUT):
+        """Ждёт, пока очереди шардов разойдутся по живым воркерам."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # Очередь воркера, который сейчас не подключён, ждать бесполезно
+        while any(self.queues[index].qsize() for index in self._links) and loop.time() < deadline:
+            await asyncio.sleep(0.1)
+
+    # ---------- дочерние процессы ----------
+    async def _spawn(self, role, index=None):
+        env = dict(os.environ)
+        env[ROLE_ENV] = role
+        env[KEY_ENV] = self.authkey.hex()
+        env[RUN_DIR_ENV] = self.run_dir
+        name = WRITER if role == WRITER else f"{WORKER}{index}"
+        if self.log_file is not None:
+            env["LOG_FILE"] = process_log_file(self.log_file, name)
+        if role == WRITER:
+            command = [sys.executable, os.path.abspath(__file__), WRITER, *self.databases]
+        else:
+            env[INDEX_ENV] = str(index)
+            command = [sys.executable, self.script]
+        # Своя сессия: Ctrl-C получает только ingress и гасит детей по порядку
+        process = await asyncio.create_subprocess_exec(*command, env=env, start_new_session=True)
+        self._processes[(role, index)] = process
+        logger.info(f"Запущен {name} (pid {process.pid})")
+        return process
+
+    async def _wait_for_writer(self, process):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STARTUP_TIMEOUT
+        while not os.path.exists(self.writer_address):
+            if process.returncode is not None or loop.time() > deadline:
+                raise RuntimeError("Сервис записи не запустился")
+            await asyncio.sleep(0.05)
+
+    async def _supervise(self, role, process, index=None):
+        while True:
+            code = await process.wait()
+            if self._stopping:
+                return
+            if role == WRITER:
+                logger.error(f"Сервис записи завершился (код {code}), кластер останавливается")
+                self.failed.set()
+                return
+            logger.error(f"Воркер {index} завершился (код {code}), перезапуск")
+            self.restarts += 1
+            await asyncio.sleep(RESTART_DELAY)
+            process = await self._spawn(role, index)
+
+    @staticmethod
+    async def _terminate(process):
+        if process.returncode is not None:
+            return
+        process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Процесс {process.pid} не завершился за {STOP_TIMEOUT} с")
+            process.kill()
+            await process.wait()
+
+    # ---------- соединения воркеров ----------
+    async def _handle_worker(self, reader, writer):
+        try:
+            index = json.loads(await read_frame(reader))["worker"]
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, KeyError):
+            writer.close()
+            return
+        # Перезапущенный воркер сменяет прежнее соединение
+        previous = self._links.get(index)
+        if previous is not None:
+            previous.cancel()
+        self._links[index] = asyncio.current_task()
+        queue = self.queues[index]
+        try:
+            while True:
+                if self._unsent[index] is None:
+                    self._unsent[index] = await queue.get()
+                write_frame(writer, self._unsent[index])
+                await writer.drain()
+                self._unsent[index] = None
+                self.forwarded += 1
+        except (ConnectionError, asyncio.IncompleteReadError):
+            logger.warning(f"Воркер {index} отключился")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self._links.get(index) is asyncio.current_task():
+                del self._links[index]
+            writer.close()
+
+
+async def poll_updates(cluster, token, base_url=None):
+    """getUpdates в цикле, апдейты - в cluster.process_update; до отмены задачи."""
+    url = f"{base_url or 'https://api.telegram.org/bot'}{token}"
+    async with httpx.AsyncClient(timeout=POLL_TIMEOUT + 10) as client:
+        await client.post(f"{url}/deleteWebhook")
+        offset = 0
+        try:
+            while True:
+                try:
+                    response = await client.post(
+                        f"{url}/getUpdates", json={"offset": offset, "timeout": POLL_TIMEOUT}
+                    )
+                    data = response.json()
+                    if not data.get("ok"):
+                        retry_after = data.get("parameters", {}).get("retry_after")
+                        logger.warning(f"getUpdates: {data.get('description')}")
+                        await asyncio.sleep(retry_after or POLL_RETRY_DELAY)
+                        continue
+                except (httpx.HTTPError, ValueError) as e:
+                    logger.warning(f"getUpdates не удался ({e}), повтор через {POLL_RETRY_DELAY} с")
+                    await asyncio.sleep(POLL_RETRY_DELAY)
+                    continue
+                for update in data["result"]:
+                    # Полная очередь шарда задерживает и подтверждение offset
+                    await cluster.process_update(update)
+                    offset = update["update_id"] + 1
+        except asyncio.CancelledError:
+            # Как PTB при остановке: подтверждаем принятое, иначе после рестарта
+            # Telegram пришлёт его снова
+            if offset:
+                try:
+                    await client.post(f"{url}/getUpdates", json={"offset": offset, "timeout": 0, "limit": 1},
+                                      timeout=POLL_RETRY_DELAY)
+                except httpx.HTTPError:
+                    pass
+            raise
+
+
+async def set_webhook(token, url, secret_token=None, base_url=None):
+    api = f"{base_url or 'https://api.telegram.org/bot'}{token}"
+    params = {"url": url, "allowed_updates": Update.ALL_TYPES}
+    if secret_token:
+        params["secret_token"] = secret_token
+    async with httpx.AsyncClient() as client:
+        response = await client.post(f"{api}/setWebhook", json=params)
+        response.raise_for_status()
+
+
+def run_ingress(cluster, source, server=None):
+    """Аналог run_polling/run_webhook для ingress: source - корутина приёма
+    (poll_updates) или None, если апдейты приносит server (WebhookServer)."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stop = asyncio.Event()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    async def main():
+        await cluster.start()
+        receiving = asyncio.create_task(source) if source is not None else None
+        if server is not None:
+            await server.start()
+        waiters = [asyncio.create_task(stop.wait()), asyncio.create_task(cluster.failed.wait())]
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+            if receiving is not None:
+                receiving.cancel()
+                await asyncio.gather(receiving, return_exceptions=True)
+            if server is not None:
+                await server.stop()
+            await cluster.drain()
+            await cluster.stop()
+        return 1 if cluster.failed.is_set() else 0
+
+    try:
+        return loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+class WorkerLink:
+    """Сторона воркера: читает кадры ingress и отдаёт апдейты в application.
+
+    Подставляется в webhook.run_webhook вместо WebhookServer - там нужны
+    только start() и stop(). Пока SequencedApplication занят (max_in_flight),
+    следующий кадр не читается, и очередь копится на стороне ingress.
+    """
+
+    def __init__(self, application, address, index):
+        self.application = application
+        self.address = address
+        self.index = index
+        self._task = None
+        self._writer = None
+
+    async def start(self):
+        reader, self._writer = await asyncio.open_unix_connection(self.address)
+        write_frame(self._writer, json.dumps({"worker": self.index}).encode())
+        await self._writer.drain()
+        self._task = asyncio.create_task(self._read(reader), name="worker-link")
+        logger.info(f"Воркер {self.index} подключён к {self.address}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _read(self, reader):
+        while True:
+            try:
+                data = await read_frame(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                # ingress ушёл - без апдейтов воркеру делать нечего
+                logger.error("Соединение с ingress потеряно, воркер останавливается")
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            try:
+                update = Update.de_json(json.loads(data), self.application.bot)
+            except Exception as e:
+                logger.warning(f"Некорректный апдейт от ingress: {e}")
+                continue
+            await self.application.process_update(update)
+
+
+if __name__ == "__main__":
+    # Сервис записи: python cluster.py writer <db> [<db>...], окружение задаёт Cluster
+    from logs import LOG_FILE, setup_logging
+    from storage import serve_writes
+
+    setup_logging(level=os.getenv("LOG_LEVEL", "INFO").upper(), log_file=os.getenv("LOG_FILE", LOG_FILE),
+                  fmt=os.getenv("LOG_FORMAT", "json").lower())
+    if sys.argv[1:2] != [WRITER]:
+        sys.exit("usage: python cluster.py writer <db> [<db>...]")
+    parent = os.getppid()
+
+    def _orphaned():
+        # ingress убит без остановки кластера - писатель уходит следом
+        while os.getppid() == parent:
+            time.sleep(1)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=_orphaned, name="writer-parent", daemon=True).start()
+    serve_writes(sys.argv[2:], os.path.join(os.environ[RUN_DIR_ENV], WRITER_SOCKET),
+                 bytes.fromhex(os.environ[KEY_ENV]))
@@ -0,0 +1,158 @@
+"""Тексты бота и фото отзывов с перечитыванием config.ini без рестарта.
+
+Тексты ([TEXTS]) и file_id фото отзывов ([REVIEWS] PHOTOS) берутся из
+config.ini, без них - значения по умолчанию ниже. Из них собирается
+неизменяемый снимок Content с готовым списком InputMediaPhoto, и
+обработчики берут content.current один раз в начале: подмена снимка -
+одно присваивание, полусобранного состояния никто не увидит.
+
+Правка config.ini подхватывается через watchdog: файл разбирается в
+потоке, снимок проверяется (длины текстов и подписи, число фото) и
+только потом подменяет текущий; при ошибке остаётся прежний. Прочие
+настройки файла передаются в async on_config - что из них можно
+применить на ходу, решает бот.
+
+Многострочный текст в ini пишется с отступом у строк продолжения:
+
+    [TEXTS]
+    start_format = 👋 Hallo. Schick uns bitte Deine Angaben:
+        📜 Anzahl der Skins:
+"""
+import asyncio
+import configparser
+import logging
+import os
+
+from telegram import InputMediaPhoto
+
+from watch import FileWatcher
+
+logger = logging.getLogger(__name__)
+
+MAX_TEXT_LENGTH = 4096
+MAX_CAPTION_LENGTH = 1024
+MAX_REVIEW_PHOTOS = 10  # больше не влезет в одну медиагруппу
+
+DEFAULT_TEXTS = {
+    "start_intro": (
+        "Grind-Games ist die führende deutsche Seite für den An- und Verkauf von Fortnite Accounts. "
+        "Unser Ziel ist es, jedem User ein faires Angebot für seinen Fortnite Account zukommen zu lassen "
+        "und damit die Möglichkeit zu geben, aus einem alten Fortnite Account noch Geld machen zu können - "
+        "während man gleichzeitig einem künftigen Käufer eine Freude bereiten kann!\n\n"
+        "Wir antworten auf alle Account Anfragen in der Regel innerhalb von wenigen Stunden.\n\n"
+        "Sobald wir uns auf einen Preis geeinigt haben, bereiten wir die Überweisung auf dein Bankkonto direkt vor. "
+        "Es ist durchaus möglich, dass das Geld bereits nach wenigen Stunden bei dir ist und wir geben unser Bestes, "
+        "um dafür zu sorgen, dass alle Auszahlungen an unsere Verkäufer schnellstmöglich ausgeführt werden."
+    ),
+    "start_format": (
+        "👋 Hallo. Schick uns bitte Deine Angaben in diesem Format:\n"
+        "📜 Anzahl der Skins:\n"
+        "💎 OG oder seltene Skins:\n"
+        "📸 Fotos von Deinem Konto\n\n"
+        "Du kannst auch die automatische Verifizierungsmethode verwenden und dein Konto "
+        "durch den Skin Checker überprüfen lassen und uns die Fotos zukommen lassen, "
+        "die du vom Bot in Telegram in nur wenigen Sekunden erhältst.\n@BombSkinCheckerBot"
+    ),
+    "invalid_info": (
+        "👋 Hallo. Schicken Sie uns Ihre Angaben in diesem Format:\n"
+        "📝 Anzahl der Skins:\n"
+        "📝 Og oder seltene Skins:\n"
+        "🖼️ Fotos von Ihrem Konto\n\n"
+        "Oder Sie können die automatische Verifizierungsmethode verwenden, "
+        "das Konto durch den Checker überprüfen und uns die Fotos schicken, "
+        "die Sie vom Bot in Telegramm erhalten.\n@BombSkinCheckerBot"
+    ),
+    "reviews_caption": "📊 Bewertungen unserer Kunden:",
+}
+
+DEFAULT_REVIEW_PHOTOS = (
+    "AgACAgIAAxkBAAICO2hs9wABZdRD-__U8VkQ4-sGQatUMQACKvcxG2gAAWlLHUTK0lkjfD0BAAMCAAN5AAM2BA",
+    "AgACAgIAAxkBAAICPWhs9wVRoEb4YYMCnB3WAUFnKjLPAAIs9zEbaAABaUvP67RaQkhiJgEAAwIAA3kAAzYE",
+)
+
+
+class Content:
+    """Снимок текстов и отзывов; конструктор проверяет значения (ValueError)."""
+
+    __slots__ = ("texts", "review_photos", "review_media")
+
+    def __init__(self, texts, review_photos):
+        for name, text in texts.items():
+            limit = MAX_CAPTION_LENGTH if name == "reviews_caption" else MAX_TEXT_LENGTH
+            if not text or len(text) > limit:
+                raise ValueError(f"текст {name}: нужно от 1 до {limit} символов")
+        if len(review_photos) > MAX_REVIEW_PHOTOS:
+            raise ValueError(f"фото отзывов больше {MAX_REVIEW_PHOTOS}")
+        self.texts = dict(texts)
+        self.review_photos = tuple(review_photos)
+        # Объекты PTB неизменяемы - один список уходит во все отправки галереи
+        self.review_media = tuple(
+            InputMediaPhoto(media=photo_id, caption=texts["reviews_caption"] if i == 0 else None)
+            for i, photo_id in enumerate(review_photos)
+        )
+
+
+def read_config(path):
+    """config.ini без интерполяции: в текстах может быть '%'. Нет файла - пустой."""
+    config = configparser.ConfigParser(interpolation=None)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            config.read_file(f)
+    return config
+
+
+def content_from_config(config):
+    texts = dict(DEFAULT_TEXTS)
+    if config.has_section("TEXTS"):
+        for name, value in config.items("TEXTS"):
+            if name not in texts:
+                raise ValueError(f"неизвестный текст {name}")
+            texts[name] = value.strip()
+    photos = config.get("REVIEWS", "PHOTOS", fallback=None)
+    review_photos = DEFAULT_REVIEW_PHOTOS if photos is None else photos.replace(",", " ").split()
+    return Content(texts, review_photos)
+
+
+def _load(path):
+    config = read_config(path)
+    return config, content_from_config(config)
+
+
+class ContentStore:
+    def __init__(self, path, on_config=None):
+        self.path = path
+        self.on_config = on_config
+        self.current = Content(DEFAULT_TEXTS, DEFAULT_REVIEW_PHOTOS)
+        self._watcher = None
+        # Счётчики для наблюдения
+        self.reloads = 0
+        self.rejected = 0
+
+    def load(self):
+        """Синхронная загрузка при старте; ошибка - остаются значения по умолчанию."""
+        try:
+            _, self.current = _load(self.path)
+        except (configparser.Error, OSError, ValueError) as e:
+            logger.error(f"Тексты из {self.path} не загружены: {e}")
+
+    async def reload(self):
+        try:
+            config, content = await asyncio.to_thread(_load, self.path)
+        except (configparser.Error, OSError, ValueError) as e:
+            self.rejected += 1
+            logger.error(f"{self.path} не применён, остаётся прежний: {e}")
+            return
+        self.current = content
+        self.reloads += 1
+        logger.info(f"{self.path} перечитан")
+        if self.on_config is not None:
+            await self.on_config(config)
+
+    def watch(self):
+        self._watcher = FileWatcher([self.path], self.reload)
+        self._watcher.start()
+
+    def stop_watching(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
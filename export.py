@@ -0,0 +1,175 @@
+"""Выгрузка заявок и переписки в CSV / JSONL (/export).
+
+Строки идут асинхронным генератором страницами по EXPORT_PAGE:
+заявки - по id, сообщения заявки - по (timestamp, id) через индекс
+idx_messages_account (schema v9), keyset-пагинацией без OFFSET. Каждая
+страница читается отдельным запросом в пуле читателей и дописывается во
+временный файл в потоке, так что память не зависит от размера выгрузки,
+а долгий экспорт не держит ни event loop, ни соединение читателя.
+
+Формат строки один для заявки и сообщения (COLUMNS): у заявки kind
+'request', id - номер заявки, text - account_info; вложения - file_id
+через пробел. Заявки, уже ушедшие в архив (archive.py), выгружаются по
+одной, из архивной записи.
+"""
+import asyncio
+import csv
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+EXPORT_PAGE = 500
+EXPORT_CONCURRENCY = 2  # одновременных выгрузок
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024  # больше бот отправить не может
+FORMATS = ("csv", "jsonl")
+COLUMNS = ("account_id", "kind", "id", "timestamp", "author", "username", "text", "attachments")
+
+_ATTACHMENTS = """(SELECT group_concat(file_id, ' ') FROM (
+                       SELECT file_id FROM attachments {where} ORDER BY position))"""
+
+
+def _requests_page(conn, after_id, limit, account_id, date_from, date_to):
+    conditions, params = ["a.id > ?"], [after_id]
+    if account_id is not None:
+        conditions.append("a.id = ?")
+        params.append(account_id)
+    if date_from is not None:
+        conditions.append("a.created_at >= ?")
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append("a.created_at < ?")
+        params.append(date_to)
+    attachments = _ATTACHMENTS.format(where="WHERE account_id = a.id AND message_id IS NULL")
+    return conn.execute(
+        f"SELECT a.id, 'request', a.id, a.created_at, 'user', a.username, a.account_info, {attachments} "
+        f"FROM accounts a WHERE {' AND '.join(conditions)} ORDER BY a.id LIMIT ?",
+        (*params, limit),
+    ).fetchall()
+
+
+def _messages_page(conn, account_id, after, limit):
+    attachments = _ATTACHMENTS.format(where="WHERE message_id = m.id")
+    return conn.execute(
+        f"SELECT m.account_id, 'message', m.id, m.timestamp, "
+        f"CASE WHEN m.from_admin THEN 'admin' ELSE 'user' END, NULL, m.message_text, {attachments} "
+        f"FROM messages m INDEXED BY idx_messages_account "
+        f"WHERE m.account_id = ? AND (m.timestamp, m.id) > (?, ?) "
+        f"ORDER BY m.timestamp, m.id LIMIT ?",
+        (account_id, *after, limit),
+    ).fetchall()
+
+
+async def iter_requests(db, page=EXPORT_PAGE, account_id=None, date_from=None, date_to=None):
+    after_id = 0
+    while True:
+        rows = await db.read(_requests_page, after_id, page, account_id, date_from, date_to)
+        for row in rows:
+            yield row
+        if len(rows) < page:
+            return
+        after_id = rows[-1][2]
+
+
+async def iter_messages(db, account_id, page=EXPORT_PAGE):
+    after = ("", 0)
+    while True:
+        rows = await db.read(_messages_page, account_id, after, page)
+        for row in rows:
+            yield row
+        if len(rows) < page:
+            return
+        after = (rows[-1][3], rows[-1][2])
+
+
+async def iter_export(db, page=EXPORT_PAGE, **filters):
+    """Заявка, за ней её переписка - и так по всем заявкам выборки."""
+    async for request in iter_requests(db, page, **filters):
+        yield request
+        async for message in iter_messages(db, request[0], page):
+            yield message
+
+
+def archived_rows(account):
+    """Строки COLUMNS из архивной записи (archive.py)."""
+    files = {}
+    for attachment in account.get("attachments", ()):
+        files.setdefault(attachment["message_id"], []).append(attachment["file_id"])
+    account_id = account["id"]
+    yield (account_id, "request", account_id, account.get("created_at"), "user",
+           account.get("username"), account.get("account_info"), " ".join(files.get(None, ())) or None)
+    for m in account.get("messages", ()):
+        yield (account_id, "message", m["id"], m["timestamp"], "admin" if m["from_admin"] else "user",
+               None, m["message_text"], " ".join(files.get(m["id"], ())) or None)
+
+
+class _Sink:
+    """Временный файл выгрузки; write() и close() зовутся из потока."""
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+        self.file = tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", newline="", suffix=f".{fmt}", delete=False
+        )
+        self.path = self.file.name
+        self._csv = None
+        if fmt == "csv":
+            self._csv = csv.writer(self.file)
+            self._csv.writerow(COLUMNS)
+
+    def write(self, rows):
+        if self._csv is not None:
+            self._csv.writerows(rows)
+        else:
+            self.file.writelines(
+                json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + "\n" for row in rows
+            )
+
+    def close(self):
+        self.file.close()
+        return os.path.getsize(self.path)
+
+
+class Exporter:
+    def __init__(self, db, page=EXPORT_PAGE, concurrency=EXPORT_CONCURRENCY):
+        self.db = db
+        self.page = page
+        self._slots = asyncio.Semaphore(concurrency)
+        # Счётчики для наблюдения
+        self.exports = 0
+        self.rows_exported = 0
+
+    async def export(self, fmt, rows=None, **filters):
+        """-> (путь к временному файлу, строк, байт); файл удаляет вызывающий.
+
+        rows - готовый (синхронный) итератор строк вместо выборки из БД.
+        """
+        async with self._slots:
+            sink = await asyncio.to_thread(_Sink, fmt)
+            count = 0
+            try:
+                if rows is not None:
+                    batch = list(rows)
+                    await asyncio.to_thread(sink.write, batch)
+                    count = len(batch)
+                else:
+                    batch = []
+                    async for row in iter_export(self.db, self.page, **filters):
+                        batch.append(row)
+                        if len(batch) >= self.page:
+                            await asyncio.to_thread(sink.write, batch)
+                            count += len(batch)
+                            batch = []
+                    if batch:
+                        await asyncio.to_thread(sink.write, batch)
+                        count += len(batch)
+                size = await asyncio.to_thread(sink.close)
+            except BaseException:
+                sink.file.close()
+                os.remove(sink.path)
+                raise
+        self.exports += 1
+        self.rows_exported += count
+        return sink.path, count, size
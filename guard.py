@@ -0,0 +1,200 @@
+"""Защита приёма заявок от флуда и повторных отправок.
+
+Каждая заявка - строка accounts, топик в группе админов и несколько
+вызовов Bot API, поэтому пользователь, который жмёт /start и шлёт одни и
+те же скриншоты по кругу, обходится дорого. IntakeGuard ограничивает:
+
+* апдейты в личке от одного пользователя - token bucket; check()
+  подключается TypeHandler-ом в группу -1, лишнее отбрасывается до всех
+  обработчиков (ApplicationHandlerStop). Альбом (до 10 частей за
+  миллисекунды) стоит как один апдейт: списывается первая часть, судьбу
+  остальных решает она;
+* новые заявки - свой bucket на пользователя и общий на всех, чтобы
+  всплеск не превратился в сотни топиков;
+* повторную отправку той же заявки - по отпечатку (file_unique_id фото,
+  иначе хеш нормализованного текста) в окне DUPLICATE_WINDOW: вместо
+  новой заявки пользователь получает номер уже принятой;
+* галерею отзывов - пауза на пользователя и общий bucket.
+
+Состояние только в памяти и ограничено MAX_TRACKED_USERS: после рестарта
+лимиты начинаются заново, что для защиты от флуда не страшно.
+"""
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+
+from telegram import Chat, Update
+from telegram.ext import ApplicationHandlerStop
+
+from outbound import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+USER_RATE = 1.0              # апдейтов в секунду от одного пользователя
+USER_BURST = 8
+SUBMISSION_RATE = 3 / 3600   # новых заявок одного пользователя в секунду (3 в час)
+SUBMISSION_BURST = 3
+GLOBAL_SUBMISSION_RATE = 0.5  # новых заявок в секунду от всех вместе
+GLOBAL_SUBMISSION_BURST = 30
+DUPLICATE_WINDOW = 600       # секунд, в течение которых повтор не создаёт заявку
+REVIEW_COOLDOWN = 60         # секунд между галереями для одного пользователя
+REVIEW_RATE = 10 / 60        # галерей в секунду от всех вместе
+REVIEW_BURST = 10
+FLOOD_NOTICE_INTERVAL = 30   # не чаще одного предупреждения о флуде
+MAX_TRACKED_USERS = 10000
+
+# Вердикты admit_submission
+ACCEPTED = "accepted"
+DUPLICATE = "duplicate"
+USER_LIMITED = "user_limited"
+GLOBAL_LIMITED = "global_limited"
+
+FLOOD_NOTICE = "⏳ Bitte nicht so schnell. Ihre Nachrichten werden kurz ignoriert."
+
+
+def submission_fingerprint(text, attachments=()):
+    """Отпечаток заявки: набор file_unique_id фото, иначе хеш текста.
+
+    Подпись к тем же скриншотам может отличаться, поэтому при наличии
+    вложений текст не учитывается.
+    """
+    unique_ids = sorted(a.file_unique_id or a.file_id for a in attachments)
+    if unique_ids:
+        return "f:" + ",".join(unique_ids)
+    normalized = " ".join((text or "").casefold().split())
+    return "t:" + hashlib.sha1(normalized.encode()).hexdigest()
+
+
+class _UserState:
+    __slots__ = ("updates", "submissions", "recent", "reviews_at", "noticed_at", "album")
+
+    def __init__(self, guard):
+        self.updates = TokenBucket(guard.user_rate, guard.user_burst)
+        self.submissions = TokenBucket(guard.submission_rate, guard.submission_burst)
+        self.recent = {}  # отпечаток -> (account_id, время)
+        self.reviews_at = None
+        self.noticed_at = None
+        self.album = None  # (media_group_id, пропущен ли) последнего альбома
+
+
+class IntakeGuard:
+    def __init__(
+        self,
+        is_admin,
+        user_rate=USER_RATE,
+        user_burst=USER_BURST,
+        submission_rate=SUBMISSION_RATE,
+        submission_burst=SUBMISSION_BURST,
+        global_submission_rate=GLOBAL_SUBMISSION_RATE,
+        global_submission_burst=GLOBAL_SUBMISSION_BURST,
+        duplicate_window=DUPLICATE_WINDOW,
+        review_cooldown=REVIEW_COOLDOWN,
+        max_users=MAX_TRACKED_USERS,
+        review_rate=REVIEW_RATE,
+        review_burst=REVIEW_BURST,
+    ):
+        self.is_admin = is_admin
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.submission_rate = submission_rate
+        self.submission_burst = submission_burst
+        self.duplicate_window = duplicate_window
+        self.review_cooldown = review_cooldown
+        self.max_users = max_users
+        self._submissions = TokenBucket(global_submission_rate, global_submission_burst)
+        self._reviews = TokenBucket(review_rate, review_burst)
+        self._users = OrderedDict()
+        # Счётчики для наблюдения
+        self.dropped = 0
+        self.duplicates = 0
+        self.limited = 0
+        self.reviews_throttled = 0
+
+    def __len__(self):
+        return len(self._users)
+
+    def _user(self, user_id):
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _UserState(self)
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return state
+
+    # ---------- апдейты ----------
+    async def check(self, update, context):
+        """TypeHandler(Update, ...) в группе -1: флуд в личке дальше не проходит."""
+        if not isinstance(update, Update):
+            return
+        chat, user = update.effective_chat, update.effective_user
+        if chat is None or user is None or chat.type != Chat.PRIVATE or self.is_admin(user.id):
+            return
+        now = time.monotonic()
+        state = self._user(user.id)
+        message = update.effective_message
+        media_group_id = message.media_group_id if message is not None else None
+        if media_group_id is not None and state.album is not None and state.album[0] == media_group_id:
+            # Следующая часть того же альбома: как первая
+            if state.album[1]:
+                return
+            self.dropped += 1
+            raise ApplicationHandlerStop
+        admitted = not state.updates.delay(now)
+        if media_group_id is not None:
+            state.album = (media_group_id, admitted)
+        if admitted:
+            state.updates.take(now)
+            return
+        self.dropped += 1
+        if state.noticed_at is None or now - state.noticed_at >= FLOOD_NOTICE_INTERVAL:
+            state.noticed_at = now
+            logger.warning(f"Флуд от пользователя {user.id}, апдейты отбрасываются")
+            if update.effective_message is not None:
+                try:
+                    await update.effective_message.reply_text(FLOOD_NOTICE)
+                except Exception as e:
+                    logger.warning(f"Не удалось предупредить о флуде: {e}")
+        raise ApplicationHandlerStop
+
+    # ---------- заявки ----------
+    def admit_submission(self, user_id, fingerprint):
+        """-> (вердикт, account_id уже принятой заявки для DUPLICATE)."""
+        now = time.monotonic()
+        state = self._user(user_id)
+        for key in [k for k, (_, at) in state.recent.items() if now - at > self.duplicate_window]:
+            del state.recent[key]
+        previous = state.recent.get(fingerprint)
+        if previous is not None:
+            self.duplicates += 1
+            return DUPLICATE, previous[0]
+        if state.submissions.delay(now):
+            self.limited += 1
+            return USER_LIMITED, None
+        if self._submissions.delay(now):
+            self.limited += 1
+            logger.warning("Общий лимит новых заявок исчерпан")
+            return GLOBAL_LIMITED, None
+        state.submissions.take(now)
+        self._submissions.take(now)
+        return ACCEPTED, None
+
+    def remember_submission(self, user_id, fingerprint, account_id):
+        """Запоминает принятую заявку, чтобы отсеивать её повторы."""
+        self._user(user_id).recent[fingerprint] = (account_id, time.monotonic())
+
+    # ---------- отзывы ----------
+    def admit_reviews(self, user_id):
+        now = time.monotonic()
+        state = self._user(user_id)
+        if state.reviews_at is not None and now - state.reviews_at < self.review_cooldown:
+            self.reviews_throttled += 1
+            return False
+        if self._reviews.delay(now):
+            self.reviews_throttled += 1
+            return False
+        self._reviews.take(now)
+        state.reviews_at = now
+        return True
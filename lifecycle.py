@@ -0,0 +1,164 @@
+"""Жизненный цикл заявки: статусы, закрытие топиков, истечение простоя.
+
+    new -> in_progress -> deal -> paid -> closed
+
+Все статусы, кроме closed, считаются открытыми: только по ним ищется
+активный диалог пользователя и строится очередь админов (частичные
+индексы в schema v5), так что рост истории на маршрутизацию не влияет.
+Первый ответ админа переводит new в in_progress (touch_accounts пишет
+это вместе с перепиской). Закрытие и переоткрытие зеркалятся в
+close_forum_topic / reopen_forum_topic; диалоги без сообщений дольше
+idle_days дней закрываются фоновой задачей.
+"""
+import asyncio
+import logging
+
+from outbound import LANE_BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+NEW = "new"
+IN_PROGRESS = "in_progress"
+DEAL = "deal"
+PAID = "paid"
+CLOSED = "closed"
+STATUSES = (NEW, IN_PROGRESS, DEAL, PAID, CLOSED)
+
+IDLE_TIMEOUT_DAYS = 14
+EXPIRY_INTERVAL = 600  # секунд между проверками простоя
+EXPIRY_BATCH = 50      # заявок за одну проверку, чтобы не забить очередь Bot API
+
+
+def touch_accounts(conn, rows):
+    """Хук TranscriptWriter: отметка активности и new -> in_progress по ответу админа."""
+    conn.executemany(
+        "UPDATE accounts SET last_activity = CURRENT_TIMESTAMP WHERE id = ?",
+        [(account_id,) for account_id in {row[0] for row in rows}],
+    )
+    answered = {row[0] for row in rows if row[1]}
+    if answered:
+        conn.executemany(
+            f"UPDATE accounts SET status = '{IN_PROGRESS}' WHERE id = ? AND status = '{NEW}'",
+            [(account_id,) for account_id in answered],
+        )
+
+
+def _set_status(conn, account_id, status):
+    """-> (старый статус, id, user_id, admin_chat_id, topic_id) или None."""
+    row = conn.execute(
+        "SELECT status, id, user_id, admin_chat_id, topic_id FROM accounts WHERE id = ?",
+        (account_id,),
+    ).fetchone()
+    if row is None or row[0] == status:
+        return row
+    if status == CLOSED:
+        conn.execute("UPDATE accounts SET status = ?, closed_at = CURRENT_TIMESTAMP WHERE id = ?",
+                     (status, account_id))
+    else:
+        conn.execute("UPDATE accounts SET status = ?, closed_at = NULL, "
+                     "last_activity = CURRENT_TIMESTAMP WHERE id = ?", (status, account_id))
+    return row
+
+
+# Условие дословно совпадает с предикатом частичных индексов schema v5 -
+# иначе SQLite не докажет, что индекс применим, и пойдёт по всей таблице
+OPEN_CONDITION = f"status <> '{CLOSED}'"
+
+
+def _idle_accounts(conn, idle_days, limit):
+    return [row[0] for row in conn.execute(
+        f"SELECT id FROM accounts INDEXED BY idx_accounts_open_by_status "
+        f"WHERE {OPEN_CONDITION} AND last_activity < datetime('now', ?) LIMIT ?",
+        (f"-{idle_days} days", limit),
+    )]
+
+
+def _status_counts(conn):
+    return dict(conn.execute(
+        f"SELECT status, COUNT(*) FROM accounts INDEXED BY idx_accounts_open_by_status "
+        f"WHERE {OPEN_CONDITION} GROUP BY status"
+    ).fetchall())
+
+
+class Lifecycle:
+    def __init__(self, db, routes, idle_days=IDLE_TIMEOUT_DAYS, interval=EXPIRY_INTERVAL):
+        self.db = db
+        self.routes = routes
+        self.idle_days = idle_days
+        self.interval = interval
+        self._bot = None
+        self._task = None
+        # Счётчики для наблюдения
+        self.expired = 0
+
+    async def start(self, bot):
+        self._bot = bot
+        if self.idle_days > 0:
+            self._task = asyncio.create_task(self._expiry_loop(), name="lifecycle-expiry")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def transition(self, account_id, status, rate_limit_args=None):
+        """Переводит заявку в status. -> старый статус или None, если заявки нет."""
+        if status not in STATUSES:
+            raise ValueError(f"Неизвестный статус {status}")
+        row = await self.db.write(_set_status, account_id, status)
+        if row is None:
+            return None
+        old, _, user_id, admin_chat_id, topic_id = row
+        if old == status:
+            return old
+        # Активный диалог пользователя мог смениться
+        self.routes.invalidate_user(user_id)
+        if admin_chat_id and topic_id and (old == CLOSED or status == CLOSED):
+            await self._sync_topic(admin_chat_id, topic_id, status, rate_limit_args)
+        return old
+
+    async def _sync_topic(self, admin_chat_id, topic_id, status, rate_limit_args):
+        try:
+            if status == CLOSED:
+                await self._bot.close_forum_topic(
+                    chat_id=admin_chat_id, message_thread_id=topic_id,
+                    rate_limit_args=rate_limit_args,
+                )
+            else:
+                await self._bot.reopen_forum_topic(
+                    chat_id=admin_chat_id, message_thread_id=topic_id,
+                    rate_limit_args=rate_limit_args,
+                )
+        except Exception as e:
+            # Топик могли удалить или уже закрыть руками - статус в БД важнее
+            logger.warning(f"Не удалось обновить топик {topic_id} ({status}): {e}")
+
+    async def counts(self):
+        """Число открытых заявок по статусам."""
+        return await self.db.read(_status_counts)
+
+    async def expire_idle(self):
+        """Закрывает до EXPIRY_BATCH простаивающих диалогов; -> сколько закрыто."""
+        account_ids = await self.db.read(_idle_accounts, self.idle_days, EXPIRY_BATCH)
+        for account_id in account_ids:
+            await self.transition(account_id, CLOSED, rate_limit_args=LANE_BACKGROUND)
+        if account_ids:
+            self.expired += len(account_ids)
+            logger.info(f"Закрыто по простою: {len(account_ids)}")
+        return len(account_ids)
+
+    async def _expiry_loop(self):
+        while True:
+            try:
+                # Полная пачка - скорее всего, есть ещё: следующая сразу
+                if await self.expire_idle() >= EXPIRY_BATCH:
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка закрытия простаивающих диалогов: {e}")
+            await asyncio.sleep(self.interval)
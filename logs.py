@@ -0,0 +1,227 @@
+"""Логирование, которое не блокирует event loop.
+
+Корневой логгер пишет только в очередь (QueueHandler), а форматирование
+и запись в файл / stderr делает QueueListener в своём потоке. В
+обработчике logger.error(...) стоит одного put в очередь; исключение
+форматируется тоже в потоке слушателя.
+
+* Файл - JSON по строке на запись: ts, level, logger, msg и контекст
+  апдейта - update_id, account_id, handler (contextvars; их выставляют
+  sequencer, router и metrics.timed), при исключении - exc.
+* Ротация по размеру и по времени, старые файлы сжимаются gzip, хранится
+  backups последних.
+* Одинаковые предупреждения и ошибки с одного места в коде (файл:строка)
+  пропускаются не больше SAMPLE_BURST за SAMPLE_WINDOW секунд; первая
+  запись следующего окна несёт число отброшенных (suppressed).
+* В stderr (nohup) по умолчанию уходят только предупреждения и ошибки.
+"""
+import atexit
+import contextvars
+import glob
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+
+LOG_FILE = "logs/bot.log"
+LOG_MAX_BYTES = 20 * 1024 * 1024
+LOG_ROTATE_HOURS = 24
+LOG_BACKUPS = 14
+SAMPLE_WINDOW = 60   # секунд
+SAMPLE_BURST = 10    # записей с одного места за окно
+MAX_SAMPLED_SITES = 4096
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+_update_id = contextvars.ContextVar("update_id", default=None)
+_account_id = contextvars.ContextVar("account_id", default=None)
+_handler = contextvars.ContextVar("handler", default=None)
+CONTEXT_FIELDS = ("update_id", "account_id", "handler")
+
+
+# ---------- контекст апдейта ----------
+def bind_update(update_id):
+    """Начало обработки апдейта: остальной контекст сбрасывается."""
+    _update_id.set(update_id)
+    _account_id.set(None)
+    _handler.set(None)
+
+
+def bind_account(account_id):
+    _account_id.set(account_id)
+
+
+def bind_handler(name):
+    _handler.set(name)
+
+
+class ContextFilter(logging.Filter):
+    """Переносит контекст апдейта в запись - пока она ещё в потоке event loop."""
+
+    def filter(self, record):
+        record.update_id = _update_id.get()
+        record.account_id = _account_id.get()
+        record.handler = _handler.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, window=SAMPLE_WINDOW, burst=SAMPLE_BURST, level=logging.WARNING):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.level = level
+        self._sites = {}  # (файл, строка) -> [начало окна, записей, отброшено]
+        self._lock = threading.Lock()  # пишут и потоки SQLite
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or record.created - site[0] >= self.window:
+                if site is None and len(self._sites) >= MAX_SAMPLED_SITES:
+                    self._sites.clear()
+                if site is not None and site[2]:
+                    record.suppressed = site[2]
+                self._sites[key] = [record.created, 1, 0]
+                return True
+            site[1] += 1
+            if site[1] <= self.burst:
+                return True
+            site[2] += 1
+            self.suppressed += 1
+            return False
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+                  + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class CompressingRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    """Ротация по размеру или раз в interval секунд; старый файл -> .gz.
+
+    Имя архива - время ротации (bot.log.20250101-120000.gz), поэтому
+    несколько ротаций по размеру в одном интервале друг друга не затирают.
+    """
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, interval=LOG_ROTATE_HOURS * 3600,
+                 backups=LOG_BACKUPS):
+        super().__init__(filename, "a", encoding="utf-8", delay=True)
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backups = backups
+        self.rollover_at = time.time() + interval if interval > 0 else None
+
+    def shouldRollover(self, record):
+        # До записи - только по времени; размер проверяет emit() после
+        # записи, чтобы не форматировать запись второй раз
+        return self.rollover_at is not None and time.time() >= self.rollover_at
+
+    def emit(self, record):
+        super().emit(record)
+        try:
+            # Файл может перерасти max_bytes на одну запись
+            if self.max_bytes > 0 and self.stream is not None and self.stream.tell() >= self.max_bytes:
+                self.doRollover()
+        except Exception:
+            self.handleError(record)
+
+    def doRollover(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if self.interval > 0:
+            self.rollover_at = time.time() + self.interval
+        if not os.path.exists(self.baseFilename) or not os.path.getsize(self.baseFilename):
+            return
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        target = f"{self.baseFilename}.{stamp}"
+        n = 0
+        while os.path.exists(target + ".gz"):
+            n += 1
+            target = f"{self.baseFilename}.{stamp}.{n}"
+        os.rename(self.baseFilename, target)
+        with open(target, "rb") as source, gzip.open(target + ".gz", "wb") as archive:
+            shutil.copyfileobj(source, archive)
+        os.remove(target)
+        archives = sorted(glob.glob(glob.escape(self.baseFilename) + ".*.gz"), key=os.path.getmtime)
+        for old in archives[:-self.backups] if self.backups > 0 else ():
+            os.remove(old)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Слушатель в этом же процессе: запись кладётся в очередь как есть,
+    без форматирования в потоке event loop (стандартный prepare() форматирует)."""
+
+    def prepare(self, record):
+        return record
+
+
+class _Listener(logging.handlers.QueueListener):
+    """stop() можно звать повторно: при выходе его зовёт ещё и atexit."""
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def setup_logging(level=logging.INFO, log_file=LOG_FILE, fmt="json", max_bytes=LOG_MAX_BYTES,
+                  rotate_hours=LOG_ROTATE_HOURS, backups=LOG_BACKUPS, console_level=logging.WARNING):
+    """Подключает очередь к корневому логгеру; -> QueueListener (останавливается при выходе)."""
+    handlers = []
+    if log_file:
+        directory = os.path.dirname(log_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        file_handler = CompressingRotatingFileHandler(
+            log_file, max_bytes=max_bytes, interval=rotate_hours * 3600, backups=backups
+        )
+        file_handler.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+        handlers.append(file_handler)
+    console = logging.StreamHandler()
+    console.setLevel(console_level if log_file else logging.NOTSET)
+    console.setFormatter(logging.Formatter(TEXT_FORMAT))
+    handlers.append(console)
+
+    log_queue = queue.SimpleQueue()
+    listener = _Listener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    # httpx пишет INFO на каждый вызов Bot API - это самый частый и самый бесполезный поток
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    return listener
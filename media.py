@@ -0,0 +1,202 @@
+"""Сборка медиагрупп (альбомов) из отдельных апдейтов.
+
+Telegram присылает альбом частями - по апдейту на каждый файл, с общим
+media_group_id. Агрегатор копит части и отдаёт альбом целиком:
+
+* сразу, как только набралось 10 элементов (предел Telegram);
+* иначе после паузы, подстроенной под наблюдаемый интервал между
+  частями (EWMA), в пределах [min_delay, max_delay];
+* принудительно, если альбом висит дольше ttl или альбомов в памяти
+  больше max_groups - тогда первым уходит самый старый.
+
+Недособранный альбом может пережить рестарт: on_update(album) вызывается
+после каждой части (например, чтобы сохранить его), on_done(album) -
+после успешной обработки, а restore() отдаёт альбом, поднятый при старте.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+MAX_ALBUM_SIZE = 10       # больше Telegram в один альбом не кладёт
+MEDIA_GROUP_DELAY = 1.0   # пауза, пока ещё не с чем сравнивать
+MIN_DELAY = 0.15
+MAX_DELAY = 1.5
+GAP_FACTOR = 3            # ждём в несколько раз дольше типичного интервала
+GAP_SMOOTHING = 0.2       # вес нового наблюдения в EWMA
+ALBUM_TTL = 30            # секунд
+MAX_GROUPS = 1000
+
+# Вложение сообщения или заявки; строка таблицы attachments
+Attachment = namedtuple(
+    "Attachment", ("media_type", "file_id", "file_unique_id", "position", "caption")
+)
+
+
+# Типы вложений, которые пересылаются между пользователем и админами.
+# animation проверяется раньше document: у GIF заполнены оба поля
+MEDIA_TYPES = ("photo", "video", "animation", "document", "audio", "voice", "video_note", "sticker")
+
+
+def photo_attachment(message, position=0):
+    """Attachment для самого большого размера фото из сообщения."""
+    photo = message.photo[-1]
+    return Attachment("photo", photo.file_id, photo.file_unique_id, position, message.caption or "")
+
+
+def media_type(message):
+    """Тип вложения сообщения из MEDIA_TYPES или None."""
+    for name in MEDIA_TYPES:
+        if getattr(message, name):
+            return name
+    return None
+
+
+def message_attachment(message, position=0):
+    """Attachment для вложения любого типа из MEDIA_TYPES (у фото - самый большой размер)."""
+    name = media_type(message)
+    if name is None:
+        return None
+    if name == "photo":
+        return photo_attachment(message, position)
+    media = getattr(message, name)
+    return Attachment(name, media.file_id, media.file_unique_id, position, message.caption or "")
+
+
+class Album:
+    __slots__ = ("media_group_id", "items", "message_ids", "caption", "meta", "first_seen",
+                 "last_seen", "timer")
+
+    def __init__(self, media_group_id, meta, now):
+        self.media_group_id = media_group_id
+        self.items = []  # Attachment в порядке прихода
+        self.message_ids = []  # id исходных сообщений, если переданы
+        self.caption = ""
+        self.meta = meta
+        self.first_seen = now
+        self.last_seen = now
+        self.timer = None
+
+
+class MediaGroupAggregator:
+    def __init__(
+        self,
+        on_album,
+        initial_delay=MEDIA_GROUP_DELAY,
+        min_delay=MIN_DELAY,
+        max_delay=MAX_DELAY,
+        ttl=ALBUM_TTL,
+        max_groups=MAX_GROUPS,
+        on_update=None,
+        on_done=None,
+    ):
+        self.on_album = on_album
+        self.on_update = on_update
+        self.on_done = on_done
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.ttl = ttl
+        self.max_groups = max_groups
+        self._gap = None
+        self._initial_delay = initial_delay
+        self._albums = OrderedDict()
+        self._tasks = set()
+        # Счётчики для наблюдения
+        self.flushed_full = 0
+        self.flushed_timeout = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._albums)
+
+    def __contains__(self, media_group_id):
+        return media_group_id in self._albums
+
+    @property
+    def delay(self):
+        if self._gap is None:
+            return self._initial_delay
+        return min(self.max_delay, max(self.min_delay, self._gap * GAP_FACTOR))
+
+    def add(self, media_group_id, attachment, meta, message_id=None):
+        """Добавляет часть альбома; meta запоминается по первой части."""
+        now = time.monotonic()
+        self._evict(now)
+        album = self._albums.get(media_group_id)
+        if album is None:
+            album = Album(media_group_id, meta, now)
+            self._albums[media_group_id] = album
+        else:
+            gap = now - album.last_seen
+            self._gap = gap if self._gap is None else (
+                GAP_SMOOTHING * gap + (1 - GAP_SMOOTHING) * self._gap
+            )
+            album.last_seen = now
+        album.items.append(attachment._replace(position=len(album.items)))
+        if message_id is not None:
+            album.message_ids.append(message_id)
+        if attachment.caption and not album.caption:
+            album.caption = attachment.caption
+        if self.on_update is not None:
+            self.on_update(album)
+
+        if album.timer is not None:
+            album.timer.cancel()
+            album.timer = None
+        if len(album.items) >= MAX_ALBUM_SIZE:
+            self.flushed_full += 1
+            self._flush(media_group_id)
+        else:
+            album.timer = asyncio.get_running_loop().call_later(
+                self.delay, self._on_timer, media_group_id
+            )
+
+    def _on_timer(self, media_group_id):
+        self.flushed_timeout += 1
+        self._flush(media_group_id)
+
+    def _evict(self, now):
+        while self._albums:
+            media_group_id, oldest = next(iter(self._albums.items()))
+            if len(self._albums) < self.max_groups and now - oldest.first_seen < self.ttl:
+                break
+            logger.warning(f"Медиагруппа {media_group_id} отправлена принудительно "
+                           f"({len(oldest.items)} шт.)")
+            self.evicted += 1
+            self._flush(media_group_id)
+
+    def _flush(self, media_group_id):
+        album = self._albums.pop(media_group_id, None)
+        if album is None:
+            return
+        if album.timer is not None:
+            album.timer.cancel()
+            album.timer = None
+        task = asyncio.create_task(self._deliver(album))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, album):
+        try:
+            await self.on_album(album)
+        except Exception as e:
+            logger.error(f"Ошибка обработки медиагруппы {album.media_group_id}: {e}")
+            return
+        if self.on_done is not None:
+            self.on_done(album)
+
+    def restore(self, album):
+        """Отдаёт на обработку альбом, собранный до рестарта (части больше не придут)."""
+        if album.media_group_id in self._albums:
+            return
+        self._albums[album.media_group_id] = album
+        self._flush(album.media_group_id)
+
+    async def close(self):
+        """Отдаёт все недособранные альбомы и ждёт их обработки."""
+        for media_group_id in list(self._albums):
+            self._flush(media_group_id)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
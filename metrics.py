@@ -0,0 +1,274 @@
+"""Встроенные метрики: гистограммы задержек, счётчики и глубины очередей.
+
+Что меряется:
+
+* bot_handler_seconds{handler} - время каждого обработчика PTB;
+* bot_sqlite_seconds{db,op,fn} - время запроса в потоке SQLite;
+* bot_api_seconds{method}, bot_api_queue_seconds{lane} - вызов Bot API и
+  ожидание в планировщике исходящих; RetryAfter и ошибки - счётчиками;
+* bot_queue_depth{queue} и прочие значения, которые компоненты уже
+  считают сами, - снимаются в момент выдачи через collect().
+
+Наружу - текст в формате Prometheus (MetricsServer, GET /metrics) и
+краткая сводка для команды /stats. Запись - два perf_counter, bisect и
+короткая блокировка, поэтому метрики можно держать включёнными всегда.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from telegram.ext import ApplicationHandlerStop, ConversationHandler
+
+from logs import bind_handler
+from router import UpdateRouter
+from webhook import InvalidRequest, read_request, write_response
+
+logger = logging.getLogger(__name__)
+
+# Верхние границы корзин, секунды
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_PATH = "/metrics"
+STATS_TOP = 8  # строк в каждом разделе /stats
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # последняя - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля линейной интерполяцией внутри корзины (как histogram_quantile)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                if i == len(BUCKETS):
+                    return BUCKETS[-1]
+                lower = BUCKETS[i - 1] if i else 0.0
+                return lower + (BUCKETS[i] - lower) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()  # observe() зовут и потоки SQLite
+        self._histograms = {}  # name -> (help, label names, {label values: Histogram})
+        self._counters = {}    # name -> (help, label names, {label values: int})
+        self._collectors = []  # (name, type, help, label names, fn -> [(label values, value)])
+
+    # ---------- запись ----------
+    def observe(self, name, labels, seconds, help="", label_names=()):
+        with self._lock:
+            family = self._histograms.get(name)
+            if family is None:
+                family = self._histograms[name] = (help, label_names, {})
+            histogram = family[2].get(labels)
+            if histogram is None:
+                histogram = family[2][labels] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, labels, value=1, help="", label_names=()):
+        with self._lock:
+            family = self._counters.get(name)
+            if family is None:
+                family = self._counters[name] = (help, label_names, {})
+            family[2][labels] = family[2].get(labels, 0) + value
+
+    def collect(self, name, kind, help, label_names, fn):
+        """fn() -> [(значения меток, число)], вызывается при каждой выдаче."""
+        self._collectors.append((name, kind, help, label_names, fn))
+
+    def timed(self, callback, name="bot_handler_seconds"):
+        """Оборачивает async-обработчик PTB: время и число исключений."""
+        labels = (callback.__name__,)
+
+        @functools.wraps(callback)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            bind_handler(labels[0])
+            try:
+                return await callback(*args, **kwargs)
+            except ApplicationHandlerStop:
+                raise  # штатная остановка цепочки обработчиков, не ошибка
+            except Exception:
+                self.inc("bot_handler_errors_total", labels,
+                         help="Исключения, вышедшие из обработчика", label_names=("handler",))
+                raise
+            finally:
+                self.observe(name, labels, time.perf_counter() - started,
+                             help="Время обработчика PTB", label_names=("handler",))
+
+        wrapper.timed = True
+        return wrapper
+
+    def histogram(self, name, labels):
+        family = self._histograms.get(name)
+        return family[2].get(labels) if family else None
+
+    # ---------- выдача ----------
+    def render(self):
+        """Все метрики в текстовом формате Prometheus."""
+        lines = []
+        with self._lock:
+            histograms = {name: (h, n, {k: (list(v.counts), v.sum, v.count) for k, v in s.items()})
+                          for name, (h, n, s) in self._histograms.items()}
+            counters = {name: (h, n, dict(s)) for name, (h, n, s) in self._counters.items()}
+        for name, (help, names, series) in sorted(histograms.items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            for values, (counts, total, count) in sorted(series.items()):
+                cumulative = 0
+                for bound, n in zip((*BUCKETS, "+Inf"), counts):
+                    cumulative += n
+                    le = _labels((*names, "le"), (*values, bound))
+                    lines.append(f"{name}_bucket{le} {cumulative}")
+                lines.append(f"{name}_sum{_labels(names, values)} {total:.6f}")
+                lines.append(f"{name}_count{_labels(names, values)} {count}")
+        for name, (help, names, series) in sorted(counters.items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} counter")
+            for values, value in sorted(series.items()):
+                lines.append(f"{name}{_labels(names, values)} {value}")
+        for name, kind, help, names, fn in self._collectors:
+            try:
+                samples = list(fn())
+            except Exception as e:
+                logger.warning(f"Метрика {name} не собрана: {e}")
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for values, value in samples:
+                lines.append(f"{name}{_labels(names, values)} {value}")
+        lines.append("# HELP bot_uptime_seconds Время с запуска")
+        lines.append("# TYPE bot_uptime_seconds gauge")
+        lines.append(f"bot_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(lines) + "\n"
+
+    def format_stats(self):
+        """Сводка для /stats: самые нагруженные обработчики, запросы и методы API."""
+        uptime = int(time.time() - self.started)
+        lines = [f"📈 Uptime {uptime // 3600} ч {uptime // 60 % 60} мин"]
+        sections = (
+            ("Обработчики", "bot_handler_seconds"),
+            ("SQLite", "bot_sqlite_seconds"),
+            ("Bot API", "bot_api_seconds"),
+        )
+        with self._lock:
+            for title, name in sections:
+                family = self._histograms.get(name)
+                if not family:
+                    continue
+                lines.append(f"\n{title} (n, p50/p95 мс):")
+                top = sorted(family[2].items(), key=lambda kv: kv[1].sum, reverse=True)[:STATS_TOP]
+                for values, histogram in top:
+                    lines.append(
+                        f"• {'/'.join(map(str, values))}: {histogram.count}, "
+                        f"{histogram.quantile(0.5) * 1000:.0f}/{histogram.quantile(0.95) * 1000:.0f}"
+                    )
+            retry_after = self._counters.get("bot_api_retry_after_total")
+            if retry_after:
+                lines.append(f"\n429: {sum(retry_after[2].values())}")
+        for name, kind, help, names, fn in self._collectors:
+            if name != "bot_queue_depth":
+                continue
+            try:
+                depths = ", ".join(f"{values[0]}={value}" for values, value in fn())
+            except Exception:
+                continue
+            lines.append(f"\nОчереди: {depths}")
+        return "\n".join(lines)
+
+
+def instrument_handlers(application, metrics):
+    """Подменяет callback всех зарегистрированных обработчиков на замеряемый."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument(handler, metrics)
+
+
+def _instrument(handler, metrics):
+    if isinstance(handler, ConversationHandler):
+        nested = [*handler.entry_points, *handler.fallbacks]
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for inner in nested:
+            _instrument(inner, metrics)
+        return
+    if isinstance(handler, UpdateRouter):
+        for key, callback in handler.routes.items():
+            if not getattr(callback, "timed", False):
+                handler.routes[key] = metrics.timed(callback)
+        return
+    callback = getattr(handler, "callback", None)
+    if callback is None or getattr(callback, "timed", False):
+        return
+    handler.callback = metrics.timed(callback)
+
+
+class MetricsServer:
+    """GET /metrics в формате Prometheus на отдельном порту."""
+
+    def __init__(self, metrics, listen="127.0.0.1", port=9100):
+        self.metrics = metrics
+        self.listen = listen
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        logger.info(f"Метрики на http://{self.listen}:{self.port}{METRICS_PATH}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, headers, body = request
+            if path.split("?", 1)[0] != METRICS_PATH:
+                write_response(writer, 404, {"ok": False}, keep_alive=False)
+            elif method != "GET":
+                write_response(writer, 405, {"ok": False}, keep_alive=False)
+            else:
+                write_response(writer, 200, self.metrics.render(), keep_alive=False,
+                               content_type=CONTENT_TYPE)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        except InvalidRequest as e:
+            write_response(writer, e.status, {"ok": False}, keep_alive=False)
+        except Exception as e:
+            logger.error(f"Ошибка выдачи метрик: {e}")
+        finally:
+            writer.close()
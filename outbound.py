@@ -0,0 +1,346 @@
+"""Планировщик исходящих запросов к Bot API.
+
+Подключается через Application.builder().rate_limiter(...), поэтому через
+него проходят все вызовы context.bot.* и reply_text. Умеет:
+
+* token bucket на весь бот и отдельный на каждый чат (личка / группа);
+  в группе лимит 20 в минуту считается только для send*: создание и
+  переименование топиков его не тратят, альбом стоит как одно сообщение;
+* полосы приоритета: ответы админов раньше пересылки, пересылка раньше
+  альбомов, альбомы раньше галереи отзывов, фоновые задачи последними. Полоса передаётся через
+  rate_limit_args=LANE_*;
+* строгий порядок внутри чата: в один чат одновременно летит не больше
+  одного запроса;
+* склейку подряд идущих sendMessage в один чат, пока они ждут очереди;
+* повтор после RetryAfter с паузой ровно на retry_after для этого чата;
+  заодно вдвое снижается скорость его bucket - лимит ужесточают реальные
+  ответы 429, а не догадки заранее.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Полосы приоритета: меньше - раньше. Нумерация с 1: ExtBot выбрасывает
+# ложный rate_limit_args, и полоса 0 доходила бы сюда как None
+LANE_ADMIN = 1    # ответы админов пользователю
+LANE_RELAY = 2    # пересылка сообщений и всё остальное по умолчанию
+LANE_ALBUM = 3    # пересылка альбомов
+LANE_REVIEWS = 4  # галерея отзывов
+LANE_BACKGROUND = 5  # фоновые задачи: запас топиков и т.п.
+LANES = 5
+
+OVERALL_RATE = 30         # сообщений в секунду на весь бот
+PRIVATE_RATE = 1.0        # сообщений в секунду в один личный чат
+PRIVATE_BURST = 3
+GROUP_RATE = 20 / 60      # 20 сообщений в минуту в одну группу
+GROUP_BURST = 20
+MIN_CHAT_RATE = 1 / 60    # ниже RetryAfter скорость чата не опускает
+MAX_RETRIES = 5
+MAX_MESSAGE_LENGTH = 4096
+COALESCE_SEPARATOR = "\n\n"
+SHUTDOWN_DRAIN_TIMEOUT = 10
+MAX_IDLE_BUCKETS = 1024
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен (0 - уже сейчас)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def tighten(self, now, min_rate):
+        """После RetryAfter: вдвое реже и без накопленного запаса."""
+        self._refill(now)
+        self.rate = max(min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Pending:
+    __slots__ = ("lane", "chat", "endpoint", "data", "callback", "args", "kwargs",
+                 "future", "followers", "retries", "queued_at")
+
+    def __init__(self, lane, chat, endpoint, data, callback, args, kwargs, future):
+        self.lane = lane
+        self.chat = chat
+        self.endpoint = endpoint
+        self.data = data
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.followers = []  # склеенные с этим запросом
+        self.retries = 0
+        self.queued_at = time.monotonic()
+
+
+def _chat_key(data):
+    chat_id = data.get("chat_id")
+    if chat_id is None:
+        return None
+    try:
+        return int(chat_id)
+    except (TypeError, ValueError):
+        return chat_id  # @username канала/группы
+
+
+def _is_group(chat):
+    return isinstance(chat, str) or chat < 0
+
+
+def _throttled(item):
+    """Тратит ли запрос bucket своего чата: в группе - только send*."""
+    return not _is_group(item.chat) or item.endpoint.startswith("send")
+
+
+class OutboundScheduler(BaseRateLimiter):
+    def __init__(
+        self,
+        overall_rate=OVERALL_RATE,
+        private_rate=PRIVATE_RATE,
+        private_burst=PRIVATE_BURST,
+        group_rate=GROUP_RATE,
+        group_burst=GROUP_BURST,
+        max_retries=MAX_RETRIES,
+        coalesce=True,
+        metrics=None,
+    ):
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.coalesce = coalesce
+        self.metrics = metrics  # metrics.Metrics: время вызовов и ожидания в очереди
+        self._global = TokenBucket(overall_rate, overall_rate)
+        self._buckets = {}
+        self._blocked_until = {}
+        self._in_flight = set()
+        self._lanes = [deque() for _ in range(LANES)]
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Счётчики для наблюдения
+        self.sent = 0
+        self.retried = 0
+        self.coalesced = 0
+
+    # ---------- BaseRateLimiter ----------
+    async def initialize(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch(), name="outbound-scheduler")
+
+    async def shutdown(self):
+        # Дадим очереди доразослаться, но не бесконечно
+        deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+        while (self.pending() or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for lane in self._lanes:
+            while lane:
+                item = lane.popleft()
+                for pending in (item, *item.followers):
+                    if not pending.future.done():
+                        pending.future.cancel()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        lane = LANE_RELAY if rate_limit_args is None else int(rate_limit_args)
+        item = _Pending(
+            lane=min(max(lane, LANE_ADMIN), LANE_BACKGROUND),
+            chat=_chat_key(data),
+            endpoint=endpoint,
+            data=data,
+            callback=callback,
+            args=args,
+            kwargs=kwargs,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        self._lanes[item.lane - LANE_ADMIN].append(item)
+        self._wakeup.set()
+        return await item.future
+
+    def pending(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    # ---------- выбор следующего запроса ----------
+    def _bucket(self, chat, now):
+        bucket = self._buckets.get(chat)
+        if bucket is None:
+            if len(self._buckets) > MAX_IDLE_BUCKETS:
+                for key in [k for k, b in self._buckets.items() if b.is_full(now)]:
+                    del self._buckets[key]
+                for key in [k for k, t in self._blocked_until.items() if t <= now]:
+                    del self._blocked_until[key]
+            if _is_group(chat):
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, self.private_burst)
+            self._buckets[chat] = bucket
+        return bucket
+
+    def _pick(self, now):
+        """Возвращает (запрос, None) или (None, сколько ждать)."""
+        earliest = None
+        # None - запросы без чата; их RetryAfter тормозит весь бот
+        global_delay = max(self._global.delay(now), self._blocked_until.get(None, 0) - now)
+        if global_delay > 0:
+            return None, global_delay
+        skipped = set()
+        for lane in self._lanes:
+            for item in lane:
+                chat = item.chat
+                if chat is not None:
+                    if chat in skipped:
+                        continue
+                    if chat in self._in_flight:
+                        skipped.add(chat)
+                        continue
+                    wait = self._blocked_until.get(chat, 0) - now
+                    if _throttled(item):
+                        wait = max(wait, self._bucket(chat, now).delay(now))
+                    if wait > 0:
+                        skipped.add(chat)
+                        earliest = wait if earliest is None else min(earliest, wait)
+                        continue
+                global_delay = self._global.delay(now)
+                if global_delay > 0:
+                    return None, global_delay
+                lane.remove(item)
+                return item, None
+        return None, earliest
+
+    def _coalesce(self, item):
+        """Дописывает в item следующие sendMessage в тот же чат из той же полосы."""
+        lane = self._lanes[item.lane - LANE_ADMIN]
+        base = {k: v for k, v in item.data.items() if k != "text"}
+        text = item.data.get("text") or ""
+        merged = []
+        for other in lane:
+            if other.chat != item.chat:
+                continue
+            if other.endpoint != "sendMessage":
+                break
+            if {k: v for k, v in other.data.items() if k != "text"} != base:
+                break
+            extra = other.data.get("text") or ""
+            if len(text) + len(COALESCE_SEPARATOR) + len(extra) > MAX_MESSAGE_LENGTH:
+                break
+            text += COALESCE_SEPARATOR + extra
+            merged.append(other)
+        if merged:
+            for other in merged:
+                lane.remove(other)
+            item.data["text"] = text
+            item.followers.extend(merged)
+            self.coalesced += len(merged)
+
+    async def _dispatch(self):
+        while True:
+            item, wait = self._pick(time.monotonic())
+            if item is None:
+                self._wakeup.clear()
+                if wait is None:
+                    await self._wakeup.wait()
+                else:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            if self.coalesce and item.endpoint == "sendMessage" and item.chat is not None:
+                self._coalesce(item)
+            now = time.monotonic()
+            self._global.take(now)
+            if item.chat is not None:
+                if _throttled(item):
+                    self._bucket(item.chat, now).take(now)
+                self._in_flight.add(item.chat)
+            if self.metrics is not None:
+                self.metrics.observe(
+                    "bot_api_queue_seconds", (item.lane,), now - item.queued_at,
+                    help="Ожидание запроса в планировщике исходящих", label_names=("lane",),
+                )
+            asyncio.create_task(self._send(item))
+
+    def _count(self, name, item, help):
+        if self.metrics is not None:
+            self.metrics.inc(name, (item.endpoint,), help=help, label_names=("method",))
+
+    async def _send(self, item):
+        started = time.perf_counter()
+        try:
+            result = await item.callback(*item.args, **item.kwargs)
+        except RetryAfter as e:
+            self._count("bot_api_retry_after_total", item, "Ответы 429 (RetryAfter)")
+            if item.retries < self.max_retries:
+                item.retries += 1
+                self.retried += 1
+                logger.warning(
+                    f"RetryAfter {e.retry_after} с для {item.endpoint} в {item.chat}, "
+                    f"повтор {item.retries}/{self.max_retries}"
+                )
+                now = time.monotonic()
+                self._blocked_until[item.chat] = now + e.retry_after + 0.1
+                if item.chat is not None:
+                    self._bucket(item.chat, now).tighten(now, MIN_CHAT_RATE)
+                # Вперёд своей полосы, чтобы не нарушить порядок в чате
+                self._lanes[item.lane - LANE_ADMIN].appendleft(item)
+            else:
+                self._resolve(item, exception=e)
+        except Exception as e:
+            self._count("bot_api_errors_total", item, "Вызовы Bot API, завершившиеся ошибкой")
+            self._resolve(item, exception=e)
+        else:
+            self.sent += 1
+            self._resolve(item, result=result)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe(
+                    "bot_api_seconds", (item.endpoint,), time.perf_counter() - started,
+                    help="Время вызова Bot API", label_names=("method",),
+                )
+            self._in_flight.discard(item.chat)
+            self._wakeup.set()
+
+    @staticmethod
+    def _resolve(item, result=None, exception=None):
+        for pending in (item, *item.followers):
+            if pending.future.done():
+                continue
+            if exception is not None:
+                pending.future.set_exception(exception)
+            else:
+                pending.future.set_result(result)
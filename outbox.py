@@ -0,0 +1,270 @@
+"""Надёжная доставка пересылаемых сообщений (transactional outbox).
+
+Обработчик больше не отправляет сообщение сам: запись о доставке
+кладётся в таблицу outbox в той же транзакции, что и строка переписки
+(TranscriptWriter), и обработчик сразу возвращается. Диспетчер забирает
+созревшие записи пачками и доставляет их в фоне:
+
+* в один чат - строго по порядку: пока запись ждёт повтора, следующие за
+  ней в тот же чат не отправляются; разные чаты доставляются параллельно;
+* сетевые ошибки и таймауты - повтор с удваивающейся паузой (RetryAfter
+  уже отработал планировщик исходящих); BadRequest / Forbidden (бот
+  заблокирован, исходное сообщение удалено) повтором не лечатся - запись
+  сразу становится dead, отправитель получает уведомление;
+* ключ идемпотентности - исходное сообщение (chat:message_id) или альбом:
+  апдейт, пришедший повторно после падения, не создаст ни второй записи,
+  ни второй строки переписки. Доставленные ключи помнятся KEEP_SENT;
+* при старте всё, что осталось pending, просто подхватывается
+  диспетчером - никакой отдельной процедуры восстановления нет.
+
+Доставка at-least-once: если процесс упадёт между вызовом Bot API и
+отметкой sent, запись уйдёт ещё раз.
+
+В многопроцессном режиме (cluster.py) запись помечается номером
+поставившего её воркера (shard) и доставляется им же. Диалог делится
+между воркерами по направлениям: сообщения пользователя (шард по
+user_id) уходят в топик, ответы админов (шард по topic_id) - в личку,
+и каждое направление ставит и доставляет один воркер, так что порядок
+внутри направления сохраняется. Между направлениями порядок не
+гарантирован - например, уведомление о недоставленном ответе может
+попасть в топик раньше или позже соседних сообщений пользователя.
+Фильтр shard % shards, поэтому после уменьшения числа воркеров записи
+исчезнувших подхватывают оставшиеся.
+"""
+import asyncio
+import json
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden
+
+from outbound import LANE_BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+SENT = "sent"
+DEAD = "dead"
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 8
+RETRY_DELAY = 2.0        # секунд, удваивается с каждой попыткой
+MAX_RETRY_DELAY = 300
+POLL_INTERVAL = 30       # секунд ожидания, если будить некому
+KEEP_SENT = "-1 day"     # сколько помнить ключи доставленных записей
+PRUNE_INTERVAL = 3600
+MAX_ERROR_LENGTH = 500
+
+
+def outbox_entry(idem_key, chat_id, kind, notice=None, **payload):
+    """Запись для TranscriptWriter.enqueue(..., delivery=...).
+
+    kind и payload разбирает функция доставки (relay.deliver); notice -
+    kwargs send_message, которое уйдёт, если запись доставить не удалось.
+    """
+    payload = {"chat_id": chat_id, **payload}
+    if notice is not None:
+        payload["notice"] = notice
+    return idem_key, chat_id, kind, json.dumps(payload, ensure_ascii=False)
+
+
+def message_key(message):
+    """Ключ идемпотентности для доставки, порождённой сообщением message."""
+    return f"{message.chat_id}:{message.message_id}"
+
+
+def insert_outbox(conn, account_id, entry, shard=0):
+    """-> False, если та же доставка уже записана (апдейт пришёл повторно).
+
+    Повтор - это совпадение и ключа, и содержимого. Запись с занятым
+    ключом, но другим payload не доставляется, но возвращает True: строка
+    переписки для неё всё равно должна быть сохранена.
+    """
+    idem_key, chat_id, kind, payload = entry
+    if conn.execute(
+        "INSERT OR IGNORE INTO outbox (idem_key, account_id, chat_id, kind, payload, shard) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (idem_key, account_id, chat_id, kind, payload, shard)).rowcount > 0:
+        return True
+    row = conn.execute("SELECT kind, payload FROM outbox WHERE idem_key = ?", (idem_key,)).fetchone()
+    if row is not None and row == (kind, payload):
+        return False
+    logger.warning(f"Ключ доставки {idem_key} уже занят другим сообщением")
+    return True
+
+
+# Предикат status = 'pending' дословно совпадает с частичными индексами schema v7
+def _due(conn, now, busy_chats, limit, shard, shards):
+    """Созревшие записи по порядку, кроме чатов, где доставка уже идёт или
+    более ранняя запись ждёт повтора."""
+    return conn.execute(
+        """SELECT id, chat_id, kind, payload, attempts
+           FROM outbox INDEXED BY idx_outbox_due
+           WHERE status = 'pending' AND next_attempt <= ? AND shard % ? = ?
+             AND chat_id NOT IN (SELECT value FROM json_each(?))
+             AND NOT EXISTS (
+                 SELECT 1 FROM outbox AS head INDEXED BY idx_outbox_chat
+                 WHERE head.status = 'pending' AND head.chat_id = outbox.chat_id
+                   AND head.shard % ? = ?
+                   AND head.id < outbox.id AND head.next_attempt > ?)
+           ORDER BY id LIMIT ?""",
+        (now, shards, shard, json.dumps(busy_chats), shards, shard, now, limit),
+    ).fetchall()
+
+
+def _backlog(conn, now, shard, shards):
+    """-> (сколько ждёт доставки, когда созреет ближайший повтор или None)."""
+    return conn.execute(
+        "SELECT COUNT(*), MIN(CASE WHEN next_attempt > ? THEN next_attempt END) "
+        "FROM outbox INDEXED BY idx_outbox_due WHERE status = 'pending' AND shard % ? = ?",
+        (now, shards, shard),
+    ).fetchone()
+
+
+def _mark_sent(conn, entry_id):
+    conn.execute(f"UPDATE outbox SET status = '{SENT}', attempts = attempts + 1 WHERE id = ?",
+                 (entry_id,))
+
+
+def _mark_retry(conn, entry_id, attempts, next_attempt, error):
+    conn.execute("UPDATE outbox SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                 (attempts, next_attempt, error, entry_id))
+
+
+def _mark_dead(conn, entry_id, attempts, error):
+    conn.execute(f"UPDATE outbox SET status = '{DEAD}', attempts = ?, last_error = ? WHERE id = ?",
+                 (attempts, error, entry_id))
+
+
+def _prune_sent(conn, keep):
+    return conn.execute(
+        "DELETE FROM outbox INDEXED BY idx_outbox_sent "
+        "WHERE status = 'sent' AND created_at < datetime('now', ?)",
+        (keep,),
+    ).rowcount
+
+
+class Outbox:
+    """deliver(bot, kind, payload) отправляет одну запись; исключение - повтор."""
+
+    def __init__(self, db, deliver, batch_size=BATCH_SIZE, max_attempts=MAX_ATTEMPTS,
+                 retry_delay=RETRY_DELAY, keep_sent=KEEP_SENT, shard=0, shards=1):
+        self.db = db
+        self.deliver = deliver
+        self.shard = shard
+        self.shards = shards
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.keep_sent = keep_sent
+        self._bot = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._workers = {}  # chat_id -> задача, доставляющая в этот чат
+        self._pruned_at = 0.0
+        # Счётчики для наблюдения
+        self.backlog = 0
+        self.delivered = 0
+        self.retried = 0
+        self.dead = 0
+
+    def __len__(self):
+        return self.backlog
+
+    def wake(self, *args):
+        """Хук TranscriptWriter.on_commit: в outbox появились записи."""
+        self._wakeup.set()
+
+    async def start(self, bot):
+        self._bot = bot
+        self._task = asyncio.create_task(self._run(), name="outbox-dispatcher")
+
+    async def close(self):
+        """Останавливает доставку; недоставленное останется pending до следующего старта."""
+        tasks = [task for task in (self._task, *self._workers.values()) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._workers.clear()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                timeout = await self._dispatch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка диспетчера outbox: {e}")
+                timeout = POLL_INTERVAL
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _dispatch(self):
+        """Раздаёт созревшие записи по чатам; -> через сколько секунд смотреть снова."""
+        now = time.time()
+        if now - self._pruned_at > PRUNE_INTERVAL:
+            self._pruned_at = now
+            await self.db.write(_prune_sent, self.keep_sent)
+        rows = await self.db.read(_due, now, list(self._workers), self.batch_size,
+                                  self.shard, self.shards)
+        by_chat = {}
+        for row in rows:
+            by_chat.setdefault(row[1], []).append(row)
+        for chat_id, entries in by_chat.items():
+            task = asyncio.create_task(self._deliver_chat(entries), name=f"outbox:{chat_id}")
+            self._workers[chat_id] = task
+            task.add_done_callback(lambda task, chat_id=chat_id: self._worker_done(chat_id, task))
+        self.backlog, next_due = await self.db.read(_backlog, now, self.shard, self.shards)
+        if len(rows) >= self.batch_size:
+            return 0
+        # Созревшие записи занятых чатов разбудит завершение их доставки
+        if next_due is None:
+            return POLL_INTERVAL
+        return min(POLL_INTERVAL, max(0.0, next_due - time.time()))
+
+    def _worker_done(self, chat_id, task):
+        self._workers.pop(chat_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка доставки в чат {chat_id}: {task.exception()}")
+        self._wakeup.set()
+
+    async def _deliver_chat(self, entries):
+        for entry_id, chat_id, kind, payload, attempts in entries:
+            payload = json.loads(payload)
+            attempts += 1
+            try:
+                await self.deliver(self._bot, kind, payload)
+            except (BadRequest, Forbidden) as e:
+                await self._give_up(entry_id, attempts, payload, e)
+                continue
+            except Exception as e:
+                if attempts >= self.max_attempts:
+                    await self._give_up(entry_id, attempts, payload, e)
+                    continue
+                delay = min(MAX_RETRY_DELAY, self.retry_delay * 2 ** (attempts - 1))
+                logger.warning(f"Доставка #{entry_id} в чат {chat_id}: попытка {attempts} "
+                               f"не удалась ({e}), повтор через {delay} с")
+                await self.db.write(_mark_retry, entry_id, attempts, time.time() + delay,
+                                    str(e)[:MAX_ERROR_LENGTH])
+                self.retried += 1
+                return  # остальные записи этого чата ждут эту
+            await self.db.write(_mark_sent, entry_id)
+            self.delivered += 1
+
+    async def _give_up(self, entry_id, attempts, payload, error):
+        logger.error(f"Доставка #{entry_id} в чат {payload['chat_id']} не удалась "
+                     f"после {attempts} попыток: {error}")
+        await self.db.write(_mark_dead, entry_id, attempts, str(error)[:MAX_ERROR_LENGTH])
+        self.dead += 1
+        notice = payload.get("notice")
+        if notice is None:
+            return
+        try:
+            await self._bot.send_message(**notice, rate_limit_args=LANE_BACKGROUND)
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить о недоставленной записи #{entry_id}: {e}")
@@ -0,0 +1,284 @@
+"""Состояние PTB в SQLite: разговоры, user_data / chat_data / bot_data и задачи.
+
+Подключается через Application.builder().persistence(...). PTB сам
+отслеживает, что изменилось с прошлого прохода (затронутые пользователи
+и чаты, записанные состояния ConversationHandler), и раз в
+update_interval вызывает update_* только для них. Здесь эти вызовы не
+пишут по отдельности, а копятся в буфере «ключ -> значение» и уходят
+одной транзакцией на проход: повторная запись того же ключа до commit
+просто заменяет значение. Каждое значение - отдельная строка в JSON,
+а не общий pickle всего состояния.
+
+Загрузка при старте дешёвая: читаются только незавершённые разговоры
+(завершённые удаляются, брошенные дольше CONVERSATION_TTL - тоже) и
+bot_data. user_data / chat_data поднимаются лениво - при первом апдейте
+пользователя или чата, через refresh_user_data / refresh_chat_data.
+
+Задачи (jobs) - то, что бот держит в памяти между апдейтами и что
+должно пережить рестарт, например недособранные альбомы: save_job /
+drop_job из синхронного кода, load_jobs при старте. Задача помечена
+номером воркера (shard), и в кластере каждый воркер поднимает только
+свои.
+"""
+import asyncio
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+UPDATE_INTERVAL = 5             # секунд между проходами PTB по изменившимся ключам
+CONVERSATION_TTL = "-7 days"    # брошенные разговоры при старте не поднимаются
+RETRY_DELAY = 1.0               # секунд до повтора упавшего commit, удваивается
+MAX_RETRY_DELAY = 60
+FLUSH_ATTEMPTS = 3              # попыток дописать буфер при остановке
+
+# Таблицы буфера: имя -> (таблица, столбцы ключа)
+_TABLES = {
+    "conversations": ("conversations", ("name", "key")),
+    "user_data": ("user_data", ("user_id",)),
+    "chat_data": ("chat_data", ("chat_id",)),
+    "kv": ("kv", ("name",)),
+    "jobs": ("jobs", ("kind", "key", "shard")),
+}
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def _apply(conn, changes):
+    """changes: [((таблица, ключ), значение или None - удалить)] одной транзакцией."""
+    for (name, key), value in changes:
+        table, columns = _TABLES[name]
+        key = key if isinstance(key, tuple) else (key,)
+        if value is None:
+            where = " AND ".join(f"{column} = ?" for column in columns)
+            conn.execute(f"DELETE FROM {table} WHERE {where}", key)
+        else:
+            placeholders = ", ".join("?" * (len(columns) + 1))
+            conn.execute(
+                f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}, data, updated_at) "
+                f"VALUES ({placeholders}, CURRENT_TIMESTAMP)",
+                (*key, value),
+            )
+
+
+def _load_conversations(conn, name, ttl):
+    conn.execute("DELETE FROM conversations WHERE name = ? AND updated_at < datetime('now', ?)",
+                 (name, ttl))
+    return conn.execute("SELECT key, data FROM conversations WHERE name = ?", (name,)).fetchall()
+
+
+def _load_one(conn, table, column, key):
+    row = conn.execute(f"SELECT data FROM {table} WHERE {column} = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _load_kv(conn, name):
+    return _load_one(conn, "kv", "name", name)
+
+
+def _load_jobs(conn, kind, shard, shards):
+    return conn.execute(
+        "SELECT key, data FROM jobs WHERE kind = ? AND shard % ? = ? ORDER BY updated_at",
+        (kind, shards, shard)).fetchall()
+
+
+class SQLitePersistence(BasePersistence):
+    """BasePersistence поверх storage.Database (отдельный файл state.db).
+
+    Данные должны сериализоваться в JSON: ключи user_data / chat_data
+    возвращаются строками, как и положено JSON-объектам.
+    """
+
+    def __init__(self, db, store_data=None, update_interval=UPDATE_INTERVAL,
+                 conversation_ttl=CONVERSATION_TTL, shard=0, shards=1):
+        super().__init__(
+            store_data=store_data or PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db = db
+        self.conversation_ttl = conversation_ttl
+        self.shard = shard  # номер воркера для задач
+        self.shards = shards
+        self._dirty = {}
+        self._commit = None
+        self._retry = None
+        self._failures_in_row = 0
+        # Чьи данные уже подняты из БД (или записаны в этом процессе) и у кого
+        # есть непустая строка: пустые данные без строки не пишутся вовсе
+        self._loaded_users = set()
+        self._loaded_chats = set()
+        self._stored_users = set()
+        self._stored_chats = set()
+        self._kv = {}  # последние записанные bot_data / callback_data
+        # Счётчики для наблюдения
+        self.commits = 0
+        self.keys_written = 0
+        self.failures = 0
+
+    # ---------- буфер изменений ----------
+    def _stage(self, name, key, value):
+        self._dirty[(name, key)] = None if value is None else _dumps(value)
+        if self._commit is None:
+            self._commit = asyncio.ensure_future(self._commit_staged())
+        return self._commit
+
+    async def _write(self, name, key, value):
+        # shield: отмена одного update_* не должна отменять общий commit
+        await asyncio.shield(self._stage(name, key, value))
+
+    async def _commit_staged(self):
+        # PTB запускает update_* прохода разом - даём им всем попасть в буфер
+        await asyncio.sleep(0)
+        changes, self._dirty = self._dirty, {}
+        self._commit = None
+        try:
+            await self.db.write(_apply, list(changes.items()))
+        except Exception as e:
+            # Вернём в буфер то, что не успели переписать заново, - уйдёт со
+            # следующим commit или с повтором, если новых изменений не будет
+            self._dirty = {**changes, **self._dirty}
+            self.failures += 1
+            self._failures_in_row += 1
+            delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (self._failures_in_row - 1))
+            logger.error(f"Ошибка записи состояния ({len(changes)} ключей), повтор через {delay} с: {e}")
+            if self._retry is None:
+                self._retry = asyncio.ensure_future(self._retry_later(delay))
+            return
+        self._failures_in_row = 0
+        self.commits += 1
+        self.keys_written += len(changes)
+
+    async def _retry_later(self, delay):
+        await asyncio.sleep(delay)
+        self._retry = None
+        if self._dirty and self._commit is None:
+            self._commit = asyncio.ensure_future(self._commit_staged())
+
+    def pending(self):
+        """Сколько ключей ждут commit (не __len__: PTB проверяет persistence на истинность)."""
+        return len(self._dirty)
+
+    # ---------- разговоры ----------
+    async def get_conversations(self, name):
+        rows = await self.db.write(_load_conversations, name, self.conversation_ttl)
+        return {tuple(json.loads(key)): json.loads(data) for key, data in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        # None - разговор завершён, строка больше не нужна
+        await self._write("conversations", (name, _dumps(list(key))), new_state)
+
+    # ---------- user_data / chat_data: ленивая загрузка ----------
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def _refresh(self, name, column, key, data, loaded, stored):
+        if key in loaded:
+            return
+        loaded.add(key)
+        row = await self.db.read(_load_one, name, column, key)
+        if row is not None:
+            stored.add(key)
+            data.update(json.loads(row))
+
+    async def _update(self, name, key, data, loaded, stored):
+        loaded.add(key)
+        if data:
+            stored.add(key)
+        elif key in stored:
+            stored.discard(key)
+        else:
+            return  # пусто и в БД ничего нет - писать нечего
+        await self._write(name, key, data or None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh("user_data", "user_id", user_id, user_data,
+                            self._loaded_users, self._stored_users)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh("chat_data", "chat_id", chat_id, chat_data,
+                            self._loaded_chats, self._stored_chats)
+
+    async def update_user_data(self, user_id, data):
+        await self._update("user_data", user_id, data, self._loaded_users, self._stored_users)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._update("chat_data", chat_id, data, self._loaded_chats, self._stored_chats)
+
+    async def drop_user_data(self, user_id):
+        self._loaded_users.discard(user_id)
+        self._stored_users.discard(user_id)
+        await self._write("user_data", user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._loaded_chats.discard(chat_id)
+        self._stored_chats.discard(chat_id)
+        await self._write("chat_data", chat_id, None)
+
+    # ---------- bot_data / callback_data ----------
+    async def _update_kv(self, name, data):
+        # PTB отдаёт bot_data на каждом проходе, даже если она не менялась
+        if self._kv.get(name) == data:
+            return
+        self._kv[name] = data
+        await self._write("kv", name, data)
+
+    async def get_bot_data(self):
+        data = await self.db.read(_load_kv, "bot_data")
+        self._kv["bot_data"] = json.loads(data) if data is not None else {}
+        return self._kv["bot_data"]
+
+    async def refresh_bot_data(self, bot_data):
+        pass  # bot_data живёт в памяти целиком и поднимается при старте
+
+    async def update_bot_data(self, data):
+        await self._update_kv("bot_data", data)
+
+    async def get_callback_data(self):
+        data = await self.db.read(_load_kv, "callback_data")
+        return tuple(json.loads(data)) if data is not None else None
+
+    async def update_callback_data(self, data):
+        await self._update_kv("callback_data", data)
+
+    # ---------- задачи ----------
+    def save_job(self, kind, key, data):
+        """Запоминает задачу; запись уйдёт в фоне вместе с остальным буфером."""
+        self._stage("jobs", (kind, str(key), self.shard), data)
+
+    def drop_job(self, kind, key):
+        self._stage("jobs", (kind, str(key), self.shard), None)
+
+    async def load_jobs(self, kind):
+        """[(ключ, данные)] сохранённых задач вида kind этого воркера (shard
+        по модулю shards), от давно обновлённых к свежим."""
+        return [(key, json.loads(data))
+                for key, data in await self.db.read(_load_jobs, kind, self.shard, self.shards)]
+
+    # ---------- завершение ----------
+    async def flush(self):
+        """Дописывает всё, что есть в буфере (PTB вызывает при остановке)."""
+        for attempt in range(FLUSH_ATTEMPTS):
+            if self._retry is not None:
+                self._retry.cancel()
+                self._retry = None
+            if self._commit is not None:
+                await self._commit
+            if not self._dirty:
+                return
+            self._commit = asyncio.ensure_future(self._commit_staged())
+            await self._commit
+            if not self._dirty:
+                return
+            if attempt + 1 < FLUSH_ATTEMPTS:
+                await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+        logger.error(f"При остановке не записано {len(self._dirty)} ключей состояния")
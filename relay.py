@@ -0,0 +1,152 @@
+"""Пересылка вложений и альбомов между пользователем и топиком админов.
+
+Вместо того чтобы собирать новое сообщение из file_id, бот копирует
+исходное: copy_message переносит вложение любого типа (фото, видео,
+документ, голосовое, кружок, стикер) одним вызовом, меняя только
+подпись. Альбом копируется целиком одним вызовом copyMessages; если
+копирование не удалось или в альбоме не хватает частей, альбом
+собирается заново из вложений с сохранением их типов и подписей.
+
+Обработчики не вызывают эти функции сами: они ставят запись в outbox,
+а deliver() выполняет её в фоне (в том числе после рестарта, когда от
+исходного апдейта осталась только сохранённая запись).
+"""
+import logging
+
+from telegram import (
+    InputMediaAnimation,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+    MessageId,
+)
+from telegram.error import BadRequest
+
+from media import Album, Attachment
+
+logger = logging.getLogger(__name__)
+
+MAX_CAPTION_LENGTH = 1024
+# У кружков и стикеров подписи нет
+CAPTIONED = {"photo", "video", "animation", "document", "audio", "voice"}
+INPUT_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "animation": InputMediaAnimation,
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+}
+
+# Виды записей outbox
+KIND_TEXT = "text"    # send_message
+KIND_COPY = "copy"    # copy_media
+KIND_ALBUM = "album"  # relay_album
+
+
+def _fit(caption):
+    return caption[:MAX_CAPTION_LENGTH] if caption else caption
+
+
+async def copy_media(bot, from_chat_id, message_id, chat_id, caption, media_type,
+                     message_thread_id=None, rate_limit_args=None):
+    """Копирует сообщение с вложением, заменяя подпись на caption."""
+    kwargs = {"caption": _fit(caption)} if media_type in CAPTIONED else {}
+    return await bot.copy_message(
+        chat_id=chat_id,
+        from_chat_id=from_chat_id,
+        message_id=message_id,
+        message_thread_id=message_thread_id,
+        rate_limit_args=rate_limit_args,
+        **kwargs,
+    )
+
+
+def rebuild_media(attachments, caption):
+    """InputMedia* для send_media_group; caption - подпись первого элемента."""
+    media = []
+    for i, attachment in enumerate(attachments):
+        item_caption = caption if i == 0 else attachment.caption
+        media.append(INPUT_MEDIA[attachment.media_type](
+            media=attachment.file_id, caption=_fit(item_caption) or None
+        ))
+    return media
+
+
+async def copy_messages(bot, chat_id, from_chat_id, message_ids,
+                        message_thread_id=None, rate_limit_args=None):
+    """Вызов copyMessages: в python-telegram-bot 20.0 для него нет метода Bot.
+
+    Запрос идёт через bot._post, поэтому проходит через rate_limiter
+    ExtBot так же, как обычные методы.
+    """
+    data = {
+        "chat_id": chat_id,
+        "from_chat_id": from_chat_id,
+        "message_ids": message_ids,
+        "message_thread_id": message_thread_id,
+    }
+    result = await bot._post(
+        "copyMessages", data, api_kwargs=bot._merge_api_rl_kwargs(None, rate_limit_args)
+    )
+    return MessageId.de_list(result, bot)
+
+
+async def relay_album(bot, album, from_chat_id, chat_id, caption,
+                      message_thread_id=None, rate_limit_args=None):
+    """Переносит собранный альбом (media.Album) в chat_id.
+
+    copyMessages не умеет менять подписи, поэтому caption попадает
+    только в пересобранный альбом.
+    """
+    if len(album.message_ids) == len(album.items):
+        try:
+            return await copy_messages(
+                bot,
+                chat_id=chat_id,
+                from_chat_id=from_chat_id,
+                message_ids=sorted(album.message_ids),
+                message_thread_id=message_thread_id,
+                rate_limit_args=rate_limit_args,
+            )
+        except BadRequest as e:
+            logger.warning(f"Не удалось скопировать альбом {album.media_group_id}, "
+                           f"собираю заново: {e}")
+    return await bot.send_media_group(
+        chat_id=chat_id,
+        media=rebuild_media(album.items, caption),
+        message_thread_id=message_thread_id,
+        rate_limit_args=rate_limit_args,
+    )
+
+
+async def deliver(bot, kind, payload):
+    """Выполняет запись outbox (outbox.outbox_entry) вида kind."""
+    if kind == KIND_TEXT:
+        return await bot.send_message(
+            chat_id=payload["chat_id"],
+            text=payload["text"],
+            message_thread_id=payload.get("message_thread_id"),
+            rate_limit_args=payload.get("lane"),
+        )
+    if kind == KIND_COPY:
+        return await copy_media(
+            bot, payload["from_chat_id"], payload["message_id"],
+            chat_id=payload["chat_id"],
+            caption=payload.get("caption"),
+            media_type=payload["media_type"],
+            message_thread_id=payload.get("message_thread_id"),
+            rate_limit_args=payload.get("lane"),
+        )
+    if kind == KIND_ALBUM:
+        album = Album(payload["media_group_id"], None, 0)
+        album.items = [Attachment(*item) for item in payload["items"]]
+        album.message_ids = payload["message_ids"]
+        return await relay_album(
+            bot, album, payload["from_chat_id"],
+            chat_id=payload["chat_id"],
+            caption=payload.get("caption"),
+            message_thread_id=payload.get("message_thread_id"),
+            rate_limit_args=payload.get("lane"),
+        )
+    raise ValueError(f"Неизвестный вид доставки {kind}")
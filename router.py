@@ -0,0 +1,127 @@
+"""Маршрутизация входящих сообщений за один проход.
+
+Раньше каждое сообщение шло по цепочке MessageHandler-ов с
+пересекающимися фильтрами: первый совпавший забирал апдейт (поэтому
+альбомы так и не доходили до handle_media_group), а каждый обработчик
+сам повторял is_admin и поиск диалога.
+
+UpdateRouter классифицирует сообщение один раз - кто пишет, где, что
+прислал (текст, вложение, часть альбома) - находит диалог одним
+запросом (через кеш маршрутов) и вызывает обработчик из заранее
+составленной таблицы:
+
+    (роль, место, медиа) -> callback(update, context, routed)
+"""
+import logging
+
+from telegram import Chat, Update
+from telegram.ext import BaseHandler, filters
+
+from logs import bind_account
+from media import media_type
+
+logger = logging.getLogger(__name__)
+
+# Роль отправителя
+ADMIN = "admin"
+USER = "user"
+# Где написано сообщение
+TOPIC = "topic"      # топик группы админов
+PRIVATE = "private"  # личка с ботом
+# Что прислано
+TEXT = "text"
+MEDIA = "media"      # одно вложение любого типа из media.MEDIA_TYPES
+ALBUM = "album"      # часть медиагруппы
+
+
+class RoutedUpdate:
+    """Результат классификации; route заполняется найденным диалогом."""
+
+    __slots__ = ("role", "place", "media", "user_id", "chat_id", "topic_id", "album_id", "route")
+
+    def __init__(self, role, place, media, user_id, chat_id, topic_id=None, album_id=None):
+        self.role = role
+        self.place = place
+        self.media = media
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.topic_id = topic_id
+        self.album_id = album_id
+        self.route = None
+
+    @property
+    def key(self):
+        return self.role, self.place, self.media
+
+
+def classify(message, is_admin):
+    """RoutedUpdate для сообщения или None, если маршрутизировать нечего."""
+    if message.from_user is None:
+        return None
+    if media_type(message) is not None:
+        media = ALBUM if message.media_group_id else MEDIA
+    elif message.text:
+        media = TEXT
+    else:
+        return None
+    chat_type = message.chat.type
+    if chat_type == Chat.SUPERGROUP:
+        if not message.message_thread_id:
+            return None
+        place = TOPIC
+    elif chat_type == Chat.PRIVATE:
+        place = PRIVATE
+    else:
+        return None
+    role = ADMIN if is_admin(message.from_user.id) else USER
+    return RoutedUpdate(role, place, media, message.from_user.id, message.chat_id,
+                        message.message_thread_id if place == TOPIC else None,
+                        message.media_group_id)
+
+
+class UpdateRouter(BaseHandler):
+    """Один обработчик PTB вместо набора MessageHandler-ов.
+
+    routes: {(роль, место, медиа): callback}; комбинации вне таблицы
+    игнорируются. by_topic(chat_id, topic_id) / by_user(user_id) -
+    async-поиск диалога (Route или None). Если у пользователя нет открытого диалога, вызывается
+    on_unrouted(update, context).
+    """
+
+    def __init__(self, routes, is_admin, by_topic, by_user, on_unrouted=None):
+        super().__init__(self._unused)
+        self.routes = dict(routes)
+        self.is_admin = is_admin
+        self.by_topic = by_topic
+        self.by_user = by_user
+        self.on_unrouted = on_unrouted
+
+    @staticmethod
+    async def _unused(update, context):  # callback вызывается через таблицу маршрутов
+        return None
+
+    def check_update(self, update):
+        # Только новые сообщения; команды разбирают CommandHandler-ы
+        if not isinstance(update, Update) or update.message is None:
+            return None
+        if filters.COMMAND.check_update(update):
+            return None
+        routed = classify(update.message, self.is_admin)
+        if routed is None or routed.key not in self.routes:
+            return None
+        return routed
+
+    async def handle_update(self, update, application, check_result, context):
+        routed = check_result
+        self.collect_additional_context(context, update, application, routed)
+        if routed.place == TOPIC:
+            routed.route = await self.by_topic(routed.chat_id, routed.topic_id)
+        else:
+            routed.route = await self.by_user(routed.user_id)
+        if routed.route is None:
+            # Топик без заявки (служебный, из запаса) молча пропускаем
+            if routed.place == PRIVATE and self.on_unrouted is not None:
+                await self.on_unrouted(update, context)
+            return None
+        bind_account(routed.route.account_id)
+        return await self.routes[routed.key](update, context, routed)
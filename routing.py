@@ -0,0 +1,106 @@
+"""LRU-кэш маршрутизации: (группа, topic) -> запрос и user -> открытый диалог.
+
+Записи компактные (__slots__). Отсутствие маршрута тоже кэшируется,
+поэтому при установившемся трафике пересылка не трогает диск. Кэш
+сбрасывается там, где пишется привязка топика (create_support_topic).
+
+В кластере привязку меняют и другие процессы, а сбросить чужой кэш
+некому, поэтому у воркеров записи живут WORKER_ROUTE_TTL секунд.
+"""
+import time
+from collections import OrderedDict
+
+ROUTING_CACHE_SIZE = 4096
+WORKER_ROUTE_TTL = 5.0
+
+# Отличает «нет в кэше» от закэшированного «маршрута нет» (None)
+MISS = object()
+
+
+class Route:
+    __slots__ = ("account_id", "user_id", "admin_chat_id", "topic_id")
+
+    def __init__(self, account_id, user_id, admin_chat_id, topic_id):
+        self.account_id = account_id
+        self.user_id = user_id
+        self.admin_chat_id = admin_chat_id
+        self.topic_id = topic_id
+
+    def __repr__(self):
+        return (f"Route(account_id={self.account_id}, user_id={self.user_id}, "
+                f"admin_chat_id={self.admin_chat_id}, topic_id={self.topic_id})")
+
+
+class _LRU:
+    __slots__ = ("maxsize", "ttl", "data")
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (value, когда устареет или None)
+
+    def get(self, key):
+        try:
+            value, expires = self.data[key]
+        except KeyError:
+            return MISS
+        if expires is not None and expires <= time.monotonic():
+            del self.data[key]
+            return MISS
+        self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self.data[key] = (value, expires)
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+
+
+class RoutingCache:
+    def __init__(self, maxsize=ROUTING_CACHE_SIZE, ttl=None):
+        self._by_topic = _LRU(maxsize, ttl)
+        self._by_user = _LRU(maxsize, ttl)
+        # Растёт при каждой инвалидации: загрузка, начатая до неё,
+        # не должна положить в кэш устаревший результат
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._by_topic.data) + len(self._by_user.data)
+
+    def by_topic(self, chat_id, topic_id):
+        return self._by_topic.get((chat_id, topic_id))
+
+    def by_user(self, user_id):
+        return self._by_user.get(user_id)
+
+    def store_topic(self, chat_id, topic_id, route, generation):
+        if generation == self.generation:
+            self._by_topic.put((chat_id, topic_id), route)
+
+    def store_user(self, user_id, route, generation):
+        if generation == self.generation:
+            self._by_user.put(user_id, route)
+
+    def assign(self, route):
+        """Новая привязка топика к запросу: сразу кладём актуальный маршрут."""
+        self.generation += 1
+        self._by_topic.put((route.admin_chat_id, route.topic_id), route)
+        self._by_user.put(route.user_id, route)
+
+    def invalidate_user(self, user_id):
+        self.generation += 1
+        self._by_user.pop(user_id)
+
+    def invalidate_topic(self, chat_id, topic_id):
+        self.generation += 1
+        self._by_topic.pop((chat_id, topic_id))
+
+    def clear(self):
+        self.generation += 1
+        self._by_topic.data.clear()
+        self._by_user.data.clear()
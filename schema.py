@@ -0,0 +1,377 @@
+"""Схема БД и версионные миграции.
+
+Версия хранится в PRAGMA user_version. Каждая миграция выполняется в
+своей транзакции вместе с повышением версии, поэтому упавшая миграция
+не оставляет базу в промежуточном состоянии.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def migrate(conn, migrations):
+    """Применяет к conn миграции с номером больше текущего user_version."""
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, step in enumerate(migrations, start=1):
+        if version <= current:
+            continue
+        conn.execute("BEGIN")
+        try:
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Миграция {step.__name__} применена (версия {version})")
+    return max(current, len(migrations))
+
+
+# ================== accounts.db ==================
+def _accounts_v1_initial(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS accounts (
+                 id INTEGER PRIMARY KEY,
+                 user_id INTEGER,
+                 username TEXT,
+                 account_info TEXT,
+                 status TEXT DEFAULT 'new',
+                 admin_chat_id INTEGER,
+                 topic_id INTEGER,
+                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+                 id INTEGER PRIMARY KEY,
+                 account_id INTEGER,
+                 from_admin BOOLEAN,
+                 message_text TEXT,
+                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+
+def _accounts_v2_routing_indexes(conn):
+    # topic -> запрос
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_accounts_topic ON accounts (topic_id)")
+    # user -> последний открытый диалог; частичный индекс только по открытым
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_accounts_open_by_user
+                 ON accounts (user_id, id DESC)
+                 WHERE admin_chat_id IS NOT NULL''')
+
+
+def _accounts_v3_topic_pool(conn):
+    # Заранее созданные свободные топики в группе админов
+    conn.execute('''CREATE TABLE IF NOT EXISTS topic_pool (
+                 admin_chat_id INTEGER NOT NULL,
+                 topic_id INTEGER NOT NULL,
+                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 PRIMARY KEY (admin_chat_id, topic_id))''')
+    # Заявки, которым ещё не назначен топик (поднимаются при старте)
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_accounts_unassigned
+                 ON accounts (id) WHERE topic_id IS NULL''')
+
+
+MIGRATION_BATCH = 500
+
+
+def _parse_legacy(text):
+    """'PHOTO:file_id:caption' / 'ALBUM:id1,id2:caption' -> (caption, вложения)."""
+    kind, _, rest = text.partition(":")
+    # file_id не содержит ':', всё после второго ':' - подпись целиком
+    file_ids, _, caption = rest.partition(":")
+    ids = [file_id for file_id in file_ids.split(",") if file_id] if kind == "ALBUM" else [file_ids]
+    return caption, [
+        ("photo", file_id, None, position, caption if position == 0 else "")
+        for position, file_id in enumerate(ids)
+    ]
+
+
+def _convert_legacy(conn, table, column, is_message):
+    """Переносит строковые вложения table.column в attachments пачками по id."""
+    last_id = 0
+    converted = 0
+    owner = "account_id" if is_message else "id"
+    while True:
+        rows = conn.execute(
+            f"SELECT id, {owner}, {column} FROM {table} "
+            f"WHERE id > ? AND ({column} LIKE 'PHOTO:%' OR {column} LIKE 'ALBUM:%') "
+            f"ORDER BY id LIMIT ?",
+            (last_id, MIGRATION_BATCH),
+        ).fetchall()
+        if not rows:
+            break
+        attachments = []
+        updates = []
+        for row_id, account_id, text in rows:
+            caption, items = _parse_legacy(text)
+            message_id = row_id if is_message else None
+            attachments.extend((account_id, message_id, *item) for item in items)
+            updates.append((caption, row_id))
+        conn.executemany(
+            "INSERT INTO attachments (account_id, message_id, media_type, file_id, file_unique_id, "
+            "position, caption) VALUES (?, ?, ?, ?, ?, ?, ?)", attachments)
+        conn.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?", updates)
+        converted += len(rows)
+        last_id = rows[-1][0]
+    if converted:
+        logger.info(f"{table}: {converted} строк с вложениями перенесено в attachments")
+
+
+def _accounts_v4_attachments(conn):
+    # Вложения заявок (message_id IS NULL) и сообщений переписки
+    conn.execute('''CREATE TABLE IF NOT EXISTS attachments (
+                 id INTEGER PRIMARY KEY,
+                 account_id INTEGER NOT NULL REFERENCES accounts (id),
+                 message_id INTEGER REFERENCES messages (id),
+                 media_type TEXT NOT NULL,
+                 file_id TEXT NOT NULL,
+                 file_unique_id TEXT,
+                 position INTEGER NOT NULL DEFAULT 0,
+                 caption TEXT)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_attachments_message
+                 ON attachments (message_id, position) WHERE message_id IS NOT NULL''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_attachments_account
+                 ON attachments (account_id, message_id, position)''')
+    conn.execute('''CREATE INDEX IF NOT EXISTS idx_attachments_unique
+                 ON attachments (file_unique_id) WHERE file_unique_id IS NOT NULL''')
+    _convert_legacy(conn, "accounts", "account_info", is_message=False)
+    _convert_legacy(conn, "messages", "message_text", is_message=True)
+
+
+def _accounts_v5_lifecycle(conn):
+    # Время последнего сообщения - для закрытия простаивающих диалогов
+    conn.execute("ALTER TABLE accounts ADD COLUMN last_activity TIMESTAMP")
+    conn.execute("ALTER TABLE accounts ADD COLUMN closed_at TIMESTAMP")
+    conn.execute("UPDATE accounts SET last_activity = created_at")
+    # Один проход по messages вместо подзапроса на каждую заявку
+    last_messages = conn.execute(
+        "SELECT MAX(timestamp), account_id FROM messages GROUP BY account_id").fetchall()
+    conn.executemany("UPDATE accounts SET last_activity = ? WHERE id = ?", last_messages)
+    # Маршрутизация смотрит только на открытые диалоги
+    conn.execute("DROP INDEX IF EXISTS idx_accounts_open_by_user")
+    conn.execute("""CREATE INDEX idx_accounts_open_by_user
+                 ON accounts (user_id, id DESC)
+                 WHERE admin_chat_id IS NOT NULL AND status <> 'closed'""")
+    # Очередь админов и истечение простоя: открытые по статусу и давности
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_accounts_open_by_status
+                 ON accounts (status, last_activity)
+                 WHERE status <> 'closed'""")
+
+
+def _accounts_v6_search(conn):
+    # Полнотекстовый поиск по заявкам и переписке. rowid кодирует источник:
+    # заявка - 2*id+1, сообщение - 2*id, поэтому триггеры удаляют по rowid
+    conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+                 body, username, account_id UNINDEXED,
+                 tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')""")
+    # Не executescript: он коммитит сам и разорвал бы транзакцию миграции
+    for statement in _SEARCH_TRIGGERS:
+        conn.execute(statement)
+    conn.execute("""INSERT INTO search_index (rowid, body, username, account_id)
+                 SELECT 2 * id + 1, COALESCE(account_info, ''), COALESCE(username, ''), id
+                 FROM accounts""")
+    conn.execute("""INSERT INTO search_index (rowid, body, username, account_id)
+                 SELECT 2 * id, message_text, '', account_id
+                 FROM messages WHERE message_text <> ''""")
+
+
+_SEARCH_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS accounts_search_insert AFTER INSERT ON accounts BEGIN
+           INSERT INTO search_index (rowid, body, username, account_id)
+           VALUES (2 * new.id + 1, COALESCE(new.account_info, ''), COALESCE(new.username, ''), new.id);
+       END""",
+    # Смена статуса и активности индекс не трогает - только текст и username
+    """CREATE TRIGGER IF NOT EXISTS accounts_search_update
+       AFTER UPDATE OF account_info, username ON accounts BEGIN
+           DELETE FROM search_index WHERE rowid = 2 * old.id + 1;
+           INSERT INTO search_index (rowid, body, username, account_id)
+           VALUES (2 * new.id + 1, COALESCE(new.account_info, ''), COALESCE(new.username, ''), new.id);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS accounts_search_delete AFTER DELETE ON accounts BEGIN
+           DELETE FROM search_index WHERE rowid = 2 * old.id + 1;
+       END""",
+    # Подписи-пустышки альбомов в индекс не попадают
+    """CREATE TRIGGER IF NOT EXISTS messages_search_insert AFTER INSERT ON messages
+       WHEN new.message_text <> '' BEGIN
+           INSERT INTO search_index (rowid, body, username, account_id)
+           VALUES (2 * new.id, new.message_text, '', new.account_id);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_search_update AFTER UPDATE OF message_text ON messages BEGIN
+           DELETE FROM search_index WHERE rowid = 2 * old.id;
+           INSERT INTO search_index (rowid, body, username, account_id)
+           SELECT 2 * new.id, new.message_text, '', new.account_id WHERE new.message_text <> '';
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_search_delete AFTER DELETE ON messages BEGIN
+           DELETE FROM search_index WHERE rowid = 2 * old.id;
+       END""",
+)
+
+
+def _accounts_v7_outbox(conn):
+    # Исходящие пересылки: пишутся вместе с перепиской, доставляются в фоне.
+    # idem_key - исходное сообщение или альбом, повторный апдейт игнорируется
+    conn.execute('''CREATE TABLE IF NOT EXISTS outbox (
+                 id INTEGER PRIMARY KEY,
+                 idem_key TEXT NOT NULL UNIQUE,
+                 account_id INTEGER,
+                 chat_id INTEGER NOT NULL,
+                 kind TEXT NOT NULL,
+                 payload TEXT NOT NULL,
+                 status TEXT NOT NULL DEFAULT 'pending',
+                 attempts INTEGER NOT NULL DEFAULT 0,
+                 next_attempt REAL NOT NULL DEFAULT 0,
+                 last_error TEXT,
+                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    # Созревшие записи и ближайший повтор
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_outbox_due
+                 ON outbox (next_attempt) WHERE status = 'pending'""")
+    # Порядок внутри чата: есть ли более ранняя недоставленная запись
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_outbox_chat
+                 ON outbox (chat_id, id) WHERE status = 'pending'""")
+    # Очистка доставленных ключей
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_outbox_sent
+                 ON outbox (created_at) WHERE status = 'sent'""")
+
+
+def _accounts_v8_admin_groups(conn):
+    # Несколько групп админов: номера топиков уникальны только внутри группы
+    conn.execute("DROP INDEX IF EXISTS idx_accounts_topic")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_accounts_topic ON accounts (admin_chat_id, topic_id)")
+    # Балансировка least_open: открытые заявки по группам
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_accounts_open_by_group
+                 ON accounts (admin_chat_id)
+                 WHERE status <> 'closed'""")
+    # Язык пользователя - для балансировки по языку, в том числе при повторе после рестарта
+    conn.execute("ALTER TABLE accounts ADD COLUMN language TEXT")
+
+
+def _accounts_v9_archive(conn):
+    # Где лежит заявка, перенесённая в архив (archive.py)
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive_manifest (
+                 account_id INTEGER PRIMARY KEY,
+                 partition TEXT NOT NULL,
+                 user_id INTEGER,
+                 username TEXT,
+                 closed_at TIMESTAMP,
+                 archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archive_manifest_user ON archive_manifest (user_id)")
+    # Кандидаты в архив: закрытые по давности закрытия
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_accounts_closed
+                 ON accounts (closed_at) WHERE status = 'closed'""")
+    # Переписка одной заявки по порядку - без прохода по всей messages
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_account ON messages (account_id, timestamp)")
+
+
+def _accounts_v10_outbox_shard(conn):
+    # Многопроцессный режим (cluster.py): запись доставляет воркер, который её поставил
+    conn.execute("ALTER TABLE outbox ADD COLUMN shard INTEGER NOT NULL DEFAULT 0")
+
+
+def _accounts_v11_topic_pool_shard(conn):
+    # Запас топиков делится между воркерами: каждый поднимает только свои
+    conn.execute("ALTER TABLE topic_pool ADD COLUMN shard INTEGER NOT NULL DEFAULT 0")
+
+
+def _accounts_v12_card_sent(conn):
+    # Карточка заявки в топике: пока не отправлена, заявка поднимается при
+    # старте, даже если топик уже назначен. У старых заявок с топиком
+    # карточка считается отправленной
+    conn.execute("ALTER TABLE accounts ADD COLUMN card_sent INTEGER NOT NULL DEFAULT 0")
+    conn.execute("UPDATE accounts SET card_sent = 1 WHERE topic_id IS NOT NULL")
+    conn.execute("DROP INDEX IF EXISTS idx_accounts_unassigned")
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_accounts_card_pending
+                 ON accounts (id) WHERE card_sent = 0""")
+
+
+def _accounts_v13_account_shard(conn):
+    # Воркер, принявший заявку: при старте он же поднимает её без карточки
+    conn.execute("ALTER TABLE accounts ADD COLUMN shard INTEGER NOT NULL DEFAULT 0")
+
+
+def _accounts_v14_dead_letters(conn):
+    # Строки переписки, которые не записываются даже по одной
+    # (storage.TranscriptWriter): откладываются сюда, чтобы не держать очередь
+    conn.execute('''CREATE TABLE IF NOT EXISTS transcript_dead_letters (
+                 id INTEGER PRIMARY KEY,
+                 row TEXT NOT NULL,
+                 error TEXT NOT NULL,
+                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+
+ACCOUNTS_MIGRATIONS = [
+    _accounts_v1_initial,
+    _accounts_v2_routing_indexes,
+    _accounts_v3_topic_pool,
+    _accounts_v4_attachments,
+    _accounts_v5_lifecycle,
+    _accounts_v6_search,
+    _accounts_v7_outbox,
+    _accounts_v8_admin_groups,
+    _accounts_v9_archive,
+    _accounts_v10_outbox_shard,
+    _accounts_v11_topic_pool_shard,
+    _accounts_v12_card_sent,
+    _accounts_v13_account_shard,
+    _accounts_v14_dead_letters,
+]
+
+
+# ================== admins.db ==================
+def _admins_v1_initial(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS admins (
+                 id INTEGER PRIMARY KEY,
+                 chat_id INTEGER UNIQUE)''')
+
+
+ADMINS_MIGRATIONS = [
+    _admins_v1_initial,
+]
+
+
+# ================== state.db ==================
+def _state_v1_initial(conn):
+    # Состояние PTB (persistence.SQLitePersistence): значение - JSON
+    conn.execute('''CREATE TABLE IF NOT EXISTS conversations (
+                 name TEXT NOT NULL,
+                 key TEXT NOT NULL,
+                 data TEXT NOT NULL,
+                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 PRIMARY KEY (name, key))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS user_data (
+                 user_id INTEGER PRIMARY KEY,
+                 data TEXT NOT NULL,
+                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS chat_data (
+                 chat_id INTEGER PRIMARY KEY,
+                 data TEXT NOT NULL,
+                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS kv (
+                 name TEXT PRIMARY KEY,
+                 data TEXT NOT NULL,
+                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    # Задачи, которые должны пережить рестарт (недособранные альбомы)
+    conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                 kind TEXT NOT NULL,
+                 key TEXT NOT NULL,
+                 data TEXT NOT NULL,
+                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 PRIMARY KEY (kind, key))''')
+
+
+def _state_v2_job_shard(conn):
+    # Воркер кластера, который держал задачу: после рестарта её поднимает он же
+    conn.execute("ALTER TABLE jobs ADD COLUMN shard INTEGER NOT NULL DEFAULT 0")
+
+
+STATE_MIGRATIONS = [
+    _state_v1_initial,
+    _state_v2_job_shard,
+]
+
+
+def migrate_accounts(conn):
+    return migrate(conn, ACCOUNTS_MIGRATIONS)
+
+
+def migrate_admins(conn):
+    return migrate(conn, ADMINS_MIGRATIONS)
+
+
+def migrate_state(conn):
+    return migrate(conn, STATE_MIGRATIONS)
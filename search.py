@@ -0,0 +1,138 @@
+"""Поиск по заявкам и переписке для админов (/search).
+
+Индекс - FTS5-таблица search_index (schema v6), её держат в актуальном
+состоянии триггеры на accounts и messages, так что пути записи ничего
+не знают о поиске. Запрос пользователя превращается в набор префиксных
+термов, результаты ранжируются по bm25 (username весит больше текста) и
+листаются по ключу (score, rowid) без OFFSET: следующая страница
+начинается сразу за последней строкой предыдущей.
+
+bm25 считается для каждого совпадения, поэтому у частого слова в
+миллионной переписке ранжирование стоило бы секунды. Ранжируются только
+последние RANK_WINDOW совпадений: их нижняя граница по rowid находится
+обходом индекса в обратном порядке без подсчёта bm25. rowid заявки -
+2 * accounts.id + 1, сообщения - 2 * messages.id: номера двух таблиц
+несравнимы, поэтому окно у заявок и у сообщений своё, и поток сообщений
+не вытесняет заявки из поиска.
+"""
+import re
+from collections import OrderedDict
+
+PAGE_SIZE = 8
+MAX_TERMS = 8
+SNIPPET_TOKENS = 10
+RANK_WINDOW = 5000  # сколько последних совпадений ранжировать
+MAX_SESSIONS = 256  # сколько последних поисков помнят кнопку «дальше»
+
+_TERM = re.compile(r"\w+", re.UNICODE)
+
+# Чётность rowid в search_index
+MESSAGES = 0
+REQUESTS = 1
+
+
+def build_match(text):
+    """Строка запроса FTS5 из свободного текста или None, если искать нечего.
+
+    Каждое слово - префиксный терм в кавычках, поэтому операторы FTS5 из
+    ввода (NEAR, OR, '*', '"') не интерпретируются.
+    """
+    terms = _TERM.findall(text)[:MAX_TERMS]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def _window_floor(conn, match, parity, window=RANK_WINDOW):
+    """Наименьший rowid среди последних window совпадений одного вида
+    (0 - совпадений меньше)."""
+    row = conn.execute(
+        "SELECT rowid FROM search_index WHERE search_index MATCH ? AND rowid % 2 = ? "
+        "ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+        (match, parity, window - 1),
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def _search(conn, match, floor, after, limit):
+    """Страница результатов: [(score, rowid, account_id, snippet, username, status,
+    admin_chat_id, topic_id)], отсортированных по (score, rowid)."""
+    keyset = ""
+    params = [match, floor[REQUESTS], floor[MESSAGES]]
+    if after is not None:
+        # bm25 тем меньше, чем лучше совпадение
+        keyset = "AND (score > ? OR (score = ? AND s.rowid > ?))"
+        params += [after[0], after[0], after[1]]
+    params.append(limit)
+    return conn.execute(
+        f"""SELECT bm25(search_index, 1.0, 4.0) AS score, s.rowid, s.account_id,
+                   snippet(search_index, 0, '«', '»', '…', {SNIPPET_TOKENS}),
+                   a.username, a.status, a.admin_chat_id, a.topic_id
+            FROM search_index AS s JOIN accounts AS a ON a.id = s.account_id
+            WHERE search_index MATCH ?
+              AND s.rowid >= CASE s.rowid % 2 WHEN {REQUESTS} THEN ? ELSE ? END {keyset}
+            ORDER BY score, s.rowid
+            LIMIT ?""",
+        params,
+    ).fetchall()
+
+
+def topic_link(admin_chat_id, topic_id):
+    """Ссылка на топик супергруппы (t.me/c/<id без -100>/<topic>)."""
+    if not admin_chat_id or not topic_id:
+        return None
+    internal = str(admin_chat_id)
+    if internal.startswith("-100"):
+        internal = internal[4:]
+    return f"https://t.me/c/{internal.lstrip('-')}/{topic_id}"
+
+
+def format_results(rows):
+    lines = []
+    for score, rowid, account_id, snippet, username, status, admin_chat_id, topic_id in rows:
+        source = "📝" if rowid % 2 else "💬"
+        link = topic_link(admin_chat_id, topic_id)
+        head = f"{source} #{account_id} {username or ''} [{status}]"
+        lines.append(f"{head}\n{snippet.strip()}" + (f"\n{link}" if link else ""))
+    return "\n\n".join(lines)
+
+
+def search_page(conn, match, floor=None, after=None, limit=PAGE_SIZE, window=RANK_WINDOW):
+    """-> (floor, строки); floor - границы окон (сообщения, заявки), считается
+    на первой странице и дальше передаётся обратно."""
+    if floor is None:
+        floor = (_window_floor(conn, match, MESSAGES, window),
+                 _window_floor(conn, match, REQUESTS, window))
+    return floor, _search(conn, match, floor, after, limit)
+
+
+class SearchSessions:
+    """Запоминает (запрос, окно, ключ последней строки) для кнопки «дальше».
+
+    В callback_data помещается только 64 байта, поэтому в кнопке лежит
+    номер сессии, а сам запрос - здесь, в ограниченном LRU.
+    """
+
+    def __init__(self, maxsize=MAX_SESSIONS):
+        self.maxsize = maxsize
+        self._sessions = OrderedDict()
+        self._next_id = 0
+
+    def open(self, user_id, match, floor, after):
+        self._next_id += 1
+        self._sessions[self._next_id] = (user_id, match, floor, after)
+        if len(self._sessions) > self.maxsize:
+            self._sessions.popitem(last=False)
+        return self._next_id
+
+    def get(self, session_id, user_id):
+        """-> (match, floor, after) или None, если сессия устарела или чужая."""
+        session = self._sessions.get(session_id)
+        if session is None or session[0] != user_id:
+            return None
+        return session[1:]
+
+    def advance(self, session_id, after):
+        user_id, match, floor, _ = self._sessions[session_id]
+        self._sessions[session_id] = (user_id, match, floor, after)
+        self._sessions.move_to_end(session_id)
@@ -0,0 +1,86 @@
+"""Параллельная обработка апдейтов с сохранением порядка внутри диалога.
+
+PTB без concurrent_updates вызывает process_update строго по очереди,
+поэтому один медленный обработчик (например, start() с asyncio.sleep)
+задерживает всех. SequencedApplication раскладывает апдейты по ключу
+диалога: апдейты одного пользователя или одного топика обрабатываются
+строго по порядку, разные диалоги - параллельно. Общее число
+апдейтов в работе ограничено max_in_flight: при переполнении приём
+новых апдейтов ждёт, пока освободится место.
+"""
+import asyncio
+import logging
+from collections import deque
+
+from telegram import Chat, Update
+from telegram.ext import Application
+
+from logs import bind_update
+
+logger = logging.getLogger(__name__)
+
+MAX_IN_FLIGHT = 64
+
+
+def conversation_key(update):
+    """Ключ упорядочивания: топик форума, иначе пользователь, иначе чат."""
+    if not isinstance(update, Update):
+        return None
+    message = update.effective_message
+    chat = update.effective_chat
+    if (message is not None and chat is not None and chat.type == Chat.SUPERGROUP
+            and message.message_thread_id):
+        return ("topic", chat.id, message.message_thread_id)
+    if update.effective_user is not None:
+        return ("user", update.effective_user.id)
+    if chat is not None:
+        return ("chat", chat.id)
+    return None
+
+
+class SequencedApplication(Application):
+    """Подключается через Application.builder().application_class(...)."""
+
+    def __init__(self, *, max_in_flight=MAX_IN_FLIGHT, **kwargs):
+        super().__init__(**kwargs)
+        self.max_in_flight = max_in_flight
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._queues = {}
+        self._in_flight = 0
+
+    def in_flight(self):
+        """Сколько апдейтов принято, но ещё не обработано."""
+        return self._in_flight
+
+    async def process_update(self, update):
+        key = conversation_key(update)
+        await self._slots.acquire()
+        self._in_flight += 1
+        if key is None:
+            self.create_task(self._run_one(update))
+            return
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            queue.append(update)
+            self.create_task(self._drain(key, queue))
+        else:
+            queue.append(update)
+
+    async def _run_one(self, update):
+        bind_update(getattr(update, "update_id", None))
+        try:
+            await super().process_update(update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта: {e}")
+        finally:
+            self._in_flight -= 1
+            self._slots.release()
+
+    async def _drain(self, key, queue):
+        try:
+            while queue:
+                await self._run_one(queue[0])
+                queue.popleft()
+        finally:
+            del self._queues[key]
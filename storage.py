@@ -0,0 +1,526 @@
+"""Асинхронный слой хранения поверх sqlite3.
+
+Все запросы выполняются вне event loop: записи идут через один
+выделенный поток-писатель с долгоживущим соединением, чтения - через
+небольшой пул потоков, у каждого из которых своё соединение.
+
+В многопроцессном режиме (cluster.py) поток-писатель один на файл во
+всём кластере: его держит сервис serve_writes, а воркеры пишут через
+RemoteDatabase - та же очередь записей, только исполняет её другой
+процесс. Читают воркеры сами, WAL это позволяет.
+"""
+import asyncio
+import functools
+import itertools
+import logging
+import pickle
+import queue
+import signal
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+from outbox import insert_outbox
+
+logger = logging.getLogger(__name__)
+
+SQLITE_TIMEOUT = 10  # секунд для ожидания разблокировки БД
+READER_POOL_SIZE = 2
+
+_STOP = object()
+
+
+class Database:
+    """Одна БД-файл: поток-писатель и пул читателей с постоянными соединениями."""
+
+    def __init__(self, path, readers=READER_POOL_SIZE, timeout=SQLITE_TIMEOUT, metrics=None):
+        self.path = path
+        self.timeout = timeout
+        self.metrics = metrics  # metrics.Metrics: время каждого запроса в bot_sqlite_seconds
+        self._readers = readers
+        self._write_queue = queue.Queue()
+        self._writer = None
+        self._reader_pool = None
+        self._reader_conns = []
+        self._reader_local = threading.local()
+        self._lock = threading.Lock()
+
+    # ---------- соединения ----------
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('PRAGMA synchronous=NORMAL;')
+        return conn
+
+    def _reader_conn(self):
+        conn = getattr(self._reader_local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute('PRAGMA query_only=ON;')
+            self._reader_local.conn = conn
+            with self._lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    # ---------- жизненный цикл ----------
+    def start(self):
+        if self._writer is not None:
+            return self
+        self._writer = threading.Thread(
+            target=self._writer_loop, name=f"sqlite-writer:{self.path}", daemon=True
+        )
+        self._writer.start()
+        self._reader_pool = ThreadPoolExecutor(
+            max_workers=self._readers, thread_name_prefix=f"sqlite-reader:{self.path}"
+        )
+        return self
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._write_queue.put(_STOP)
+        self._writer.join()
+        self._writer = None
+        self._reader_pool.shutdown(wait=True)
+        self._reader_pool = None
+        with self._lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+
+    def _writer_loop(self):
+        conn = self._connect()
+        try:
+            while True:
+                item = self._write_queue.get()
+                if item is _STOP:
+                    break
+                fn, args, future = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                started = time.perf_counter()
+                try:
+                    with conn:
+                        result = fn(conn, *args)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                finally:
+                    self._observe("write", fn, started)
+        finally:
+            conn.close()
+
+    def _run_read(self, fn, args):
+        started = time.perf_counter()
+        try:
+            return fn(self._reader_conn(), *args)
+        finally:
+            self._observe("read", fn, started)
+
+    def _observe(self, op, fn, started):
+        if self.metrics is not None:
+            self.metrics.observe(
+                "bot_sqlite_seconds", (self.path, op, fn.__name__), time.perf_counter() - started,
+                help="Время запроса SQLite в потоке БД", label_names=("db", "op", "fn"),
+            )
+
+    def pending_writes(self):
+        """Сколько записей ждут потока-писателя."""
+        return self._write_queue.qsize()
+
+    # ---------- низкоуровневый API ----------
+    def submit_write(self, fn, *args) -> Future:
+        """Ставит fn(conn, *args) в очередь писателя; выполняется в одной транзакции."""
+        if self._writer is None:
+            raise RuntimeError(f"База {self.path} не запущена")
+        future = Future()
+        self._write_queue.put((fn, args, future))
+        return future
+
+    def submit_read(self, fn, *args) -> Future:
+        if self._reader_pool is None:
+            raise RuntimeError(f"База {self.path} не запущена")
+        return self._reader_pool.submit(self._run_read, fn, args)
+
+    async def write(self, fn, *args):
+        return await asyncio.wrap_future(self.submit_write(fn, *args))
+
+    async def read(self, fn, *args):
+        return await asyncio.wrap_future(self.submit_read(fn, *args))
+
+    # ---------- удобные обёртки ----------
+    async def execute(self, sql, params=()):
+        """Выполняет изменяющий запрос, возвращает lastrowid."""
+        return await self.write(_execute, sql, params)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(_fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(_fetchall, sql, params)
+
+
+class RemoteDatabase(Database):
+    """Database, записи которой выполняет сервис-писатель (serve_writes).
+
+    fn и аргументы записи уходят писателю через pickle, поэтому fn -
+    функция уровня импортируемого модуля (не __main__). Записи одного
+    процесса выполняются в порядке постановки.
+    """
+
+    def __init__(self, path, address, authkey, readers=READER_POOL_SIZE, timeout=SQLITE_TIMEOUT,
+                 metrics=None):
+        super().__init__(path, readers=readers, timeout=timeout, metrics=metrics)
+        self.address = address
+        self.authkey = authkey
+        self._conn = None
+        self._receiver = None
+        self._calls = {}  # id -> (fn, future, started): ждут ответа писателя
+        self._calls_changed = threading.Condition()
+        self._call_ids = itertools.count()
+
+    def start(self):
+        if self._writer is not None:
+            return self
+        self._conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+        self._conn.send(self.path)
+        self._receiver = threading.Thread(
+            target=self._receiver_loop, name=f"sqlite-remote:{self.path}", daemon=True
+        )
+        self._receiver.start()
+        return super().start()
+
+    def close(self):
+        if self._writer is None:
+            return
+        super().close()
+        self._receiver.join()
+        self._conn.close()
+        self._conn = None
+
+    def _writer_loop(self):
+        # Здесь поток только отправляет записи; ответы разбирает _receiver_loop
+        while True:
+            item = self._write_queue.get()
+            if item is _STOP:
+                break
+            fn, args, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            call_id = next(self._call_ids)
+            with self._calls_changed:
+                self._calls[call_id] = (fn, future, time.perf_counter())
+            try:
+                self._conn.send((call_id, fn, args))
+            except Exception as e:
+                with self._calls_changed:
+                    self._calls.pop(call_id, None)
+                future.set_exception(e)
+        # Дожидаемся ответов на всё отправленное, потом прощаемся с писателем
+        with self._calls_changed:
+            self._calls_changed.wait_for(lambda: not self._calls)
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass
+
+    def _receiver_loop(self):
+        try:
+            while True:
+                call_id, ok, value = self._conn.recv()
+                with self._calls_changed:
+                    fn, future, started = self._calls.pop(call_id)
+                    self._calls_changed.notify_all()
+                self._observe("write", fn, started)
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self._calls_changed:
+                lost = list(self._calls.values())
+                self._calls.clear()
+                self._calls_changed.notify_all()
+            for _, future, _ in lost:
+                future.set_exception(ConnectionError(f"Сервис записи {self.path} недоступен"))
+
+    def pending_writes(self):
+        return self._write_queue.qsize() + len(self._calls)
+
+    def submit_write(self, fn, *args) -> Future:
+        if fn.__module__ == "__main__":
+            raise TypeError(f"{fn.__name__}: запись для сервиса должна жить в импортируемом модуле")
+        return super().submit_write(fn, *args)
+
+
+def _serve_connection(conn, databases):
+    lock = threading.Lock()
+
+    def reply(call_id, future):
+        try:
+            message = (call_id, True, future.result())
+        except BaseException as e:
+            message = (call_id, False, e)
+        with lock:
+            try:
+                try:
+                    conn.send(message)
+                except (pickle.PicklingError, TypeError, AttributeError) as e:
+                    conn.send((call_id, False, RuntimeError(f"ответ записи не передать: {e}")))
+            except OSError:
+                pass  # воркер уже отключился
+
+    try:
+        db = databases[conn.recv()]
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            call_id, fn, args = message
+            db.submit_write(fn, *args).add_done_callback(functools.partial(reply, call_id))
+    except (EOFError, OSError):
+        pass
+    except Exception as e:
+        logger.error(f"Ошибка соединения с сервисом записи: {e}")
+    finally:
+        conn.close()
+
+
+def serve_writes(paths, address, authkey):
+    """Сервис-писатель: по потоку-писателю на каждый файл из paths для
+    всех RemoteDatabase кластера. Работает до SIGTERM / SIGINT."""
+    databases = {path: Database(path).start() for path in paths}
+
+    def _stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, _stop)
+    listener = Listener(address, family="AF_UNIX", authkey=authkey)
+    logger.info(f"Сервис записи слушает {address}")
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except (EOFError, OSError) as e:
+                # Чужой клиент с неверным ключом и т.п. - следующий
+                logger.warning(f"Сервис записи: соединение отклонено ({e})")
+                continue
+            threading.Thread(target=_serve_connection, args=(conn, databases),
+                             name="sqlite-service", daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        for db in databases.values():
+            db.close()
+
+
+def _execute(conn, sql, params):
+    return conn.execute(sql, params).lastrowid
+
+
+def _fetchone(conn, sql, params):
+    return conn.execute(sql, params).fetchone()
+
+
+def _fetchall(conn, sql, params):
+    return conn.execute(sql, params).fetchall()
+
+
+TRANSCRIPT_BATCH_SIZE = 200
+TRANSCRIPT_FLUSH_INTERVAL = 0.005  # секунд ожидания остальных строк пачки
+TRANSCRIPT_RETRY_DELAY = 0.5       # секунд после ошибки записи, удваивается
+TRANSCRIPT_MAX_RETRY_DELAY = 30
+TRANSCRIPT_CLOSE_ATTEMPTS = 3      # попыток дописать буфер при остановке
+TRANSCRIPT_SPLIT_AFTER = 5         # неудач подряд, после которых пачка пишется по строке
+
+
+def insert_attachments(conn, account_id, message_id, attachments):
+    """attachments: Attachment-подобные кортежи (media_type, file_id, file_unique_id, position, caption)."""
+    conn.executemany(
+        "INSERT INTO attachments (account_id, message_id, media_type, file_id, file_unique_id, "
+        "position, caption) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(account_id, message_id, *attachment) for attachment in attachments],
+    )
+
+
+def insert_account(conn, user_id, username, info, attachments, language, shard=0):
+    """shard - номер воркера, который принял заявку и создаёт ей топик."""
+    account_id = conn.execute(
+        "INSERT INTO accounts (user_id, username, account_info, language, last_activity, shard) "
+        "VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, ?)",
+        (user_id, username, info, language, shard)).lastrowid
+    if attachments:
+        insert_attachments(conn, account_id, None, attachments)
+    return account_id
+
+
+def _insert_messages(conn, rows, on_batch=None, shard=0):
+    insert = "INSERT INTO messages (account_id, from_admin, message_text) VALUES (?, ?, ?)"
+    plain = []
+    for account_id, from_admin, text, attachments, delivery in rows:
+        if delivery is not None and not insert_outbox(conn, account_id, delivery, shard):
+            continue  # апдейт пришёл повторно: уже записан и поставлен в доставку
+        if not attachments:
+            plain.append((account_id, from_admin, text))
+            continue
+        # Сообщению с вложениями нужен id; порядок строк сохраняем
+        if plain:
+            conn.executemany(insert, plain)
+            plain = []
+        message_id = conn.execute(insert, (account_id, from_admin, text)).lastrowid
+        insert_attachments(conn, account_id, message_id, attachments)
+    if plain:
+        conn.executemany(insert, plain)
+    if on_batch is not None:
+        on_batch(conn, rows)
+
+
+def _insert_dead_letter(conn, row, error):
+    conn.execute("INSERT INTO transcript_dead_letters (row, error) VALUES (?, ?)", (row, error))
+
+
+class TranscriptWriter:
+    """Write-behind очередь для таблицы messages.
+
+    Обработчики кладут строки через enqueue() и сразу продолжают работу,
+    фоновая задача пишет их пачками в одной транзакции - по размеру пачки
+    или по истечении короткого окна flush_interval. Строка может нести
+    запись outbox (delivery) - она попадает в ту же транзакцию, с
+    номером воркера shard.
+
+    Пачка, которую не удалось записать, возвращается в голову очереди и
+    повторяется с растущей паузой; flush() при этом бросает исключение,
+    пока пачка не записана. После split_after неудач подряд пачка пишется
+    по одной строке: строка, которая не записывается и одна, уходит в
+    transcript_dead_letters, остальные - в messages. Если не удаётся
+    отложить и её, база недоступна целиком - пачка снова ждёт повтора.
+    """
+
+    def __init__(self, db, batch_size=TRANSCRIPT_BATCH_SIZE, flush_interval=TRANSCRIPT_FLUSH_INTERVAL,
+                 on_batch=None, on_commit=None, shard=0, retry_delay=TRANSCRIPT_RETRY_DELAY,
+                 split_after=TRANSCRIPT_SPLIT_AFTER):
+        self.db = db
+        self.shard = shard
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.split_after = split_after
+        self.on_batch = on_batch  # on_batch(conn, batch) - в той же транзакции, что и пачка
+        self.on_commit = on_commit  # on_commit(batch) - после успешного commit
+        self.commits = 0
+        self.rows_written = 0
+        self.failures = 0
+        self.dead_letters = 0
+        self._head_failures = 0  # неудач подряд у пачки в голове очереди
+        self._buffer = []
+        self._wakeup = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._closing = False
+        self._task = None
+
+    def start(self):
+        self._closing = False
+        self._task = asyncio.create_task(self._run(), name="transcript-writer")
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def enqueue(self, account_id, from_admin, text, attachments=(), delivery=None):
+        """delivery - запись outbox.outbox_entry(...) для доставки этого сообщения."""
+        self._buffer.append((account_id, int(from_admin), text, tuple(attachments), delivery))
+        self._wakeup.set()
+
+    def enqueue_many(self, rows):
+        """rows: (account_id, from_admin, text[, attachments[, delivery]])"""
+        self._buffer.extend(
+            (row[0], int(row[1]), row[2], tuple(row[3]) if len(row) > 3 else (),
+             row[4] if len(row) > 4 else None) for row in rows
+        )
+        self._wakeup.set()
+
+    async def _run(self):
+        while not self._closing:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if not self._closing and len(self._buffer) < self.batch_size:
+                # Даём окну набрать остальные строки пачки
+                await asyncio.sleep(self.flush_interval)
+            failures = 0
+            while not self._closing:
+                try:
+                    await self._write_pending()
+                    break
+                except Exception:
+                    failures += 1
+                    await asyncio.sleep(min(TRANSCRIPT_MAX_RETRY_DELAY,
+                                            self.retry_delay * 2 ** (failures - 1)))
+
+    async def _write_pending(self):
+        async with self._write_lock:
+            while self._buffer:
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+                try:
+                    await self.db.write(_insert_messages, batch, self.on_batch, self.shard)
+                except Exception as e:
+                    self.failures += 1
+                    self._head_failures += 1
+                    if self._head_failures < self.split_after:
+                        # Пачка остаётся первой в очереди: порядок строк сохраняется
+                        self._buffer[:0] = batch
+                        logger.error(f"Ошибка сохранения {len(batch)} сообщений, повтор позже: {e}")
+                        raise
+                    logger.error(f"Пачка из {len(batch)} сообщений не записывается "
+                                 f"{self._head_failures} раз подряд, пишу по одной: {e}")
+                    await self._write_singly(batch)
+                else:
+                    self._committed(batch)
+                self._head_failures = 0
+
+    async def _write_singly(self, batch):
+        for i, row in enumerate(batch):
+            try:
+                await self.db.write(_insert_messages, [row], self.on_batch, self.shard)
+            except Exception as e:
+                try:
+                    await self.db.write(_insert_dead_letter, repr(row), repr(e))
+                except Exception:
+                    self._buffer[:0] = batch[i:]
+                    raise
+                self.dead_letters += 1
+                logger.error(f"Сообщение диалога {row[0]!r} отложено в transcript_dead_letters: {e}")
+            else:
+                self._committed([row])
+
+    def _committed(self, batch):
+        self.commits += 1
+        self.rows_written += len(batch)
+        if self.on_commit is not None:
+            self.on_commit(batch)
+
+    async def flush(self):
+        """Дожидается, пока все поставленные до вызова строки будут записаны.
+        Если запись не удалась, бросает исключение - строки остаются в очереди."""
+        await self._write_pending()
+
+    async def close(self):
+        """Останавливает фоновую задачу, дописав всё, что осталось в буфере."""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        for attempt in range(TRANSCRIPT_CLOSE_ATTEMPTS):
+            try:
+                await self._write_pending()
+                return
+            except Exception:
+                if attempt + 1 < TRANSCRIPT_CLOSE_ATTEMPTS:
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+        logger.error(f"При остановке не записано {len(self._buffer)} сообщений")
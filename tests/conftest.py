@@ -0,0 +1,49 @@
+"""Модули бота лежат в корне репозитория; асинхронные тесты зовут run()."""
+import asyncio
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+TOKEN = "123456:TEST"
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def private_update(update_id, user_id, text="hi"):
+    """Сырой апдейт: текст в личке от user_id."""
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "u"}}}
+
+
+async def started_application(api, *handlers, **kwargs):
+    """SequencedApplication поверх bench.fake_api.FakeBotAPI, без Updater."""
+    from telegram.ext import Application
+
+    from sequencer import SequencedApplication
+
+    application = (Application.builder().token(TOKEN).base_url(api.base_url)
+                   .application_class(SequencedApplication, kwargs=kwargs).updater(None).build())
+    application.add_handlers(list(handlers))
+    await application.initialize()
+    await application.start()
+    return application
+
+
+async def stop_application(application):
+    await application.stop()
+    await application.shutdown()
+
+
+@pytest.fixture
+def chdir_tmp(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
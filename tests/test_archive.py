@@ -0,0 +1,35 @@
+import pytest
+
+from archive import AUTO_VACUUM_INCREMENTAL, Retention, _auto_vacuum
+from conftest import run
+from schema import migrate_accounts
+from storage import Database
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "accounts.db")).start()
+    db.submit_write(migrate_accounts).result()
+    yield db
+    db.close()
+
+
+def test_start_does_not_vacuum(db, tmp_path):
+    async def scenario():
+        retention = Retention(db, None, directory=str(tmp_path / "archive"), interval=3600)
+        await retention.start()
+        await retention.close()
+        return await db.read(_auto_vacuum)
+
+    assert run(scenario()) != AUTO_VACUUM_INCREMENTAL
+
+
+def test_vacuum_is_explicit_and_timed(db, tmp_path):
+    async def scenario():
+        retention = Retention(db, None, directory=str(tmp_path / "archive"))
+        elapsed = await retention.vacuum()
+        return elapsed, await db.read(_auto_vacuum)
+
+    elapsed, mode = run(scenario())
+    assert elapsed >= 0
+    assert mode == AUTO_VACUUM_INCREMENTAL
@@ -0,0 +1,30 @@
+from cluster import conversation_key, shard_of
+
+USER_ID = 7
+GROUP_ID = -1001234
+TOPIC_ID = 55
+
+
+def _private(update_id):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": "hi",
+        "chat": {"id": USER_ID, "type": "private"},
+        "from": {"id": USER_ID, "is_bot": False, "first_name": "u"}}}
+
+
+def _topic(update_id, admin_id):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": "reply", "message_thread_id": TOPIC_ID,
+        "chat": {"id": GROUP_ID, "type": "supergroup", "is_forum": True},
+        "from": {"id": admin_id, "is_bot": False, "first_name": "a"}}}
+
+
+def test_dialog_directions_have_their_own_keys():
+    assert conversation_key(_private(1)) == ("user", USER_ID)
+    assert conversation_key(_topic(2, 100)) == ("topic", GROUP_ID, TOPIC_ID)
+
+
+def test_each_direction_stays_on_one_worker():
+    shards = 4
+    assert len({shard_of(_private(i), shards) for i in range(50)}) == 1
+    assert len({shard_of(_topic(i, 100 + i), shards) for i in range(50)}) == 1
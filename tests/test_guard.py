@@ -0,0 +1,58 @@
+import pytest
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop
+
+from conftest import run
+from guard import USER_BURST, IntakeGuard
+
+USER_ID = 1001
+
+
+def _update(update_id, media_group_id=None):
+    message = {
+        "message_id": update_id, "date": 0,
+        "chat": {"id": USER_ID, "type": "private"},
+        "from": {"id": USER_ID, "is_bot": False, "first_name": "u"},
+        "photo": [{"file_id": f"f{update_id}", "file_unique_id": f"u{update_id}", "width": 1, "height": 1}],
+    }
+    if media_group_id is not None:
+        message["media_group_id"] = media_group_id
+    return Update.de_json({"update_id": update_id, "message": message}, None)
+
+
+async def _admitted(guard, updates):
+    passed = 0
+    for update in updates:
+        try:
+            await guard.check(update, None)
+        except ApplicationHandlerStop:
+            continue
+        passed += 1
+    return passed
+
+
+def test_ten_part_album_is_one_update():
+    guard = IntakeGuard(lambda chat_id: False)
+    album = [_update(i, media_group_id="album-1") for i in range(1, 11)]
+    assert run(_admitted(guard, album)) == 10
+    assert guard.dropped == 0
+
+
+def test_plain_flood_is_still_limited():
+    guard = IntakeGuard(lambda chat_id: False)
+    assert run(_admitted(guard, [_update(i) for i in range(1, 21)])) == USER_BURST
+    assert guard.dropped == 20 - USER_BURST
+
+
+def test_album_after_flood_is_dropped_whole():
+    guard = IntakeGuard(lambda chat_id: False)
+    run(_admitted(guard, [_update(i) for i in range(1, USER_BURST + 1)]))
+    album = [_update(100 + i, media_group_id="album-2") for i in range(10)]
+    assert run(_admitted(guard, album)) == 0
+
+
+@pytest.mark.parametrize("parts", [2, 10])
+def test_several_albums_in_a_row(parts):
+    guard = IntakeGuard(lambda chat_id: False)
+    updates = [_update(a * 100 + i, media_group_id=f"album-{a}") for a in range(3) for i in range(parts)]
+    assert run(_admitted(guard, updates)) == 3 * parts
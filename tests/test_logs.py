@@ -0,0 +1,31 @@
+import glob
+import logging
+
+from logs import CompressingRotatingFileHandler
+
+
+class CountingFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(message)s")
+        self.calls = 0
+
+    def format(self, record):
+        self.calls += 1
+        return super().format(record)
+
+
+def test_size_rollover_formats_each_record_once(tmp_path):
+    path = str(tmp_path / "bot.log")
+    handler = CompressingRotatingFileHandler(path, max_bytes=100, interval=0, backups=5)
+    formatter = CountingFormatter()
+    handler.setFormatter(formatter)
+    try:
+        for i in range(10):
+            handler.handle(logging.makeLogRecord({"msg": f"record {i:02d} " + "x" * 30}))
+    finally:
+        handler.close()
+    assert formatter.calls == 10
+    # 41 байт на запись: ротация после каждой третьей
+    assert len(glob.glob(path + ".*.gz")) == 3
+    with open(path, encoding="utf-8") as f:
+        assert f.read().splitlines() == ["record 09 " + "x" * 30]
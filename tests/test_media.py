@@ -0,0 +1,90 @@
+import asyncio
+
+from conftest import run
+from media import MAX_ALBUM_SIZE, Album, Attachment, MediaGroupAggregator
+
+
+def _part(i, caption=""):
+    return Attachment("photo", f"f{i}", f"u{i}", 0, caption)
+
+
+class Collector:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.albums = []
+        self.done = []
+        self.updates = 0
+
+    async def on_album(self, album):
+        if self.fail:
+            raise OSError("database is locked")
+        self.albums.append(album)
+
+    def aggregator(self, **kwargs):
+        return MediaGroupAggregator(self.on_album, on_update=self.on_update, on_done=self.done.append,
+                                    **kwargs)
+
+    def on_update(self, album):
+        self.updates += 1
+
+
+def test_full_album_flushes_at_once():
+    async def scenario():
+        collector = Collector()
+        media_groups = collector.aggregator(initial_delay=60)
+        for i in range(MAX_ALBUM_SIZE):
+            media_groups.add("g", _part(i, "caption" if i == 2 else ""), "meta", message_id=100 + i)
+        await asyncio.sleep(0)
+        await media_groups.close()
+        return collector, media_groups
+
+    collector, media_groups = run(scenario())
+    (album,) = collector.albums
+    assert [item.position for item in album.items] == list(range(MAX_ALBUM_SIZE))
+    assert album.message_ids == list(range(100, 100 + MAX_ALBUM_SIZE))
+    assert (album.caption, album.meta) == ("caption", "meta")
+    assert media_groups.flushed_full == 1 and collector.done == [album]
+    assert collector.updates == MAX_ALBUM_SIZE and len(media_groups) == 0
+
+
+def test_short_album_flushes_after_pause():
+    async def scenario():
+        collector = Collector()
+        media_groups = collector.aggregator(initial_delay=0.05, min_delay=0.05, max_delay=0.1)
+        media_groups.add("g", _part(0), None, message_id=1)
+        media_groups.add("g", _part(1), None, message_id=2)
+        await asyncio.sleep(0.01)
+        flushed_early = bool(collector.albums)
+        await asyncio.sleep(0.2)
+        await media_groups.close()
+        return flushed_early, collector, media_groups
+
+    flushed_early, collector, media_groups = run(scenario())
+    assert not flushed_early
+    assert [len(album.items) for album in collector.albums] == [2]
+    assert media_groups.flushed_timeout == 1
+
+
+def test_failed_album_is_not_marked_done():
+    async def scenario():
+        collector = Collector(fail=True)
+        media_groups = collector.aggregator()
+        media_groups.add("g", _part(0), None, message_id=1)
+        await media_groups.close()
+        return collector
+
+    assert run(scenario()).done == []
+
+
+def test_restored_album_is_processed_once():
+    async def scenario():
+        collector = Collector()
+        media_groups = collector.aggregator()
+        album = Album("g", None, 0)
+        album.items = [_part(0)]
+        media_groups.restore(album)
+        await media_groups.close()
+        return collector, album
+
+    collector, album = run(scenario())
+    assert collector.albums == [album] and collector.done == [album]
@@ -0,0 +1,84 @@
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+from bench.fake_api import FakeBotAPI
+from conftest import TOKEN, run
+from metrics import Metrics
+from outbound import LANE_ADMIN, LANE_BACKGROUND, LANE_RELAY, LANE_REVIEWS, OutboundScheduler
+
+
+def _queued(metrics):
+    """Сколько запросов прошло через каждую полосу."""
+    family = metrics._histograms.get("bot_api_queue_seconds", (None, None, {}))
+    return {labels[0]: histogram.count for labels, histogram in family[2].items()}
+
+
+async def _send(rate_limit_args):
+    api = FakeBotAPI(TOKEN)
+    await api.start()
+    metrics = Metrics()
+    bot = ExtBot(TOKEN, base_url=api.base_url, rate_limiter=OutboundScheduler(metrics=metrics))
+    try:
+        await bot.initialize()  # getMe - тоже через планировщик
+        before = _queued(metrics)
+        kwargs = {} if rate_limit_args is None else {"rate_limit_args": rate_limit_args}
+        await bot.send_message(chat_id=1, text="hi", **kwargs)
+    finally:
+        await bot.shutdown()
+        await api.stop()
+    after = _queued(metrics)
+    return sorted(lane for lane, count in after.items() if count != before.get(lane, 0))
+
+
+def test_admin_lane_survives_extbot():
+    # ExtBot отбрасывает ложный rate_limit_args - полоса не должна им быть
+    assert run(_send(LANE_ADMIN)) == [LANE_ADMIN]
+
+
+def test_other_lanes_and_default():
+    assert run(_send(LANE_REVIEWS)) == [LANE_REVIEWS]
+    assert run(_send(LANE_BACKGROUND)) == [LANE_BACKGROUND]
+    assert run(_send(None)) == [LANE_RELAY]
+
+
+async def _request(scheduler, endpoint, data, callback=None):
+    async def ok():
+        return True
+    return await scheduler.process_request(callback or ok, (), {}, endpoint, data, None)
+
+
+def test_group_bucket_counts_only_sends():
+    async def scenario():
+        scheduler = OutboundScheduler(group_rate=0.001, group_burst=2)
+        await scheduler.initialize()
+        try:
+            for _ in range(3):
+                await _request(scheduler, "editForumTopic", {"chat_id": -100})
+            await _request(scheduler, "sendMediaGroup", {"chat_id": -100, "media": [1] * 10})
+            return scheduler._buckets[-100].tokens
+        finally:
+            await scheduler.shutdown()
+
+    # Топики не тратят лимит группы, альбом стоит как одно сообщение
+    assert 0.9 < run(scenario()) < 1.1
+
+
+def test_retry_after_tightens_chat_rate():
+    async def scenario():
+        scheduler = OutboundScheduler(private_rate=10.0)
+        await scheduler.initialize()
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RetryAfter(0)
+            return True
+
+        try:
+            await _request(scheduler, "sendMessage", {"chat_id": 1, "text": "hi"}, flaky)
+            return len(attempts), scheduler._buckets[1].rate
+        finally:
+            await scheduler.shutdown()
+
+    assert run(scenario()) == (2, 5.0)
@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+from telegram.error import BadRequest, NetworkError
+
+from conftest import run
+from outbox import Outbox, outbox_entry
+from relay import KIND_ALBUM, KIND_TEXT
+from schema import migrate_accounts
+from storage import Database, TranscriptWriter, _fetchall
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "accounts.db")).start()
+    db.submit_write(migrate_accounts).result()
+    yield db
+    db.close()
+
+
+def _rows(db, sql):
+    return db.submit_read(_fetchall, sql, ()).result()
+
+
+def _write(db, *rows):
+    async def scenario():
+        writer = TranscriptWriter(db)
+        writer.enqueue_many(rows)
+        await writer.flush()
+
+    run(scenario())
+
+
+def test_redelivered_update_is_written_once(db):
+    entry = outbox_entry("10:5", 20, KIND_TEXT, text="hi")
+    _write(db, (1, False, "hi", (), entry))
+    _write(db, (1, False, "hi", (), entry))
+    assert _rows(db, "SELECT message_text FROM messages") == [("hi",)]
+    assert _rows(db, "SELECT idem_key FROM outbox") == [("10:5",)]
+
+
+def test_taken_key_never_drops_transcript_row(db):
+    first = outbox_entry("10:album:g", 20, KIND_ALBUM, message_ids=[1, 2])
+    late = outbox_entry("10:album:g", 20, KIND_ALBUM, message_ids=[3])
+    _write(db, (1, False, "album", (), first), (1, False, "late part", (), late))
+    assert _rows(db, "SELECT message_text FROM messages ORDER BY id") == [("album",), ("late part",)]
+    assert len(_rows(db, "SELECT id FROM outbox")) == 1
+
+
+class NoticeBot:
+    def __init__(self):
+        self.notices = []
+
+    async def send_message(self, **kwargs):
+        self.notices.append(kwargs)
+
+
+async def _deliver_all(db, rows, deliver, expected):
+    bot = NoticeBot()
+    outbox = Outbox(db, deliver, retry_delay=0.05)
+    writer = TranscriptWriter(db, on_commit=outbox.wake)
+    await outbox.start(bot)
+    writer.enqueue_many(rows)
+    await writer.flush()
+    for _ in range(300):
+        if outbox.delivered + outbox.dead >= expected:
+            break
+        await asyncio.sleep(0.01)
+    await outbox.close()
+    return outbox, bot
+
+
+def test_retry_keeps_order_within_chat(db):
+    sent = []
+    failures = {"1:1": 1}
+
+    async def deliver(bot, kind, payload):
+        key = payload["key"]
+        if failures.get(key):
+            failures[key] -= 1
+            raise NetworkError("connection reset")
+        sent.append((payload["chat_id"], key))
+
+    rows = [(1, False, key, (), outbox_entry(key, chat_id, KIND_TEXT, key=key))
+            for key, chat_id in (("1:1", 10), ("1:2", 10), ("2:1", 20), ("1:3", 10))]
+    outbox, _ = run(_deliver_all(db, rows, deliver, expected=4))
+    assert [key for chat_id, key in sent if chat_id == 10] == ["1:1", "1:2", "1:3"]
+    assert ("2:1" in [key for _, key in sent]) and outbox.retried == 1
+    assert _rows(db, "SELECT DISTINCT status FROM outbox") == [("sent",)]
+
+
+def test_permanent_error_marks_dead_and_notifies(db):
+    async def deliver(bot, kind, payload):
+        raise BadRequest("Message to copy not found")
+
+    notice = {"chat_id": 30, "text": "not delivered"}
+    rows = [(1, False, "x", (), outbox_entry("3:1", 10, KIND_TEXT, notice=notice))]
+    outbox, bot = run(_deliver_all(db, rows, deliver, expected=1))
+    assert (outbox.dead, outbox.retried) == (1, 0)
+    assert [(n["chat_id"], n["text"]) for n in bot.notices] == [(30, "not delivered")]
+    assert _rows(db, "SELECT status, attempts FROM outbox") == [("dead", 1)]
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+import persistence
+from conftest import run
+from persistence import SQLitePersistence
+from schema import migrate_state
+from storage import Database
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "state.db")).start()
+    db.submit_write(migrate_state).result()
+    yield db
+    db.close()
+
+
+def test_each_worker_restores_only_its_jobs(db):
+    async def scenario():
+        workers = [SQLitePersistence(db, shard=shard, shards=2) for shard in range(2)]
+        workers[0].save_job("album", "a", {"n": 0})
+        workers[1].save_job("album", "b", {"n": 1})
+        workers[1].save_job("album", "c", {"n": 2})
+        workers[1].drop_job("album", "c")
+        for worker in workers:
+            await worker.flush()
+        # Перезапущенный воркер 1 - новый объект с тем же номером
+        respawned = SQLitePersistence(db, shard=1, shards=2)
+        single = SQLitePersistence(db)
+        return (await workers[0].load_jobs("album"), await respawned.load_jobs("album"),
+                sorted(await single.load_jobs("album")))
+
+    first, second, single = run(scenario())
+    assert first == [("a", {"n": 0})]
+    assert second == [("b", {"n": 1})]
+    assert single == [("a", {"n": 0}), ("b", {"n": 1})]
+
+
+class FlakyWrites:
+    """Database, у которой первые failures записей падают."""
+
+    def __init__(self, db, failures):
+        self.db = db
+        self.failures = failures
+
+    async def write(self, fn, *args):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("database is locked")
+        return await self.db.write(fn, *args)
+
+    async def read(self, fn, *args):
+        return await self.db.read(fn, *args)
+
+
+def test_failed_commit_is_retried_without_new_changes(db, monkeypatch):
+    monkeypatch.setattr(persistence, "RETRY_DELAY", 0.01)
+
+    async def scenario():
+        state = SQLitePersistence(FlakyWrites(db, failures=2))
+        state.save_job("album", "a", {"n": 1})
+        for _ in range(200):
+            if state.commits:
+                break
+            await asyncio.sleep(0.01)
+        return state, await SQLitePersistence(db).load_jobs("album")
+
+    state, jobs = run(scenario())
+    assert jobs == [("a", {"n": 1})]
+    assert (state.failures, state.commits, state.pending()) == (2, 1, 0)
@@ -0,0 +1,39 @@
+from telegram.ext import ExtBot
+
+from bench.fake_api import FakeBotAPI
+from conftest import TOKEN, run
+from media import Album, Attachment
+from outbound import LANE_ALBUM, OutboundScheduler
+from relay import relay_album
+
+
+def _album(parts, message_ids):
+    album = Album("g", None, 0)
+    album.items = [Attachment("photo", f"f{i}", f"u{i}", i, "") for i in range(parts)]
+    album.message_ids = message_ids
+    return album
+
+
+async def _relay(album):
+    api = FakeBotAPI(TOKEN)
+    await api.start()
+    bot = ExtBot(TOKEN, base_url=api.base_url, rate_limiter=OutboundScheduler())
+    try:
+        await bot.initialize()
+        result = await relay_album(bot, album, 1, chat_id=-100, caption="caption",
+                                   message_thread_id=7, rate_limit_args=LANE_ALBUM)
+    finally:
+        await bot.shutdown()
+        await api.stop()
+    return api.calls, result
+
+
+def test_album_is_copied_in_one_call():
+    calls, result = run(_relay(_album(3, [12, 10, 11])))
+    assert calls["copyMessages"] == 1 and calls["sendMediaGroup"] == 0
+    assert len(result) == 3
+
+
+def test_incomplete_album_is_rebuilt():
+    calls, _ = run(_relay(_album(3, [10, 11])))
+    assert calls["copyMessages"] == 0 and calls["sendMediaGroup"] == 1
@@ -0,0 +1,23 @@
+import time
+
+from routing import MISS, Route, RoutingCache
+
+
+def test_worker_routes_expire():
+    routes = RoutingCache(ttl=0.05)
+    route = Route(1, 10, -100, 7)
+    routes.store_user(10, route, routes.generation)
+    routes.store_topic(-100, 7, None, routes.generation)
+    assert routes.by_user(10) is route and routes.by_topic(-100, 7) is None
+    time.sleep(0.06)
+    # Чужой процесс мог поменять привязку - идём в БД заново
+    assert routes.by_user(10) is MISS and routes.by_topic(-100, 7) is MISS
+    assert len(routes) == 0
+
+
+def test_routes_without_ttl_stay():
+    routes = RoutingCache(maxsize=1)
+    routes.store_user(10, None, routes.generation)
+    assert routes.by_user(10) is None
+    routes.store_user(11, None, routes.generation)
+    assert routes.by_user(10) is MISS
@@ -0,0 +1,46 @@
+import sqlite3
+
+import pytest
+
+from schema import migrate_accounts
+from search import build_match, search_page
+from storage import insert_account
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    migrate_accounts(conn)
+    yield conn
+    conn.close()
+
+
+def _message(conn, account_id, text):
+    conn.execute("INSERT INTO messages (account_id, from_admin, message_text) VALUES (?, 0, ?)",
+                 (account_id, text))
+
+
+def _all_pages(conn, match, window):
+    floor, rows = search_page(conn, match, window=window)
+    found = list(rows)
+    while rows:
+        _, rows = search_page(conn, match, floor, (rows[-1][0], rows[-1][1]), window=window)
+        found += rows
+    return found
+
+
+def test_request_survives_busy_message_stream(conn):
+    request = insert_account(conn, 1, "alice", "broken invoice", (), "en")
+    chatty = insert_account(conn, 2, "bob", "hello", (), "en")
+    for i in range(20):
+        _message(conn, chatty, f"invoice {i}")
+    rows = _all_pages(conn, build_match("invoice"), window=5)
+    requests = [row for row in rows if row[1] % 2]
+    assert [row[2] for row in requests] == [request]
+    # Сообщений - только последние window
+    assert sum(1 for row in rows if not row[1] % 2) == 5
+
+
+def test_build_match_quotes_operators():
+    assert build_match('a OR "b*') == '"a"* "OR"* "b"*'
+    assert build_match("!!!") is None
@@ -0,0 +1,81 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from bench.fake_api import FakeBotAPI
+from conftest import TOKEN, private_update, run, started_application, stop_application
+from sequencer import conversation_key
+
+
+def test_order_within_dialog_and_parallel_across_dialogs():
+    async def scenario():
+        api = FakeBotAPI(TOKEN)
+        await api.start()
+        finished = []
+
+        async def handle(update, context):
+            # Первый апдейт пользователя 1 самый медленный
+            await asyncio.sleep(0.2 if update.update_id == 1 else 0.01)
+            finished.append((update.effective_user.id, update.update_id))
+
+        application = await started_application(api, TypeHandler(Update, handle))
+        try:
+            updates = [private_update(1, 1), private_update(2, 2), private_update(3, 1),
+                       private_update(4, 2), private_update(5, 1)]
+            for data in updates:
+                await application.process_update(Update.de_json(data, application.bot))
+            for _ in range(100):
+                if len(finished) == len(updates):
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await stop_application(application)
+            await api.stop()
+        return finished
+
+    finished = run(scenario())
+    assert [update_id for user_id, update_id in finished if user_id == 1] == [1, 3, 5]
+    assert [update_id for user_id, update_id in finished if user_id == 2] == [2, 4]
+    # Медленный диалог не задерживает соседний
+    assert finished.index((2, 4)) < finished.index((1, 1))
+
+
+def test_in_flight_is_bounded():
+    async def scenario():
+        api = FakeBotAPI(TOKEN)
+        await api.start()
+        release = asyncio.Event()
+        peak = 0
+
+        async def handle(update, context):
+            nonlocal peak
+            peak = max(peak, application.in_flight())
+            await release.wait()
+
+        application = await started_application(api, TypeHandler(Update, handle), max_in_flight=2)
+        try:
+            feeder = asyncio.ensure_future(asyncio.gather(*(
+                application.process_update(Update.de_json(private_update(i, i), application.bot))
+                for i in range(1, 6))))
+            await asyncio.sleep(0.05)
+            blocked = not feeder.done()
+            release.set()
+            await feeder
+            while application.in_flight():
+                await asyncio.sleep(0.01)
+        finally:
+            await stop_application(application)
+            await api.stop()
+        return blocked, peak
+
+    assert run(scenario()) == (True, 2)
+
+
+def test_conversation_key_prefers_topic():
+    topic = Update.de_json({"update_id": 1, "message": {
+        "message_id": 1, "date": 0, "text": "x", "message_thread_id": 9, "is_topic_message": True,
+        "chat": {"id": -100, "type": "supergroup", "is_forum": True},
+        "from": {"id": 5, "is_bot": False, "first_name": "a"}}}, None)
+    assert conversation_key(topic) == ("topic", -100, 9)
+    assert conversation_key(Update.de_json(private_update(2, 5), None)) == ("user", 5)
@@ -0,0 +1,159 @@
+import asyncio
+import itertools
+
+import pytest
+from telegram.error import BadRequest, NetworkError
+
+from conftest import run
+from schema import migrate_accounts
+from storage import Database, _fetchall, insert_account
+from topics import IntakeQueue, TopicPool, assign_topic, mark_card_sent
+
+GROUP_ID = -1001
+
+
+class FakeTopic:
+    def __init__(self, message_thread_id):
+        self.message_thread_id = message_thread_id
+
+
+class FakeForumBot:
+    """create_forum_topic / edit_forum_topic; edit_errors - исключения очередных переименований."""
+
+    def __init__(self, edit_errors=()):
+        self._ids = itertools.count(100)
+        self.edit_errors = list(edit_errors)
+        self.names = {}
+
+    async def create_forum_topic(self, chat_id, name, **kwargs):
+        topic_id = next(self._ids)
+        self.names[topic_id] = name
+        return FakeTopic(topic_id)
+
+    async def edit_forum_topic(self, chat_id, message_thread_id, name, **kwargs):
+        if self.edit_errors:
+            raise self.edit_errors.pop(0)
+        self.names[message_thread_id] = name
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "accounts.db")).start()
+    db.submit_write(migrate_accounts).result()
+    yield db
+    db.close()
+
+
+async def _filled(pool):
+    for _ in range(200):
+        if len(pool) >= pool.size:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("запас не пополнился")
+
+
+def test_each_worker_owns_its_pool_rows(db):
+    async def scenario():
+        bot = FakeForumBot()
+        pools = [TopicPool(db, GROUP_ID, size=2, shard=shard, shards=2) for shard in range(2)]
+        for pool in pools:
+            await pool.start(bot)
+            await _filled(pool)
+            await pool.close()
+        owned = [set(pool._free) for pool in pools]
+        # Перезапущенный воркер поднимает только свои строки
+        respawned = TopicPool(db, GROUP_ID, size=0, shard=1, shards=2)
+        await respawned.start(bot)
+        return owned, set(respawned._free)
+
+    owned, restored = run(scenario())
+    assert not owned[0] & owned[1]
+    assert restored == owned[1]
+
+
+def _pool_rows(db):
+    return {row[0] for row in db.submit_read(_fetchall, "SELECT topic_id FROM topic_pool", ()).result()}
+
+
+def test_transient_rename_failure_keeps_topic(db):
+    async def scenario():
+        bot = FakeForumBot(edit_errors=[NetworkError("connection reset")])
+        pool = TopicPool(db, GROUP_ID, size=1)
+        await pool.start(bot)
+        await _filled(pool)
+        await pool.close()
+        reserved = pool._free[0]
+        with pytest.raises(NetworkError):
+            await pool.acquire("Request #1")
+        assert _pool_rows(db) == {reserved}
+        return bot, reserved, await pool.acquire("Request #1")
+
+    bot, reserved, topic_id = run(scenario())
+    assert topic_id == reserved
+    assert bot.names[topic_id] == "Request #1"
+    assert _pool_rows(db) == set()
+
+
+def test_deleted_reserve_topic_is_skipped(db):
+    async def scenario():
+        bot = FakeForumBot(edit_errors=[BadRequest("Topic_id_invalid")])
+        pool = TopicPool(db, GROUP_ID, size=1)
+        await pool.start(bot)
+        await _filled(pool)
+        await pool.close()
+        reserved = pool._free[0]
+        return reserved, await pool.acquire("Request #2"), pool.misses
+
+    reserved, topic_id, misses = run(scenario())
+    assert topic_id != reserved
+    assert misses == 1
+    assert _pool_rows(db) == set()
+
+
+def test_intake_replays_requests_without_card(db):
+    def prepare(conn):
+        ids = [insert_account(conn, user_id, f"u{user_id}", "info", (), "en") for user_id in (1, 2, 3)]
+        assign_topic(conn, ids[1], GROUP_ID, 10)  # топик есть, карточка не ушла
+        assign_topic(conn, ids[2], GROUP_ID, 11)
+        mark_card_sent(conn, ids[2])
+        return ids
+
+    ids = db.submit_write(prepare).result()
+
+    async def scenario():
+        replayed = []
+
+        async def process(bot, job):
+            replayed.append(job.account_id)
+
+        queue = IntakeQueue(db, process, workers=1)
+        await queue.start(None)
+        await queue._queue.join()
+        await queue.close()
+        return replayed
+
+    assert run(scenario()) == ids[:2]
+
+
+def test_intake_replays_only_own_shard(db):
+    def prepare(conn):
+        return [insert_account(conn, user_id, f"u{user_id}", "info", (), "en", shard=user_id % 2)
+                for user_id in (1, 2, 3, 4)]
+
+    ids = db.submit_write(prepare).result()
+
+    async def replayed_by(shard):
+        replayed = []
+
+        async def process(bot, job):
+            replayed.append(job.account_id)
+
+        queue = IntakeQueue(db, process, workers=1, shard=shard, shards=2)
+        await queue.start(None)
+        await queue._queue.join()
+        await queue.close()
+        return replayed
+
+    # Перезапущенный воркер 0 не трогает заявки живого воркера 1
+    assert run(replayed_by(0)) == [ids[1], ids[3]]
+    assert run(replayed_by(1)) == [ids[0], ids[2]]
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from conftest import run
+from schema import migrate_accounts
+from storage import Database, TranscriptWriter, _fetchall
+
+
+class FailingBatches:
+    """on_batch, который роняет первые failures транзакций."""
+
+    def __init__(self, failures):
+        self.failures = failures
+
+    def __call__(self, conn, batch):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk I/O error")
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "accounts.db")).start()
+    db.submit_write(migrate_accounts).result()
+    yield db
+    db.close()
+
+
+def _texts(db):
+    return [row[0] for row in db.submit_read(
+        _fetchall, "SELECT message_text FROM messages ORDER BY id", ()).result()]
+
+
+def test_flush_raises_until_batch_is_committed(db):
+    async def scenario():
+        writer = TranscriptWriter(db, on_batch=FailingBatches(2))
+        writer.enqueue(1, False, "first")
+        writer.enqueue(1, True, "second")
+        for _ in range(2):
+            with pytest.raises(OSError):
+                await writer.flush()
+            assert len(writer) == 2
+        await writer.flush()
+        return writer
+
+    writer = run(scenario())
+    assert _texts(db) == ["first", "second"]
+    assert (writer.failures, writer.commits, len(writer)) == (2, 1, 0)
+
+
+def test_background_writer_retries_failed_batch(db):
+    async def scenario():
+        writer = TranscriptWriter(db, on_batch=FailingBatches(3), retry_delay=0.01)
+        writer.start()
+        writer.enqueue(1, False, "kept")
+        for _ in range(200):
+            if writer.commits:
+                break
+            await asyncio.sleep(0.01)
+        writer.enqueue(1, False, "after")
+        await writer.close()
+        return writer
+
+    writer = run(scenario())
+    assert _texts(db) == ["kept", "after"]
+    assert writer.failures == 3
+
+
+def _reject_poison(conn, batch):
+    if any(row[2] == "poison" for row in batch):
+        raise ValueError("bad row")
+
+
+def test_poison_row_does_not_block_queue(db):
+    async def scenario():
+        writer = TranscriptWriter(db, on_batch=_reject_poison, retry_delay=0.01, split_after=3)
+        writer.start()
+        writer.enqueue_many([(1, False, "before"), (1, False, "poison"), (1, True, "after")])
+        for _ in range(200):
+            if writer.dead_letters:
+                break
+            await asyncio.sleep(0.01)
+        writer.enqueue(1, False, "later")
+        await writer.flush()
+        await writer.close()
+        return writer
+
+    writer = run(scenario())
+    assert _texts(db) == ["before", "after", "later"]
+    (dead,) = db.submit_read(_fetchall, "SELECT row, error FROM transcript_dead_letters", ()).result()
+    assert "poison" in dead[0] and "bad row" in dead[1]
+    assert (writer.failures, writer.dead_letters, len(writer)) == (3, 1, 0)
@@ -0,0 +1,170 @@
+import asyncio
+
+from telegram.ext import MessageHandler, filters
+
+import webhook
+from bench.fake_api import FakeBotAPI
+from conftest import TOKEN, private_update, run, started_application, stop_application
+from metrics import METRICS_PATH, Metrics, MetricsServer
+from webhook import WebhookServer, replay
+
+PATH = "/telegram"
+
+
+class Recorder:
+    def __init__(self):
+        self.updates = []
+
+    async def process_update(self, update):
+        self.updates.append(update)
+
+
+async def _server(**kwargs):
+    server = WebhookServer(Recorder(), port=0, path=PATH, decode=lambda data: data, **kwargs)
+    await server.start()
+    return server, server._server.sockets[0].getsockname()[1]
+
+
+async def _closed_by_server(port, data, timeout=2.0):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(data)
+    await writer.drain()
+    try:
+        return await asyncio.wait_for(reader.read(), timeout) == b""
+    finally:
+        writer.close()
+
+
+def test_stalled_headers_close_connection():
+    async def scenario():
+        server, port = await _server(header_timeout=0.1)
+        try:
+            closed = await _closed_by_server(port, f"POST {PATH} HTTP/1.1\r\nHost: x\r\n".encode())
+        finally:
+            await server.stop()
+        return closed, server.timeouts
+
+    assert run(scenario()) == (True, 1)
+
+
+def test_idle_connection_is_closed():
+    async def scenario():
+        server, port = await _server(keepalive_timeout=0.1)
+        try:
+            closed = await _closed_by_server(port, b"")
+        finally:
+            await server.stop()
+        return closed, server.timeouts
+
+    assert run(scenario()) == (True, 1)
+
+
+def test_stalled_body_closes_connection():
+    async def scenario():
+        server, port = await _server(body_timeout=0.1)
+        try:
+            request = f"POST {PATH} HTTP/1.1\r\nContent-Length: 100\r\n\r\n{{\"update_id\"".encode()
+            closed = await _closed_by_server(port, request)
+        finally:
+            await server.stop()
+        return closed, server.timeouts, server.application.updates
+
+    assert run(scenario()) == (True, 1, [])
+
+
+async def _status_line(port, data):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(data)
+    await writer.drain()
+    try:
+        return (await asyncio.wait_for(reader.readline(), 2.0)).decode().strip()
+    finally:
+        writer.close()
+
+
+def test_bad_content_length_answers_400():
+    async def scenario():
+        server, port = await _server()
+        metrics_server = MetricsServer(Metrics(), port=0)
+        await metrics_server.start()
+        metrics_port = metrics_server._server.sockets[0].getsockname()[1]
+        try:
+            statuses = []
+            for port_, path in ((port, PATH), (metrics_port, METRICS_PATH)):
+                for length in ("abc", "-5", str(webhook.MAX_BODY_SIZE + 1)):
+                    request = f"POST {path} HTTP/1.1\r\nContent-Length: {length}\r\n\r\n"
+                    statuses.append(await _status_line(port_, request.encode()))
+        finally:
+            await metrics_server.stop()
+            await server.stop()
+        return statuses
+
+    assert run(scenario()) == [
+        "HTTP/1.1 400 Bad Request", "HTTP/1.1 400 Bad Request", "HTTP/1.1 413 Payload Too Large",
+    ] * 2
+
+
+def test_replay_through_webhook_to_fake_api():
+    """replay() -> WebhookServer -> SequencedApplication -> FakeBotAPI: ответы
+    каждому пользователю уходят в порядке его сообщений."""
+    async def scenario():
+        api = FakeBotAPI(TOKEN)
+        await api.start()
+        replies = []
+        api.listeners.append(lambda method, params, now: replies.append(
+            (int(params["chat_id"]), params["text"])) if method == "sendMessage" else None)
+
+        async def echo(update, context):
+            await asyncio.sleep(0.01 * (update.update_id % 3))
+            await update.message.reply_text(f"echo {update.message.text}")
+
+        application = await started_application(api, MessageHandler(filters.TEXT, echo))
+        server = WebhookServer(application, port=0, path=PATH, secret_token="s3cret")
+        await server.start()
+        url = f"http://127.0.0.1:{server._server.sockets[0].getsockname()[1]}{PATH}"
+        updates = [private_update(i, 100 + i % 3, text=str(i)) for i in range(1, 31)]
+        try:
+            statuses = await replay(url, updates, secret_token="s3cret", concurrency=1)
+            forbidden = await replay(url, updates[:1], secret_token="wrong")
+            for _ in range(300):
+                if len(replies) == len(updates):
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await server.stop()
+            await stop_application(application)
+            await api.stop()
+        return statuses, forbidden, replies, server.accepted
+
+    statuses, forbidden, replies, accepted = run(scenario())
+    assert statuses == [200] * 30 and forbidden == [403] and accepted == 30
+    for user_id in (100, 101, 102):
+        texts = [text for chat_id, text in replies if chat_id == user_id]
+        assert texts == [f"echo {i}" for i in range(1, 31) if 100 + i % 3 == user_id]
+
+
+def test_full_queue_answers_503(monkeypatch):
+    monkeypatch.setattr(webhook, "ENQUEUE_TIMEOUT", 0.05)
+
+    class Stuck:
+        def __init__(self):
+            self.release = asyncio.Event()
+
+        async def process_update(self, update):
+            await self.release.wait()
+
+    async def scenario():
+        application = Stuck()
+        server = WebhookServer(application, port=0, path=PATH, queue_size=1, decode=lambda data: data)
+        await server.start()
+        url = f"http://127.0.0.1:{server._server.sockets[0].getsockname()[1]}{PATH}"
+        try:
+            # Первый апдейт занял forwarder, второй - очередь, третьему места нет
+            statuses = await replay(url, [private_update(i, 1) for i in range(1, 4)])
+            health = server.health()
+        finally:
+            application.release.set()
+            await server.stop()
+        return statuses, health[0], server.rejected
+
+    assert run(scenario()) == ([200, 200, 503], 503, 1)
@@ -0,0 +1,238 @@
+"""Создание топиков вне пути приёма заявки.
+
+* TopicPool держит запас заранее созданных топиков в группе админов
+  (таблица topic_pool, переживает рестарт). Новой заявке достаётся
+  готовый топик, который только переименовывается (edit_forum_topic);
+  запас пополняется в фоне. В кластере у каждого воркера свой запас:
+  строки помечены номером воркера (shard).
+* IntakeQueue - очередь заявок, для которых ещё нужно назначить топик и
+  отправить карточку. Обработчик пользователя сохраняет заявку, отвечает
+  ему и кладёт задачу сюда; воркеры выполняют её с повторами. Отправка
+  карточки отмечается в accounts.card_sent, и при старте поднимаются
+  заявки без неё - с топиком или без. В кластере каждый воркер поднимает
+  только принятые им заявки (accounts.shard): перезапуск одного воркера
+  не перехватывает заявки, которые ещё обрабатывают остальные.
+"""
+import asyncio
+import logging
+from collections import deque
+
+from telegram.error import BadRequest
+
+from outbound import LANE_BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+TOPIC_POOL_SIZE = 5
+POOL_TOPIC_NAME = "⏳ Reserve"
+REFILL_BACKOFF = 30       # секунд после неудачного пополнения
+INTAKE_WORKERS = 2
+INTAKE_MAX_ATTEMPTS = 5
+INTAKE_RETRY_DELAY = 2.0  # секунд, удваивается с каждой попыткой
+INTAKE_REPLAY_WINDOW = "-1 day"  # какие заявки без карточки поднимать при старте
+
+
+def _load_pool(conn, admin_chat_id, shard, shards):
+    return [row[0] for row in conn.execute(
+        "SELECT topic_id FROM topic_pool WHERE admin_chat_id = ? AND shard % ? = ? "
+        "ORDER BY created_at, topic_id",
+        (admin_chat_id, shards, shard))]
+
+
+def _add_to_pool(conn, admin_chat_id, topic_id, shard):
+    conn.execute("INSERT OR IGNORE INTO topic_pool (admin_chat_id, topic_id, shard) VALUES (?, ?, ?)",
+                 (admin_chat_id, topic_id, shard))
+
+
+def _take_from_pool(conn, admin_chat_id, topic_id):
+    return conn.execute("DELETE FROM topic_pool WHERE admin_chat_id = ? AND topic_id = ?",
+                        (admin_chat_id, topic_id)).rowcount
+
+
+def assign_topic(conn, account_id, admin_chat_id, topic_id):
+    """-> (id, user_id, admin_chat_id, topic_id) заявки для routing.Route."""
+    conn.execute("UPDATE accounts SET admin_chat_id = ?, topic_id = ? WHERE id = ?",
+                 (admin_chat_id, topic_id, account_id))
+    return conn.execute("SELECT id, user_id, admin_chat_id, topic_id FROM accounts WHERE id = ?",
+                        (account_id,)).fetchone()
+
+
+def mark_card_sent(conn, account_id):
+    conn.execute("UPDATE accounts SET card_sent = 1 WHERE id = ?", (account_id,))
+
+
+class TopicPool:
+    def __init__(self, db, admin_chat_id, size=TOPIC_POOL_SIZE, name=POOL_TOPIC_NAME, shard=0, shards=1):
+        self.db = db
+        self.admin_chat_id = admin_chat_id
+        self.shard = shard
+        self.shards = shards
+        self.size = size
+        self.name = name
+        self._free = deque()
+        self._bot = None
+        self._refill_needed = asyncio.Event()
+        self._task = None
+        # Счётчики для наблюдения
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._free)
+
+    async def start(self, bot):
+        self._bot = bot
+        self._free.extend(await self.db.read(_load_pool, self.admin_chat_id, self.shard, self.shards))
+        if self.size > 0:
+            self._refill_needed.set()
+            self._task = asyncio.create_task(self._refill_loop(), name="topic-pool-refill")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def acquire(self, name):
+        """Возвращает message_thread_id топика с именем name.
+
+        Если переименовать топик из запаса не удалось не по вине топика
+        (сеть, таймаут), он возвращается в запас, а исключение уходит
+        вызывающему - заявку повторит IntakeQueue.
+        """
+        while self._free:
+            topic_id = self._free.popleft()
+            self._refill_needed.set()
+            if not await self.db.write(_take_from_pool, self.admin_chat_id, topic_id):
+                continue  # уже забран
+            try:
+                await self._bot.edit_forum_topic(
+                    chat_id=self.admin_chat_id, message_thread_id=topic_id, name=name
+                )
+            except BadRequest as e:
+                # Топик могли удалить руками - берём следующий
+                logger.warning(f"Не удалось переименовать топик {topic_id} из запаса: {e}")
+                continue
+            except Exception:
+                self._free.appendleft(topic_id)
+                await self.db.write(_add_to_pool, self.admin_chat_id, topic_id, self.shard)
+                raise
+            self.hits += 1
+            return topic_id
+        self.misses += 1
+        topic = await self._bot.create_forum_topic(chat_id=self.admin_chat_id, name=name)
+        return topic.message_thread_id
+
+    async def _refill_loop(self):
+        while True:
+            await self._refill_needed.wait()
+            self._refill_needed.clear()
+            try:
+                while len(self._free) < self.size:
+                    topic = await self._bot.create_forum_topic(
+                        chat_id=self.admin_chat_id,
+                        name=self.name,
+                        rate_limit_args=LANE_BACKGROUND,
+                    )
+                    await self.db.write(_add_to_pool, self.admin_chat_id, topic.message_thread_id, self.shard)
+                    self._free.append(topic.message_thread_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка пополнения запаса топиков: {e}")
+                await asyncio.sleep(REFILL_BACKOFF)
+                self._refill_needed.set()
+
+
+class IntakeJob:
+    __slots__ = ("account_id", "user_info", "account_info", "language", "attempts")
+
+    def __init__(self, account_id, user_info, account_info, language=None):
+        self.account_id = account_id
+        self.user_info = user_info
+        self.account_info = account_info
+        self.language = language
+        self.attempts = 0
+
+
+# Предикат card_sent = 0 дословно совпадает с частичным индексом schema v12
+def _pending_cards(conn, shard, shards):
+    return conn.execute(
+        "SELECT id, username, account_info, language FROM accounts INDEXED BY idx_accounts_card_pending "
+        "WHERE card_sent = 0 AND shard % ? = ? AND created_at >= datetime('now', ?) ORDER BY id",
+        (shards, shard, INTAKE_REPLAY_WINDOW)).fetchall()
+
+
+class IntakeQueue:
+    """process(bot, job) назначает топик и шлёт карточку; исключение - повтор.
+
+    replay=False - не поднимать при старте заявки без карточки; поднимаются
+    только заявки воркера shard (accounts.shard по модулю shards).
+    """
+
+    def __init__(self, db, process, workers=INTAKE_WORKERS,
+                 max_attempts=INTAKE_MAX_ATTEMPTS, retry_delay=INTAKE_RETRY_DELAY, replay=True,
+                 shard=0, shards=1):
+        self.db = db
+        self.process = process
+        self.replay = replay
+        self.shard = shard
+        self.shards = shards
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        self._retries = set()
+        self._bot = None
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def submit(self, account_id, user_info, account_info, language=None):
+        self._queue.put_nowait(IntakeJob(account_id, user_info, account_info, language))
+
+    async def start(self, bot):
+        self._bot = bot
+        # Заявки, принятые до рестарта, но так и не получившие топик или карточку
+        if self.replay:
+            pending = await self.db.read(_pending_cards, self.shard, self.shards)
+            for account_id, user_info, account_info, language in pending:
+                self.submit(account_id, user_info, account_info, language)
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"intake-{i}") for i in range(self.workers)
+        ]
+
+    async def close(self):
+        for task in (*self._tasks, *self._retries):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._retries, return_exceptions=True)
+        self._tasks = []
+        self._retries.clear()
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self.process(self._bot, job)
+            except Exception as e:
+                job.attempts += 1
+                if job.attempts >= self.max_attempts:
+                    logger.error(f"Не удалось создать топик для запроса #{job.account_id} "
+                                 f"после {job.attempts} попыток: {e}")
+                else:
+                    delay = self.retry_delay * 2 ** (job.attempts - 1)
+                    logger.warning(f"Топик для запроса #{job.account_id}: попытка "
+                                   f"{job.attempts} не удалась ({e}), повтор через {delay} с")
+                    task = asyncio.create_task(self._retry_later(job, delay))
+                    self._retries.add(task)
+                    task.add_done_callback(self._retries.discard)
+            finally:
+                self._queue.task_done()
+
+    async def _retry_later(self, job, delay):
+        await asyncio.sleep(delay)
+        self._queue.put_nowait(job)
@@ -0,0 +1,78 @@
+"""Отслеживание файлов через watchdog с вызовом async-функции в event loop.
+
+Одна правка порождает серию событий (запись, -wal, переименование
+временного файла редактором), поэтому перечитывание откладывается на
+debounce; событие, пришедшее во время перечитывания, вызывает ещё одно
+после него - последняя правка не теряется.
+"""
+import asyncio
+import logging
+import os
+
+from watchdog.events import EVENT_TYPE_CLOSED_NO_WRITE, EVENT_TYPE_OPENED, FileSystemEventHandler
+from watchdog.observers import Observer
+
+logger = logging.getLogger(__name__)
+
+DEBOUNCE = 0.2  # секунд
+# Чтение файла (в том числе нашим же перечитыванием) - не правка
+_READ_EVENTS = {EVENT_TYPE_OPENED, EVENT_TYPE_CLOSED_NO_WRITE}
+
+
+class _PathHandler(FileSystemEventHandler):
+    def __init__(self, paths, callback):
+        self.paths = paths
+        self.callback = callback
+
+    def on_any_event(self, event):
+        if event.event_type in _READ_EVENTS:
+            return
+        # Редакторы сохраняют через временный файл: нужный путь - в dest_path
+        for path in (event.src_path, getattr(event, "dest_path", "")):
+            if path and os.path.abspath(path) in self.paths:
+                self.callback()
+                return
+
+
+class FileWatcher:
+    def __init__(self, paths, callback, debounce=DEBOUNCE):
+        self.paths = {os.path.abspath(path) for path in paths}
+        self.callback = callback
+        self.debounce = debounce
+        self._observer = None
+        self._loop = None
+        self._task = None
+        self._changed = False
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        handler = _PathHandler(self.paths, self._on_event)
+        self._observer = Observer()
+        for directory in {os.path.dirname(path) for path in self.paths}:
+            self._observer.schedule(handler, directory, recursive=False)
+        self._observer.daemon = True
+        self._observer.start()
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+
+    def _on_event(self):
+        # Вызывается из потока watchdog
+        self._loop.call_soon_threadsafe(self._schedule)
+
+    def _schedule(self):
+        self._changed = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._changed:
+            await asyncio.sleep(self.debounce)
+            self._changed = False
+            try:
+                await self.callback()
+            except Exception as e:
+                logger.error(f"Ошибка перечитывания {', '.join(sorted(self.paths))}: {e}")
@@ -0,0 +1,306 @@
+"""Приём апдейтов через webhook без сторонних веб-фреймворков.
+
+Встроенный HTTP/1.1 сервер на asyncio:
+
+* POST <path> - апдейт от Telegram (или от балансировщика). Проверяется
+  заголовок X-Telegram-Bot-Api-Secret-Token;
+* GET /healthz - состояние для балансировщика: глубина очереди, 503 при
+  переполнении.
+
+Чтение запроса ограничено по времени: строка запроса ждётся не дольше
+KEEPALIVE_TIMEOUT (простой keep-alive-соединения между запросами),
+заголовки - HEADER_TIMEOUT, тело - BODY_TIMEOUT. Медленный или зависший
+клиент не держит соединение и задачу сервера - по истечении соединение
+закрывается.
+
+Принятые апдейты кладутся в ограниченную очередь, один forwarder по
+порядку передаёт их в application.process_update. Если обработка не
+успевает и очередь полна, сервер отвечает 503 - Telegram повторит
+доставку позже, так что апдейты не теряются.
+
+Для проверки без Telegram есть replay(): он POST-ит записанные апдейты
+(JSONL, по объекту на строку) в локальный сервер:
+
+    python webhook.py http://127.0.0.1:8443/telegram updates.jsonl --secret XXX
+"""
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_QUEUE_SIZE = 1000
+ENQUEUE_TIMEOUT = 1.0      # секунд ждём места в очереди, прежде чем ответить 503
+KEEPALIVE_TIMEOUT = 75.0   # секунд простоя соединения до следующего запроса
+HEADER_TIMEOUT = 10.0      # секунд на заголовки после строки запроса
+BODY_TIMEOUT = 30.0        # секунд на тело запроса
+MAX_BODY_SIZE = 1 << 20
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+HEALTH_PATH = "/healthz"
+
+_REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 413: "Payload Too Large", 429: "Too Many Requests",
+    503: "Service Unavailable",
+}
+
+
+class WebhookServer:
+    """application - что угодно с async process_update(update); decode(data)
+    превращает разобранный JSON в то, что ему передаётся (по умолчанию Update)."""
+
+    def __init__(self, application, listen="127.0.0.1", port=8443, path="/telegram",
+                 secret_token=None, queue_size=WEBHOOK_QUEUE_SIZE, decode=None,
+                 header_timeout=HEADER_TIMEOUT, body_timeout=BODY_TIMEOUT,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT):
+        self.application = application
+        self.decode = decode or (lambda data: Update.de_json(data, application.bot))
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._server = None
+        self._forwarder = None
+        # Счётчики для наблюдения
+        self.accepted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        self._forwarder = asyncio.create_task(self._forward(), name="webhook-forwarder")
+        logger.info(f"Webhook слушает {self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._forwarder is not None:
+            # Уже принятые апдейты доводим до обработчиков
+            await self.queue.join()
+            self._forwarder.cancel()
+            try:
+                await self._forwarder
+            except asyncio.CancelledError:
+                pass
+            self._forwarder = None
+
+    async def _forward(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"Ошибка передачи апдейта из webhook: {e}")
+            finally:
+                self.queue.task_done()
+
+    # ---------- HTTP ----------
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader, self.header_timeout, self.body_timeout,
+                                             self.keepalive_timeout)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload = await self._dispatch(method, path, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.TimeoutError:
+            # Клиент замолчал посреди запроса или простаивает - закрываем
+            self.timeouts += 1
+        except InvalidRequest as e:
+            write_response(writer, e.status, {"ok": False}, keep_alive=False)
+        except Exception as e:
+            logger.error(f"Ошибка webhook-соединения: {e}")
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, headers, body):
+        path = path.split("?", 1)[0]
+        if path == HEALTH_PATH:
+            if method != "GET":
+                return 405, {"ok": False}
+            return self.health()
+        if path != self.path:
+            return 404, {"ok": False}
+        if method != "POST":
+            return 405, {"ok": False}
+        if self.secret_token and not hmac.compare_digest(
+            headers.get(SECRET_HEADER, "").encode(), self.secret_token.encode()
+        ):
+            return 403, {"ok": False}
+        try:
+            update = self.decode(json.loads(body))
+        except Exception as e:
+            logger.warning(f"Некорректный апдейт в webhook: {e}")
+            return 400, {"ok": False}
+        try:
+            await asyncio.wait_for(self.queue.put(update), ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return 503, {"ok": False, "reason": "queue full"}
+        self.accepted += 1
+        return 200, {"ok": True}
+
+    def health(self):
+        depth = self.queue.qsize()
+        full = self.queue.full()
+        return (503 if full else 200), {
+            "ok": not full,
+            "queue": depth,
+            "capacity": self.queue.maxsize,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+        }
+
+
+class InvalidRequest(Exception):
+    """Запрос нельзя дочитать; соединение закрывается с ответом status."""
+    status = 400
+
+
+class BodyTooLarge(InvalidRequest):
+    status = 413
+
+
+def _content_length(headers):
+    value = headers.get("content-length")
+    if not value:
+        return 0
+    # int() принял бы и "-1", и "1_0", и " 10"
+    if not (value.isascii() and value.isdigit()):
+        raise InvalidRequest(f"Content-Length: {value!r}")
+    length = int(value)
+    if length > MAX_BODY_SIZE:
+        raise BodyTooLarge()
+    return length
+
+
+async def _read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+async def read_request(reader, header_timeout=HEADER_TIMEOUT, body_timeout=BODY_TIMEOUT,
+                       keepalive_timeout=KEEPALIVE_TIMEOUT):
+    """-> (method, path, headers, body) или None; asyncio.TimeoutError, если
+    часть запроса не пришла вовремя (None вместо числа - ждать без предела)."""
+    request_line = await asyncio.wait_for(reader.readline(), keepalive_timeout)
+    if not request_line:
+        return None
+    try:
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        return None
+    headers = await asyncio.wait_for(_read_headers(reader), header_timeout)
+    length = _content_length(headers)
+    body = await asyncio.wait_for(reader.readexactly(length), body_timeout) if length else b""
+    return method.upper(), path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive, content_type="application/json"):
+    """payload - объект для JSON или готовый текст (тогда нужен content_type)."""
+    body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+    head = (
+        f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    writer.write(head.encode() + body)
+
+
+def run_webhook(application, server, webhook_url=None, drop_pending_updates=False):
+    """Аналог application.run_polling() для webhook-режима."""
+    loop = asyncio.get_event_loop()
+
+    def _stop():
+        loop.stop()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, _stop)
+        except NotImplementedError:  # Windows
+            pass
+
+    try:
+        loop.run_until_complete(application.initialize())
+        if application.post_init:
+            loop.run_until_complete(application.post_init(application))
+        # Задачи обработки апдейтов PTB дожидается при stop(), только если
+        # они созданы после start() - поэтому приём открывается после него
+        loop.run_until_complete(application.start())
+        loop.run_until_complete(server.start())
+        if webhook_url:
+            loop.run_until_complete(application.bot.set_webhook(
+                url=webhook_url,
+                secret_token=server.secret_token,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=drop_pending_updates,
+            ))
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(server.stop())
+        if application.running:
+            loop.run_until_complete(application.stop())
+        loop.run_until_complete(application.shutdown())
+        if application.post_shutdown:
+            loop.run_until_complete(application.post_shutdown(application))
+
+
+# ---------- локальная подделка Telegram для проверки ----------
+async def replay(url, updates, secret_token=None, concurrency=1):
+    """POST-ит апдейты (dict) на url; возвращает список HTTP-статусов."""
+    import httpx
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret_token} if secret_token else {}
+    statuses = []
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(timeout=10) as client:
+        async def post(update):
+            async with semaphore:
+                response = await client.post(url, json=update, headers=headers)
+                statuses.append(response.status_code)
+
+        await asyncio.gather(*(post(update) for update in updates))
+    return statuses
+
+
+def _load_updates(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Отправить записанные апдейты в локальный webhook")
+    parser.add_argument("url")
+    parser.add_argument("updates", help="JSONL-файл, по апдейту на строку")
+    parser.add_argument("--secret")
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args()
+    result = asyncio.run(replay(args.url, _load_updates(args.updates), args.secret, args.concurrency))
+    print({status: result.count(status) for status in set(result)})